@@ -11,13 +11,15 @@ from conda.resolve import Resolve
 
 def get_index(channel_urls=(), prepend=True, platform=None,
               use_local=False, use_cache=False, unknown=False,
-              offline=False, prefix=None):
+              offline=False, prefix=None, names=None):
     """
     Return the index of packages available on the channels
 
     If prepend=False, only the channels passed in as arguments are used.
     If platform=None, then the current platform is used.
     If prefix is supplied, then the packages installed in that prefix are added.
+    If names is supplied, the index may be limited to the packages which
+    can be reached from these names (see conda.shards).
     """
     if use_local:
         channel_urls = ['local'] + list(channel_urls)
@@ -26,7 +28,8 @@ def get_index(channel_urls=(), prepend=True, platform=None,
         pri0 = max(itervalues(channel_urls), key=itemgetter(1))[1] if channel_urls else 0
         for url, rec in iteritems(config.get_channel_urls(platform, offline)):
             channel_urls[url] = (rec[0], rec[1] + pri0)
-    index = fetch_index(channel_urls, use_cache=use_cache, unknown=unknown)
+    index = fetch_index(channel_urls, use_cache=use_cache, unknown=unknown,
+                        names=names)
     if prefix:
         priorities = {c: p for c, p in itervalues(channel_urls)}
         for dist, info in iteritems(install.linked_data(prefix)):
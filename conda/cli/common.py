@@ -198,6 +198,15 @@ def add_parser_copy(p):
         help="Install all packages using copies instead of hard- or soft-linking."
         )
 
+def add_parser_swap(p):
+    p.add_argument(
+        '--swap',
+        action="store_true",
+        default=config.swap_environments,
+        help="Build the updated environment next to the existing one, and swap "
+             "it in once complete (default: %(default)s).",
+        )
+
 def add_parser_pscheck(p):
     p.add_argument(
         "--force-pscheck",
@@ -243,6 +252,7 @@ def add_parser_install(p):
     add_parser_prefix(p)
     add_parser_quiet(p)
     add_parser_copy(p)
+    add_parser_swap(p)
     p.add_argument(
         "--alt-hint",
         action="store_true",
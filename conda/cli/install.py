@@ -22,7 +22,7 @@ import conda.misc as misc
 from conda.api import get_index
 from conda.cli import common
 from conda.cli.find_commands import find_executable
-from conda.resolve import NoPackagesFound, Unsatisfiable, Resolve
+from conda.resolve import NoPackagesFound, Unsatisfiable, Resolve, MatchSpec
 import conda.install as ci
 
 log = logging.getLogger(__name__)
@@ -59,7 +59,8 @@ def check_prefix(prefix, json=False):
         common.error_and_exit(error, json=json, error_type="ValueError")
 
 
-def clone(src_arg, dst_prefix, json=False, quiet=False, index=None):
+def clone(src_arg, dst_prefix, json=False, quiet=False, index=None,
+          always_copy=False):
     if os.sep in src_arg:
         src_prefix = abspath(src_arg)
         if not isdir(src_prefix):
@@ -80,7 +81,8 @@ def clone(src_arg, dst_prefix, json=False, quiet=False, index=None):
     with common.json_progress_bars(json=json and not quiet):
         actions, untracked_files = misc.clone_env(src_prefix, dst_prefix,
                                                   verbose=not json,
-                                                  quiet=quiet, index=index)
+                                                  quiet=quiet, index=index,
+                                                  always_copy=always_copy)
 
     if json:
         common.stdout_json_success(
@@ -205,6 +207,11 @@ def install(args, parser, command='install'):
             install_tar(prefix, tar_path, verbose=not args.quiet)
             return
 
+    if (newenv and args.clone) or (isinstall and args.revision):
+        # the index needs to contain packages which are not in the specs
+        names = None
+    else:
+        names = {MatchSpec(s).name for s in specs} | lnames
     index = common.get_index_trap(channel_urls=channel_urls,
                                   prepend=not args.override_channels,
                                   use_local=args.use_local,
@@ -212,7 +219,8 @@ def install(args, parser, command='install'):
                                   unknown=args.unknown,
                                   json=args.json,
                                   offline=args.offline,
-                                  prefix=prefix)
+                                  prefix=prefix,
+                                  names=names)
     r = Resolve(index)
     ospecs = list(specs)
     plan.add_defaults_to_specs(r, linked, specs, update=isupdate)
@@ -222,7 +230,8 @@ def install(args, parser, command='install'):
             common.error_and_exit('did not expect any arguments for --clone',
                                   json=args.json,
                                   error_type="ValueError")
-        clone(args.clone, prefix, json=args.json, quiet=args.quiet, index=index)
+        clone(args.clone, prefix, json=args.json, quiet=args.quiet, index=index,
+              always_copy=args.copy)
         misc.append_env(prefix)
         misc.touch_nonadmin(prefix)
         if not args.json:
@@ -389,7 +398,10 @@ environment does not exist: %s
 
     with common.json_progress_bars(json=args.json and not args.quiet):
         try:
-            plan.execute_actions(actions, index, verbose=not args.quiet)
+            if args.swap and not newenv:
+                misc.swap_execute_actions(actions, index, verbose=not args.quiet)
+            else:
+                plan.execute_actions(actions, index, verbose=not args.quiet)
             if not (command == 'update' and args.all):
                 try:
                     with open(join(prefix, 'conda-meta', 'history'), 'a') as f:
@@ -23,12 +23,14 @@ conda provides the following commands:
                  packages
     install    : install new packages into an existing conda environment
     update     : update packages in a specified conda environment
+    verify     : verify the files of the packages in a conda environment
 
 
     Packaging
     =========
 
     package    : create a conda package in an environment
+    serve      : serve package caches as a channel over HTTP
 
 Additional help for each command can be accessed by using:
 
@@ -88,7 +90,8 @@ def main():
     )
 
     main_modules = ["info", "help", "list", "search", "create", "install", "update",
-                    "remove", "config", "init", "clean", "package", "bundle"]
+                    "remove", "config", "init", "clean", "package", "bundle", "serve",
+                    "verify"]
     modules = ["conda.cli.main_"+suffix for suffix in main_modules]
     for module in modules:
         imported = importlib.import_module(module)
@@ -15,7 +15,8 @@ from os import lstat, walk, listdir
 from conda.cli import common
 import conda.config as config
 from conda.utils import human_bytes
-from conda.install import rm_rf
+from conda.install import (gc_objects, is_deduplicated, linked_prefixes,
+                           package_refs, rm_rf, set_package_refs)
 
 descr = """
 Remove unused packages and caches.
@@ -50,7 +51,8 @@ def configure_parser(sub_parsers):
     p.add_argument(
         "-l", "--lock",
         action="store_true",
-        help="Remove all conda lock files.",
+        help="Remove the conda lock files of processes which are not "
+             "running anymore.",
     )
     p.add_argument(
         "-t", "--tarballs",
@@ -60,8 +62,9 @@ def configure_parser(sub_parsers):
     p.add_argument(
         '-p', '--packages',
         action='store_true',
-        help="""Remove unused cached packages. Warning: this does not check
-    for symlinked packages.""",
+        help="""Remove unused cached packages. Warning: packages which were
+    extracted by older versions of conda are only detected as being used when
+    they are hard-linked.""",
     )
     p.add_argument(
         '-s', '--source-cache',
@@ -163,7 +166,7 @@ class CrossPlatformStLink(object):
 def find_lock():
     from os.path import join
 
-    from conda.lock import LOCKFN
+    from conda.lock import LOCKFN, lock_pid, pid_running
 
     lock_dirs = config.pkgs_dirs[:]
     lock_dirs += [config.root_dir]
@@ -185,6 +188,10 @@ def find_lock():
         for dn in os.listdir(dir):
             if os.path.isdir(join(dir, dn)) and dn.startswith(LOCKFN):
                 path = join(dir, dn)
+                # the locks of running processes are still in use
+                pid = lock_pid(path)
+                if pid is not None and pid_running(pid):
+                    continue
                 yield path
 
 
@@ -255,13 +262,41 @@ def rm_tarballs(args, pkgs_dirs, totalsize, verbose=True):
                     print("WARNING: cannot remove, file permissions: %s" % fn)
 
 
+# number of threads scanning the files of the packages which are not known
+# to be used
+SCAN_THREADS = 8
+
+
+def scan_pkg(path, cross_platform_st_nlink, check_links=True):
+    """
+    Return the tuple (size, warnings) of the extracted package `path`, where
+    size is the total size of its files, or None as soon as one of them is
+    found to be hard-linked, i.e. when the package is used (unless
+    `check_links` is False).
+    """
+    warnings = []
+    size = 0
+    for root, dir, files in walk(path):
+        for fn in files:
+            try:
+                st = lstat(join(root, fn))
+                st_nlink = st.st_nlink or cross_platform_st_nlink(join(root, fn))
+            except OSError as e:
+                warnings.append((fn, e))
+                continue
+            if check_links and st_nlink > 1:
+                return None, warnings
+            size += st.st_size
+    return size, warnings
+
+
 def find_pkgs():
     # TODO: This doesn't handle packages that have hard links to files within
     # themselves, like bin/python3.3 and bin/python3.3m in the Python package
     warnings = []
 
     cross_platform_st_nlink = CrossPlatformStLink()
-    pkgs_dirs = defaultdict(list)
+    jobs = []
     for pkgs_dir in config.pkgs_dirs:
         if not os.path.exists(pkgs_dir):
             print("WARNING: {0} does not exist".format(pkgs_dir))
@@ -269,37 +304,40 @@ def find_pkgs():
         pkgs = [i for i in listdir(pkgs_dir)
                 if (isdir(join(pkgs_dir, i)) and  # only include actual packages
                     isdir(join(pkgs_dir, i, 'info')))]
+        refs = package_refs(pkgs_dir)
         for pkg in pkgs:
-            breakit = False
-            for root, dir, files in walk(join(pkgs_dir, pkg)):
-                if breakit:
-                    break
-                for fn in files:
-                    try:
-                        st_nlink = cross_platform_st_nlink(join(root, fn))
-                    except OSError as e:
-                        warnings.append((fn, e))
-                        continue
-                    if st_nlink > 1:
-                        # print('%s is installed: %s' % (pkg, join(root, fn)))
-                        breakit = True
-                        break
-            else:
-                pkgs_dirs[pkgs_dir].append(pkg)
+            # packages recorded as being linked into an environment are used,
+            # the others are only removed when none of their files is
+            # hard-linked either, except for the recorded deduplicated
+            # packages, whose files are always hard-linked to their objects
+            prefixes = linked_prefixes(pkgs_dir, pkg, refs)
+            if not prefixes:
+                jobs.append((pkgs_dir, pkg, prefixes is None or
+                             not is_deduplicated(join(pkgs_dir, pkg))))
+
+    def scan(job):
+        return scan_pkg(join(job[0], job[1]), cross_platform_st_nlink, job[2])
+
+    try:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(SCAN_THREADS)
+    except (ImportError, RuntimeError):
+        results = [scan(job) for job in jobs]
+    else:
+        try:
+            results = list(executor.map(scan, jobs))
+        finally:
+            executor.shutdown(wait=True)
 
     totalsize = 0
+    pkgs_dirs = defaultdict(list)
     pkgsizes = defaultdict(list)
-    for pkgs_dir in pkgs_dirs:
-        for pkg in pkgs_dirs[pkgs_dir]:
-            pkgsize = 0
-            for root, dir, files in walk(join(pkgs_dir, pkg)):
-                for fn in files:
-                    # We don't have to worry about counting things twice:  by
-                    # definition these files all have a link count of 1!
-                    size = lstat(join(root, fn)).st_size
-                    totalsize += size
-                    pkgsize += size
+    for (pkgs_dir, pkg, _), (pkgsize, pkg_warnings) in zip(jobs, results):
+        warnings.extend(pkg_warnings)
+        if pkgsize is not None:
+            pkgs_dirs[pkgs_dir].append(pkg)
             pkgsizes[pkgs_dir].append(pkgsize)
+            totalsize += pkgsize
 
     return pkgs_dirs, warnings, totalsize, pkgsizes
 
@@ -341,6 +379,23 @@ def rm_pkgs(args, pkgs_dirs, warnings, totalsize, pkgsizes,
             if verbose:
                 print("removing %s" % pkg)
             rm_rf(join(pkgs_dir, pkg))
+            set_package_refs(pkgs_dir, pkg, None)
+
+
+def rm_objects(verbose=True):
+    """
+    Remove the objects of deduplicated packages (see dedup_package_files)
+    which are not used anymore, and return their number and total size.
+    """
+    count = size = 0
+    for pkgs_dir in config.pkgs_dirs:
+        if os.access(pkgs_dir, os.W_OK):
+            pkgs_dir_count, pkgs_dir_size = gc_objects(pkgs_dir)
+            count += pkgs_dir_count
+            size += pkgs_dir_size
+    if verbose and count:
+        print("removed %d unused objects (%s)" % (count, human_bytes(size)))
+    return count, size
 
 
 def rm_index_cache():
@@ -451,6 +506,10 @@ def execute(args, parser):
         }
         rm_pkgs(args, pkgs_dirs,  warnings, totalsize, pkgsizes,
                 verbose=not args.json)
+        if not args.dry_run:
+            count, size = rm_objects(verbose=not args.json)
+            json_result['packages']['objects'] = {'count': count,
+                                                  'total_size': size}
 
     if args.source_cache or args.all:
         json_result['source_cache'] = find_source_cache()
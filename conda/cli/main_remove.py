@@ -97,7 +97,7 @@ def configure_parser(sub_parsers, name='remove'):
 def execute(args, parser):
     import conda.plan as plan
     import conda.instructions as inst
-    from conda.install import rm_rf, linked
+    from conda.install import remove_prefix, linked
     from conda import config
 
     if not (args.all or args.package_names):
@@ -150,7 +150,7 @@ def execute(args, parser):
 
     if plan.nothing_to_do(actions):
         if args.all:
-            rm_rf(prefix)
+            remove_prefix(prefix)
 
             if args.json:
                 common.stdout_json({
@@ -179,7 +179,10 @@ def execute(args, parser):
     if not args.json:
         common.confirm_yn(args)
 
-    if args.json and not args.quiet:
+    if args.all:
+        # the whole prefix is removed at once, instead of package by package
+        remove_prefix(prefix)
+    elif args.json and not args.quiet:
         with json_progress_bars():
             plan.execute_actions(actions, index, verbose=not args.quiet)
     else:
@@ -194,9 +197,6 @@ def execute(args, parser):
                 else:
                     raise
 
-    if args.all:
-        rm_rf(prefix)
-
     if args.json:
         common.stdout_json({
             'success': True,
@@ -0,0 +1,69 @@
+# (c) 2016 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+from __future__ import print_function, division, absolute_import
+
+from os.path import abspath, expanduser
+
+import conda.config as config
+
+descr = """
+Serve package caches as a channel over HTTP. (EXPERIMENTAL)
+"""
+
+example = """
+Examples:
+
+    conda serve --port 8008
+    conda serve --upstream https://repo.continuum.io/pkgs/free /shared/pkgs
+
+Other machines can then use the server as a channel, e.g.:
+
+    conda install -c http://buildhost:8008 numpy
+"""
+
+
+def configure_parser(sub_parsers):
+    p = sub_parsers.add_parser(
+        'serve',
+        description=descr,
+        help=descr,
+        epilog=example,
+    )
+    p.add_argument(
+        'pkgs_dirs',
+        metavar='PKGS_DIR',
+        nargs='*',
+        help="Package caches to serve (default: the configured pkgs_dirs).",
+    )
+    p.add_argument(
+        "--host",
+        action="store",
+        default='',
+        help="Address to listen on (default: all interfaces).",
+    )
+    p.add_argument(
+        "--port",
+        action="store",
+        type=int,
+        default=8008,
+        help="Port to listen on (default: %(default)s).",
+    )
+    p.add_argument(
+        "--upstream",
+        action="store",
+        metavar="URL",
+        help="Channel to pull packages from when they are not cached yet. "
+             "Downloaded packages are stored in the first package cache.",
+    )
+    p.set_defaults(func=execute)
+
+
+def execute(args, parser):
+    from conda.server import serve
+
+    pkgs_dirs = [abspath(expanduser(path)) for path in args.pkgs_dirs]
+    serve(pkgs_dirs or config.pkgs_dirs, host=args.host, port=args.port,
+          upstream=args.upstream)
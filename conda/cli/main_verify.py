@@ -0,0 +1,108 @@
+# (c) 2016 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+from __future__ import print_function, division, absolute_import
+
+import sys
+from argparse import RawDescriptionHelpFormatter
+
+from conda.cli import common
+
+descr = """
+Verify the files of the packages linked into a conda environment, against
+the size, mode, mtime and SHA256 recorded when they were linked.
+"""
+
+example = """
+Examples:
+
+    conda verify -n myenv
+    conda verify --deep --repair -n myenv
+
+By default, only the size and mtime of the files are checked, which is fast,
+but does not detect files being corrupted without their mtime changing.  Use
+--deep to compare the SHA256 of the files instead.
+"""
+
+
+def configure_parser(sub_parsers):
+    p = sub_parsers.add_parser(
+        'verify',
+        description=descr,
+        help=descr,
+        formatter_class=RawDescriptionHelpFormatter,
+        epilog=example,
+    )
+    common.add_parser_prefix(p)
+    common.add_parser_json(p)
+    p.add_argument(
+        "--deep",
+        action="store_true",
+        help="Compare the SHA256 of the files, instead of their size and "
+             "mtime.",
+    )
+    p.add_argument(
+        "--repair",
+        action="store_true",
+        help="Link the missing or modified files from the package cache "
+             "again.",
+    )
+    p.add_argument(
+        'packages',
+        metavar='package_name',
+        action="store",
+        nargs='*',
+        help="Packages to verify (default: all packages).",
+    )
+    p.set_defaults(func=execute)
+
+
+def execute(args, parser):
+    import conda.install as install
+
+    prefix = common.get_prefix(args)
+    linked = install.linked_data(prefix)
+    if args.packages:
+        dists = [dist for dist in linked
+                 if install.name_dist(dist) in args.packages]
+        missing = set(args.packages) - set(map(install.name_dist, dists))
+        if missing:
+            common.error_and_exit("packages not linked in %s: %s" %
+                                  (prefix, ', '.join(sorted(missing))),
+                                  json=args.json,
+                                  error_type="PackageNotInstalled")
+    else:
+        dists = list(linked)
+    unverified = sorted(dist for dist in dists
+                        if not linked[dist].get('manifest'))
+
+    problems = install.verify_files(prefix, dists, deep=args.deep)
+    if args.repair and problems:
+        damaged = {}
+        for dist, f, problem in problems:
+            damaged.setdefault(dist, []).append(f)
+        for dist in sorted(damaged):
+            install.relink_files(prefix, dist, damaged[dist])
+
+    if args.json:
+        common.stdout_json_success(
+            success=not problems or args.repair,
+            problems=[{'dist': dist, 'file': f, 'problem': problem}
+                      for dist, f, problem in problems],
+            repaired=bool(args.repair and problems),
+            unverified=unverified)
+    else:
+        for dist, f, problem in problems:
+            print("%s: %s (%s)" % (dist, f, problem))
+        if unverified:
+            print("%d package(s) linked without manifest were not verified: %s"
+                  % (len(unverified), ' '.join(unverified)))
+        if problems and args.repair:
+            print("repaired %d file(s)" % len(problems))
+        elif not problems:
+            print("verified %d package(s) in %s" %
+                  (len(dists) - len(unverified), prefix))
+    if problems and not args.repair:
+        sys.exit(1)
@@ -205,3 +205,32 @@ def with_metaclass(meta, *bases):
                 return type.__new__(cls, name, (), d)
             return meta(name, bases, d)
     return metaclass("NewBase", None, {})
+
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        class _DirEntry(object):
+            # the subset of os.DirEntry used by conda, without caching
+            def __init__(self, dir_path, name):
+                self.name = name
+                self.path = os.path.join(dir_path, name)
+
+            def is_symlink(self):
+                return os.path.islink(self.path)
+
+            def is_dir(self, follow_symlinks=True):
+                if not follow_symlinks and self.is_symlink():
+                    return False
+                return os.path.isdir(self.path)
+
+            def is_file(self, follow_symlinks=True):
+                if not follow_symlinks and self.is_symlink():
+                    return False
+                return os.path.isfile(self.path)
+
+        def scandir(path='.'):
+            return iter([_DirEntry(path, name) for name in os.listdir(path)])
@@ -81,17 +81,27 @@ rc_bool_keys = [
     'allow_other_channels',
     'update_dependencies',
     'channel_priority',
+    'sharded_repodata',
+    'staged_updates',
+    'swap_environments',
+    'prefix_state_db',
+    'dedup_package_files',
 ]
 
 rc_string_keys = [
     'ssl_verify',
     'channel_alias',
     'root_dir',
+    'shared_cache_dir',
 ]
 
 # Not supported by conda config yet
 rc_other = [
     'proxy_servers',
+    'channel_mirrors',
+    'shared_cache_size',
+    'package_cache_size',
+    'package_cache_count',
 ]
 
 user_rc_path = abspath(expanduser('~/.condarc'))
@@ -349,6 +359,17 @@ def get_proxy_servers():
         return res
     sys.exit("Error: proxy_servers setting not a mapping")
 
+# ----- mirrors -----
+
+def get_channel_mirrors():
+    res = rc.get('channel_mirrors') or {}
+    if not isinstance(res, dict):
+        sys.exit("Error: channel_mirrors setting not a mapping")
+    for channel, mirrors in res.items():
+        if not isinstance(mirrors, list):
+            sys.exit("Error: channel_mirrors for %s is not a list" % channel)
+    return res
+
 # ----- foreign -----
 
 try:
@@ -376,6 +397,28 @@ disallow = set(rc.get('disallow', []))
 create_default_packages = list(rc.get('create_default_packages', []))
 update_dependencies = bool(rc.get('update_dependencies', True))
 channel_priority = bool(rc.get('channel_priority', True))
+# only fetch the repodata shards of the packages needed (when available)
+sharded_repodata = bool(rc.get('sharded_repodata', False))
+# replace the files of updated packages in place, one rename per file
+staged_updates = bool(rc.get('staged_updates', False))
+# build updated environments next to the existing ones, and swap them in
+swap_environments = bool(rc.get('swap_environments', False))
+# also keep the records of conda-meta in a single database per environment
+prefix_state_db = bool(rc.get('prefix_state_db', False))
+# store identical files of extracted packages only once (hard-linked)
+dedup_package_files = bool(rc.get('dedup_package_files', False))
+
+# cache for repodata and packages shared by all users of the machine
+shared_cache_dir = rc.get('shared_cache_dir')
+if shared_cache_dir:
+    shared_cache_dir = abspath(expanduser(shared_cache_dir))
+# maximal size of the shared cache in bytes, None means unbounded
+shared_cache_size = rc.get('shared_cache_size')
+# maximal size in bytes, and number of packages, of each package cache,
+# beyond which the least recently used packages are removed at the end of
+# each transaction, None means unbounded
+package_cache_size = rc.get('package_cache_size')
+package_cache_count = rc.get('package_cache_count')
 
 # ssl_verify can be a boolean value or a filename string
 ssl_verify = rc.get('ssl_verify', True)
@@ -14,6 +14,8 @@ import email
 import base64
 import ftplib
 import cgi
+import hashlib
+import json
 from io import BytesIO
 import tempfile
 import platform
@@ -98,6 +100,14 @@ class CondaSession(requests.Session):
             self.mount("http://", http_adapter)
             self.mount("https://", http_adapter)
 
+        # Share downloaded repodata and packages between users and processes
+        if config.shared_cache_dir:
+            caching_adapter = CachingAdapter(self.get_adapter("http://"),
+                                             config.shared_cache_dir,
+                                             config.shared_cache_size)
+            self.mount("http://", caching_adapter)
+            self.mount("https://", caching_adapter)
+
         # Enable file:// urls
         self.mount("file://", LocalFSAdapter())
 
@@ -190,6 +200,340 @@ class S3Adapter(requests.adapters.BaseAdapter):
             os.remove(self._temp_file)
 
 
+class CachingAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter which stores the bodies of successful GET responses in
+    a shared, content-addressed cache directory:
+
+        <cache_dir>/objects/<sha256[:2]>/<sha256>   response bodies
+        <cache_dir>/urls/<sha256(url)>.json         url -> body, validators
+
+    Package tarballs never change once published, so they are served from
+    the cache without contacting the server.  Everything else (repodata) is
+    revalidated with the stored Etag/Last-Modified, and served from the
+    cache when the server answers 304.  Bodies are stored while they are
+    read by the client, and only added to the cache once they were read
+    completely, with the size announced by the server.  All files are
+    written to a temporary name and renamed into place, such that several
+    processes (and users) can read and fill the cache concurrently.  When
+    the objects exceed `max_size` bytes, the least recently used ones are
+    evicted.
+    """
+    def __init__(self, adapter, cache_dir, max_size=None):
+        super(CachingAdapter, self).__init__()
+        self.adapter = adapter
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_served': 0,
+                      'bytes_stored': 0}
+        # the total size of the objects (as far as known to this adapter),
+        # computed when first needed
+        self._total = None
+
+    def _entry_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'urls', key + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def _write_atomic(self, path, data):
+        _makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fo:
+                fo.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            os.unlink(tmp_path)
+            raise
+
+    def _load_entry(self, url):
+        try:
+            with open(self._entry_path(url)) as fi:
+                entry = json.load(fi)
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url or not os.path.isfile(
+                self._object_path(entry['digest'])):
+            return None
+        return entry
+
+    def _response(self, request, entry):
+        """
+        Return a response serving the cached body of `entry`, or None if the
+        object has disappeared (e.g. evicted by another process).
+        """
+        try:
+            f = open(self._object_path(entry['digest']), 'rb')
+        except IOError:
+            return None
+        try:
+            # the access time is tracked through the entry, for the eviction
+            os.utime(self._entry_path(request.url), None)
+        except OSError:
+            pass
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.url = request.url
+        resp.request = request
+        headers = {"Content-Length": str(entry['size']),
+                   "Content-Type": entry.get('content_type') or 'text/plain'}
+        if entry.get('etag'):
+            headers['Etag'] = entry['etag']
+        if entry.get('mod'):
+            headers['Last-Modified'] = entry['mod']
+        resp.headers = requests.structures.CaseInsensitiveDict(headers)
+        resp.raw = f
+        resp.close = f.close
+        self.stats['bytes_served'] += entry['size']
+        return resp
+
+    def _add(self, request, resp, tmp_path, digest, size):
+        # add the completely read body (in tmp_path) of resp to the cache
+        os.chmod(tmp_path, 0o644)
+        _makedirs(os.path.dirname(self._object_path(digest)))
+        os.rename(tmp_path, self._object_path(digest))
+        entry = {
+            'url': request.url,
+            'digest': digest,
+            'size': size,
+            'etag': resp.headers.get('Etag'),
+            'mod': resp.headers.get('Last-Modified'),
+            'content_type': resp.headers.get('Content-Type'),
+        }
+        self._write_atomic(self._entry_path(request.url),
+                           json.dumps(entry).encode('utf-8'))
+        self.stats['bytes_stored'] += size
+        self.evict(size)
+        return entry
+
+    def forget(self, url):
+        """
+        Remove `url` from the cache, e.g. when its body turned out to be
+        corrupt.
+        """
+        entry = self._load_entry(url)
+        paths = [self._entry_path(url)]
+        if entry:
+            paths.append(self._object_path(entry['digest']))
+            if self._total is not None:
+                self._total -= entry['size']
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        log.debug("shared cache forgot: %s" % url)
+
+    def _objects_size(self):
+        size = 0
+        for root, dirs, files in os.walk(os.path.join(self.cache_dir,
+                                                      'objects')):
+            for fn in files:
+                try:
+                    size += os.lstat(os.path.join(root, fn)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def evict(self, added=0):
+        """
+        Remove the least recently used entries until the objects fit into
+        `max_size` bytes.  Objects still referenced by other entries are kept.
+        `added` is the size of the object which was just stored.
+        """
+        if not self.max_size:
+            return
+        if self._total is None:
+            self._total = self._objects_size()
+        else:
+            self._total += added
+        if self._total <= self.max_size:
+            return
+        urls_dir = os.path.join(self.cache_dir, 'urls')
+        entries = []
+        for fn in os.listdir(urls_dir):
+            path = os.path.join(urls_dir, fn)
+            try:
+                with open(path) as fi:
+                    entry = json.load(fi)
+                entries.append((os.stat(path).st_mtime, path, entry))
+            except (IOError, OSError, ValueError):
+                continue
+        sizes = {e['digest']: e['size'] for _, _, e in entries}
+        total = sum(sizes.values())
+        refs = {}
+        for _, _, e in entries:
+            refs[e['digest']] = refs.get(e['digest'], 0) + 1
+        for _, path, entry in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+            digest = entry['digest']
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            refs[digest] -= 1
+            if not refs[digest]:
+                try:
+                    os.unlink(self._object_path(digest))
+                except OSError:
+                    pass
+                total -= sizes[digest]
+            log.debug("shared cache evicted: %s" % entry['url'])
+        self._total = total
+
+    def send(self, request, stream=None, timeout=None, verify=None, cert=None,
+             proxies=None):
+        kwargs = dict(stream=True, timeout=timeout, verify=verify, cert=cert,
+                      proxies=proxies)
+        parsed = urlparse.urlparse(request.url)
+        if (request.method != 'GET' or
+                config.BINSTAR_TOKEN_PAT.search(request.url) or
+                'Authorization' in request.headers or
+                parsed.username or parsed.password):
+            # never share private (token or password protected) packages
+            return self.adapter.send(request, **kwargs)
+
+        entry = self._load_entry(request.url)
+        client_validates = ('If-None-Match' in request.headers or
+                            'If-Modified-Since' in request.headers)
+        if entry and request.url.endswith('.tar.bz2'):
+            resp = self._response(request, entry)
+            if resp is not None:
+                self.stats['hits'] += 1
+                log.debug("shared cache hit: %s" % request.url)
+                return resp
+        elif entry and not client_validates:
+            if entry.get('etag'):
+                request.headers['If-None-Match'] = entry['etag']
+            if entry.get('mod'):
+                request.headers['If-Modified-Since'] = entry['mod']
+
+        resp = self.adapter.send(request, **kwargs)
+        if resp.status_code == 304 and entry and not client_validates:
+            cached = self._response(request, entry)
+            if cached is not None:
+                resp.close()
+                self.stats['hits'] += 1
+                log.debug("shared cache hit (revalidated): %s" % request.url)
+                return cached
+
+        self.stats['misses'] += 1
+        log.debug("shared cache miss: %s" % request.url)
+        if resp.status_code != 200 or resp.headers.get('Content-Encoding'):
+            return resp
+        resp.raw = _StoringReader(self, request, resp)
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+
+class _StoringReader(object):
+    """
+    Wrapper of the raw body of `resp`, which stores everything read from it
+    into the cache of `adapter`.  The body is only added to the cache once
+    it was read completely, and when its size matches its Content-Length.
+    Errors while storing it only stop it from being stored.
+    """
+    def __init__(self, adapter, request, resp):
+        self.adapter = adapter
+        self.request = request
+        self.resp = resp
+        self.raw = resp.raw
+        self.h = hashlib.sha256()
+        self.size = 0
+        self.fo = None
+        objects_dir = os.path.join(adapter.cache_dir, 'objects')
+        try:
+            _makedirs(objects_dir)
+            # the name of the object is only known once all data is read
+            fd, self.tmp_path = tempfile.mkstemp(dir=objects_dir,
+                                                 prefix='.tmp-')
+            self.fo = os.fdopen(fd, 'wb')
+        except (IOError, OSError) as e:
+            log.debug("could not store %s in the shared cache (%s)" %
+                      (request.url, e))
+
+    def _discard(self):
+        if self.fo is not None:
+            self.fo.close()
+            self.fo = None
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+    def _finish(self):
+        self.fo.close()
+        self.fo = None
+        length = self.resp.headers.get('Content-Length')
+        if length is not None and length.isdigit() and int(length) != self.size:
+            log.debug("not storing %s in the shared cache: got %d of %s bytes"
+                      % (self.request.url, self.size, length))
+            os.unlink(self.tmp_path)
+            return
+        try:
+            self.adapter._add(self.request, self.resp, self.tmp_path,
+                              self.h.hexdigest(), self.size)
+        except (IOError, OSError) as e:
+            log.debug("could not store %s in the shared cache (%s)" %
+                      (self.request.url, e))
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self.raw.read(amt, *args, **kwargs)
+        if self.fo is not None:
+            if data:
+                try:
+                    self.fo.write(data)
+                except (IOError, OSError) as e:
+                    log.debug("could not store %s in the shared cache (%s)" %
+                              (self.request.url, e))
+                    self._discard()
+                else:
+                    self.h.update(data)
+                    self.size += len(data)
+            if self.fo is not None and (not data or amt is None):
+                self._finish()
+        return data
+
+    def stream(self, amt=2**16, decode_content=None):
+        # used by requests (Response.iter_content)
+        while True:
+            data = self.read(amt, decode_content=decode_content)
+            if not data:
+                break
+            yield data
+
+    def tell(self):
+        return self.raw.tell()
+
+    def release_conn(self):
+        release_conn = getattr(self.raw, 'release_conn', None)
+        if release_conn:
+            release_conn()
+
+    def close(self):
+        # bodies which were not read completely are not stored
+        self._discard()
+        self.raw.close()
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        # already exists, or created concurrently
+        pass
+
+
 def url_to_S3_info(url):
     """
     Convert a S3 url to a tuple of bucket and key
@@ -13,6 +13,7 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import warnings
 from functools import wraps
 from logging import getLogger
@@ -21,11 +22,12 @@ from os.path import basename, dirname, isdir, join
 import requests
 
 from conda import config
+from conda import mirrors
 from conda.compat import itervalues, input, urllib_quote, iterkeys, iteritems
-from conda.connection import CondaSession, unparse_url, RETRIES
-from conda.install import add_cached_package, find_new_location
-from conda.lock import Locked
-from conda.utils import memoized
+from conda.connection import CachingAdapter, CondaSession, unparse_url, RETRIES
+from conda.install import add_cached_package, find_new_location, touch_package
+from conda.lock import package_lock
+from conda.utils import memoized, record_md5
 
 
 log = getLogger(__name__)
@@ -55,6 +57,56 @@ def add_http_value_to_dict(resp, http_key, d, dict_key):
     if value:
         d[dict_key] = value
 
+def get_from_mirrors(session, url, **kwargs):
+    """
+    GET `url`, trying the members of its mirror set (if any) from the
+    fastest to the slowest, and failing over to the next one on connection
+    errors, server errors and client errors (such as a file missing from a
+    stale mirror).  The last error is raised (or for client errors, the
+    last response returned) when all mirrors fail.
+    """
+    candidates = mirrors.mirror_urls(url, session)
+    stale = []
+    for n, murl in enumerate(candidates, 1):
+        start = time.time()
+        try:
+            resp = session.get(murl, **kwargs)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError) as e:
+            mirrors.record_failure(murl)
+            if n == len(candidates) or "407" in str(e):
+                raise
+            log.debug("%s failed (%s), trying next mirror" %
+                      (config.remove_binstar_tokens(murl), e))
+            continue
+        mirrors.record_latency(murl, time.time() - start)
+        if (400 <= resp.status_code < 500 and resp.status_code != 407 and
+                n < len(candidates)):
+            log.debug("%s failed (%d), trying next mirror" %
+                      (config.remove_binstar_tokens(murl), resp.status_code))
+            stale.append(murl)
+            resp.close()
+            continue
+        if resp.status_code < 400:
+            # the mirrors which did not have the file are out of date
+            for surl in stale:
+                mirrors.record_failure(surl)
+        return resp
+
+def forget_cached(session, *urls):
+    """
+    Remove `urls` from the shared cache of `session` (see CachingAdapter).
+    """
+    for url in urls:
+        try:
+            adapter = session.get_adapter(url)
+        except requests.exceptions.InvalidSchema:
+            continue
+        if isinstance(adapter, CachingAdapter):
+            adapter.forget(url)
+
 # We need a decorator so that the dot gets printed *after* the repodata is fetched
 class dotlog_on_return(object):
     def __init__(self, msg):
@@ -97,8 +149,8 @@ def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
         headers["If-Modified-Since"] = cache["_mod"]
 
     try:
-        resp = session.get(url + 'repodata.json.bz2',
-                           headers=headers, proxies=session.proxies)
+        resp = get_from_mirrors(session, url + 'repodata.json.bz2',
+                                headers=headers, proxies=session.proxies)
         resp.raise_for_status()
         if resp.status_code != 304:
             cache = json.loads(bz2.decompress(resp.content).decode('utf-8'))
@@ -233,7 +285,34 @@ def add_pip_dependency(index):
                 info['version'].startswith(('2.', '3.'))):
             info.setdefault('depends', []).append('pip')
 
-def fetch_index(channel_urls, use_cache=False, unknown=False):
+def fetch_repodatas(channel_urls, use_cache=False):
+    """
+    Return a list of (url, repodata) for the channels `channel_urls`.
+    """
+    try:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(10)
+    except (ImportError, RuntimeError):
+        # concurrent.futures is only available in Python >= 3.2 or if futures is installed
+        # RuntimeError is thrown if number of threads are limited by OS
+        session = CondaSession()
+        return [(url, fetch_repodata(url, use_cache=use_cache, session=session))
+                for url in iterkeys(channel_urls)]
+    try:
+        urls = tuple(channel_urls)
+        futures = tuple(executor.submit(fetch_repodata, url, use_cache=use_cache,
+                                        session=CondaSession()) for url in urls)
+        return [(u, f.result()) for u, f in zip(urls, futures)]
+    finally:
+        executor.shutdown(wait=True)
+
+def fetch_index(channel_urls, use_cache=False, unknown=False, names=None):
+    """
+    Return the index of the packages in `channel_urls`.  When `names` is
+    given and sharded_repodata is enabled, the index of channels which
+    provide sharded repodata may be limited to the packages reachable from
+    these names.
+    """
     log.debug('channel_urls=' + repr(channel_urls))
     # pool = ThreadPool(5)
     index = {}
@@ -249,23 +328,11 @@ Allowed channels are:
   - %s
 """ % (url, '\n  - '.join(config.allowed_channels)))
 
-    try:
-        import concurrent.futures
-        executor = concurrent.futures.ThreadPoolExecutor(10)
-    except (ImportError, RuntimeError):
-        # concurrent.futures is only available in Python >= 3.2 or if futures is installed
-        # RuntimeError is thrown if number of threads are limited by OS
-        session = CondaSession()
-        repodatas = [(url, fetch_repodata(url, use_cache=use_cache, session=session))
-                     for url in iterkeys(channel_urls)]
+    if names is not None and config.sharded_repodata:
+        from conda.shards import fetch_sharded_repodatas
+        repodatas = fetch_sharded_repodatas(channel_urls, names, use_cache=use_cache)
     else:
-        try:
-            urls = tuple(channel_urls)
-            futures = tuple(executor.submit(fetch_repodata, url, use_cache=use_cache,
-                                            session=CondaSession()) for url in urls)
-            repodatas = [(u, f.result()) for u, f in zip(urls, futures)]
-        finally:
-            executor.shutdown(wait=True)
+        repodatas = fetch_repodatas(channel_urls, use_cache=use_cache)
 
     for channel, repodata in repodatas:
         if repodata is None:
@@ -302,28 +369,37 @@ def fetch_pkg(info, dst_dir=None, session=None):
     if dst_dir is None:
         dst_dir = dirname(find_new_location(fn[:-8])[0])
     path = join(dst_dir, fn)
+    touch_package(dst_dir, fn[:-8])
 
-    download(url, path, session=session, md5=info['md5'], urlstxt=True)
     if info.get('sig'):
-        from conda.signature import verify, SignatureError
+        from conda.signature import SHA256, verify, SignatureError
 
+        # compute the SHA256 needed for the signature while downloading
+        hashes = download(url, path, session=session, md5=info['md5'],
+                          urlstxt=True, digests={'sha256': SHA256.new})
         fn2 = fn + '.sig'
         url = (info['channel'] if info['sig'] == '.' else
                info['sig'].rstrip('/') + '/') + fn2
         log.debug("signature url=%r" % url)
         download(url, join(dst_dir, fn2), session=session)
         try:
-            if verify(path):
+            if verify(path, hashes['sha256']):
                 return
         except SignatureError as e:
             sys.exit(str(e))
         sys.exit("Error: Signature for '%s' is invalid." % (basename(path)))
+    else:
+        download(url, path, session=session, md5=info['md5'], urlstxt=True)
 
 
 def download(url, dst_path, session=None, md5=None, urlstxt=False,
-             retries=None):
-    pp = dst_path + '.part'
-    dst_dir = dirname(dst_path)
+             retries=None, digests=None):
+    """
+    Download `url` to `dst_path`, verifying the MD5 if given.  `digests`
+    may map names to hash constructors; the hash objects, which are fed
+    while streaming the download, are returned in a dictionary under the
+    same names.
+    """
     session = session or CondaSession()
 
     if not config.ssl_verify:
@@ -336,95 +412,119 @@ def download(url, dst_path, session=None, md5=None, urlstxt=False,
 
     if retries is None:
         retries = RETRIES
-    with Locked(dst_dir):
-        try:
-            resp = session.get(url, stream=True, proxies=session.proxies)
-            resp.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 407:  # Proxy Authentication Required
-                handle_proxy_407(url, session)
-                # Try again
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries)
-            msg = "HTTPError: %s: %s\n" % (e, url)
-            log.debug(msg)
-            raise RuntimeError(msg)
+    # packages are locked under their name (see package_lock)
+    lock_name = basename(dst_path)
+    if lock_name.endswith('.tar.bz2'):
+        lock_name = lock_name[:-8]
+    with package_lock(dirname(dst_path), lock_name, exclusive=True):
+        return _download(url, dst_path, session, md5, urlstxt, retries,
+                         digests)
 
-        except requests.exceptions.ConnectionError as e:
-            # requests isn't so nice here. For whatever reason, https gives
-            # this error and http gives the above error. Also, there is no
-            # status_code attribute here.  We have to just check if it looks
-            # like 407.
-            # See: https://github.com/kennethreitz/requests/issues/2061.
-            if "407" in str(e):  # Proxy Authentication Required
-                handle_proxy_407(url, session)
-                # try again
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries)
-            msg = "Connection error: %s: %s\n" % (e, url)
-            stderrlog.info('Could not connect to %s\n' % url)
-            log.debug(msg)
-            raise RuntimeError(msg)
 
-        except IOError as e:
-            raise RuntimeError("Could not open '%s': %s" % (url, e))
+def _download(url, dst_path, session, md5, urlstxt, retries, digests):
+    # the download itself (while holding the lock of dst_path)
+    pp = dst_path + '.part'
+    dst_dir = dirname(dst_path)
+    try:
+        resp = get_from_mirrors(session, url, stream=True,
+                                proxies=session.proxies)
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 407:  # Proxy Authentication Required
+            handle_proxy_407(url, session)
+            # Try again
+            return _download(url, dst_path, session, md5, urlstxt,
+                             retries, digests)
+        msg = "HTTPError: %s: %s\n" % (e, url)
+        log.debug(msg)
+        raise RuntimeError(msg)
+
+    except requests.exceptions.ConnectionError as e:
+        # requests isn't so nice here. For whatever reason, https gives
+        # this error and http gives the above error. Also, there is no
+        # status_code attribute here.  We have to just check if it looks
+        # like 407.
+        # See: https://github.com/kennethreitz/requests/issues/2061.
+        if "407" in str(e):  # Proxy Authentication Required
+            handle_proxy_407(url, session)
+            # try again
+            return _download(url, dst_path, session, md5, urlstxt,
+                             retries, digests)
+        msg = "Connection error: %s: %s\n" % (e, url)
+        stderrlog.info('Could not connect to %s\n' % url)
+        log.debug(msg)
+        raise RuntimeError(msg)
 
-        size = resp.headers.get('Content-Length')
-        if size:
-            size = int(size)
-            fn = basename(dst_path)
-            getLogger('fetch.start').info((fn[:14], size))
+    except IOError as e:
+        raise RuntimeError("Could not open '%s': %s" % (url, e))
 
-        n = 0
-        if md5:
-            h = hashlib.new('md5')
-        try:
-            with open(pp, 'wb') as fo:
-                more = True
-                while more:
-                    # Use resp.raw so that requests doesn't decode gz files
-                    chunk = resp.raw.read(2**14)
-                    if not chunk:
-                        more = False
-                    try:
-                        fo.write(chunk)
-                    except IOError:
-                        raise RuntimeError("Failed to write to %r." % pp)
-                    if md5:
-                        h.update(chunk)
-                    # update n with actual bytes read
-                    n = resp.raw.tell()
-                    if size and 0 <= n <= size:
-                        getLogger('fetch.update').info(n)
-        except IOError as e:
-            if e.errno == 104 and retries:  # Connection reset by pee
-                # try again
-                log.debug("%s, trying again" % e)
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries - 1)
-            raise RuntimeError("Could not open %r for writing (%s)." % (pp, e))
-
-        if size:
-            getLogger('fetch.stop').info(None)
-
-        if md5 and h.hexdigest() != md5:
-            if retries:
-                # try again
-                log.debug("MD5 sums mismatch for download: %s (%s != %s), "
-                          "trying again" % (url, h.hexdigest(), md5))
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries - 1)
-            raise RuntimeError("MD5 sums mismatch for download: %s (%s != %s)"
-                               % (url, h.hexdigest(), md5))
+    size = resp.headers.get('Content-Length')
+    if size:
+        size = int(size)
+        fn = basename(dst_path)
+        getLogger('fetch.start').info((fn[:14], size))
 
-        try:
-            os.rename(pp, dst_path)
-        except OSError as e:
-            raise RuntimeError("Could not rename %r to %r: %r" %
-                               (pp, dst_path, e))
+    n = 0
+    start = time.time()
+    if md5:
+        h = hashlib.new('md5')
+    hashes = {name: new() for name, new in iteritems(digests or {})}
+    try:
+        with open(pp, 'wb') as fo:
+            more = True
+            while more:
+                # Use resp.raw so that requests doesn't decode gz files
+                chunk = resp.raw.read(2**14)
+                if not chunk:
+                    more = False
+                try:
+                    fo.write(chunk)
+                except IOError:
+                    raise RuntimeError("Failed to write to %r." % pp)
+                if md5:
+                    h.update(chunk)
+                for h2 in itervalues(hashes):
+                    h2.update(chunk)
+                # update n with actual bytes read
+                n = resp.raw.tell()
+                if size and 0 <= n <= size:
+                    getLogger('fetch.update').info(n)
+    except IOError as e:
+        if e.errno == 104 and retries:  # Connection reset by pee
+            # try again
+            log.debug("%s, trying again" % e)
+            return _download(url, dst_path, session, md5, urlstxt,
+                             retries - 1, digests)
+        raise RuntimeError("Could not open %r for writing (%s)." % (pp, e))
+
+    if size:
+        getLogger('fetch.stop').info(None)
+    mirrors.record_throughput(resp.url, n, time.time() - start)
+
+    if md5 and h.hexdigest() != md5:
+        mirrors.record_failure(resp.url)
+        # the retries must not be served the same (shared cached) body
+        forget_cached(session, url, resp.url)
+        if retries:
+            # try again
+            log.debug("MD5 sums mismatch for download: %s (%s != %s), "
+                      "trying again" % (url, h.hexdigest(), md5))
+            return _download(url, dst_path, session, md5, urlstxt,
+                             retries - 1, digests)
+        raise RuntimeError("MD5 sums mismatch for download: %s (%s != %s)"
+                           % (url, h.hexdigest(), md5))
 
-        if urlstxt:
-            add_cached_package(dst_dir, url, overwrite=True, urlstxt=True)
+    try:
+        os.rename(pp, dst_path)
+    except OSError as e:
+        raise RuntimeError("Could not rename %r to %r: %r" %
+                           (pp, dst_path, e))
+
+    if md5:
+        record_md5(dst_path, md5)
+    if urlstxt:
+        add_cached_package(dst_dir, url, overwrite=True, urlstxt=True)
+    return hashes
 
 
 class TmpDownload(object):
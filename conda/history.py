@@ -1,15 +1,17 @@
 from __future__ import print_function, division, absolute_import
 
+import json
 import os
 import re
 import sys
 import time
-from os.path import isdir, isfile, join
+from os.path import dirname, isdir, isfile, join
 import warnings
 import errno
 import logging
 
 from conda import install
+from conda.compat import PY3
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +32,24 @@ def is_diff(content):
     return any(s.startswith(('-', '+')) for s in content)
 
 
+def apply_content(state, content):
+    """
+    Return the state following `state` given the content of a revision,
+    i.e. either a set of distributions or a diff.
+    """
+    if not is_diff(content):
+        return set(content)
+    state = set(state)
+    for s in content:
+        if s.startswith('-'):
+            state.discard(s[1:])
+        elif s.startswith('+'):
+            state.add(s[1:])
+        else:
+            raise CondaHistoryException('Did not expect: %s' % s)
+    return state
+
+
 def pretty_diff(diff):
     added = {}
     removed = {}
@@ -56,12 +76,24 @@ def pretty_content(content):
         return iter(sorted(content))
 
 
+# Once at least CHECKPOINT_INTERVAL revisions have to be replayed to get the
+# latest state, the state is stored as a checkpoint in this file (in
+# conda-meta), along with the revision number and the byte offsets (and
+# header line) of the revision in the history file, such that get_state()
+# only needs to parse the history file from the closest checkpoint on.
+# Checkpoints whose header line is not found at their offset anymore, e.g.
+# when the history file was rewritten, are ignored.
+CHECKPOINTS_FN = join('state', 'history_checkpoints.json')
+CHECKPOINT_INTERVAL = 100
+
+
 class History(object):
 
     def __init__(self, prefix):
         self.prefix = prefix
         self.meta_dir = join(prefix, 'conda-meta')
         self.path = join(self.meta_dir, 'history')
+        self.checkpoints_path = join(self.meta_dir, CHECKPOINTS_FN)
 
     def __enter__(self):
         self.update()
@@ -158,30 +190,112 @@ class History(object):
         res = []
         cur = set([])
         for dt, cont, unused_com in self.parse():
-            if not is_diff(cont):
-                cur = cont
-            else:
-                for s in cont:
-                    if s.startswith('-'):
-                        cur.discard(s[1:])
-                    elif s.startswith('+'):
-                        cur.add(s[1:])
-                    else:
-                        raise CondaHistoryException('Did not expect: %s' % s)
+            cur = apply_content(cur, cont)
             res.append((dt, cur.copy()))
         return res
 
+    def parse_revisions(self, offset=0):
+        """
+        parse the history file from the byte offset of the start of a
+        revision on, and return a list of lists [datetime string, set of
+        distributions/diffs, header line, start offset, end offset]
+        """
+        res = []
+        sep_pat = re.compile(r'==>\s*(.+?)\s*<==')
+        with open(self.path, 'rb') as fi:
+            fi.seek(offset)
+            data = fi.read()
+        pos = offset
+        for raw in data.splitlines(True):
+            start = pos
+            pos += len(raw)
+            line = raw.decode('utf-8', 'replace') if PY3 else raw
+            line = line.strip()
+            if not line:
+                continue
+            m = sep_pat.match(line)
+            if m:
+                res.append([m.group(1), set(), line, start, pos])
+                continue
+            if not res:
+                # lines appended to the revision before offset (e.g. the
+                # specs of a command which did not change anything)
+                continue
+            res[-1][4] = pos
+            if not line.startswith('#'):
+                res[-1][1].add(line)
+        return res
+
+    def load_checkpoints(self):
+        """
+        return the list of checkpoints (see CHECKPOINTS_FN) which match the
+        history file, ordered by revision
+        """
+        try:
+            with open(self.checkpoints_path) as fi:
+                checkpoints = json.load(fi)['checkpoints']
+            res = []
+            with open(self.path, 'rb') as fi:
+                for cp in checkpoints:
+                    fi.seek(cp['start'])
+                    line = fi.readline()
+                    if PY3:
+                        line = line.decode('utf-8', 'replace')
+                    if line.strip() == cp['head']:
+                        res.append(cp)
+        except (IOError, ValueError, KeyError, TypeError):
+            return []
+        return sorted(res, key=lambda cp: cp['rev'])
+
+    def save_checkpoint(self, checkpoints, rev, revision, state):
+        """
+        add the checkpoint of the parsed `revision` (see parse_revisions),
+        whose number is `rev`, to `checkpoints`, and store them
+        """
+        unused_dt, unused_cont, head, start, end = revision
+        checkpoints = [cp for cp in checkpoints if cp['rev'] < rev]
+        checkpoints.append({'rev': rev, 'head': head, 'start': start,
+                            'end': end, 'state': sorted(state)})
+        tmp_path = self.checkpoints_path + '.tmp'
+        try:
+            if not isdir(dirname(self.checkpoints_path)):
+                os.makedirs(dirname(self.checkpoints_path))
+            with open(tmp_path, 'w') as fo:
+                json.dump({'checkpoints': checkpoints}, fo)
+            os.rename(tmp_path, self.checkpoints_path)
+        except (IOError, OSError) as e:
+            log.debug("could not write %s: %r" % (self.checkpoints_path, e))
+
     def get_state(self, rev=-1):
         """
         return the state, i.e. the set of distributions, for a given revision,
         defaults to latest (which is the same as the current state when
         the log file is up-to-date)
         """
-        states = self.construct_states()
-        if not states:
+        if not isfile(self.path):
+            return set([])
+        checkpoints = self.load_checkpoints()
+        if rev >= 0:
+            checkpoints = [cp for cp in checkpoints if cp['rev'] <= rev]
+        cp = checkpoints[-1] if checkpoints else None
+        first = cp['rev'] + 1 if cp else 0
+        state = set(cp['state']) if cp else set([])
+        revisions = self.parse_revisions(cp['end'] if cp else 0)
+        total = first + len(revisions)
+        if total == 0:
             return set([])
-        times, pkgs = zip(*states)
-        return pkgs[rev]
+        if rev < 0:
+            rev += total
+            if 0 <= rev < first - 1:
+                # before the checkpoint
+                return self.get_state(rev)
+        if not max(first - 1, 0) <= rev < total:
+            raise IndexError("no revision %d in %s" % (rev, self.path))
+        for revision in revisions[:rev - first + 1]:
+            state = apply_content(state, revision[1])
+        if rev == total - 1 and len(revisions) >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint(checkpoints, rev, revisions[-1], state)
+        return state
 
     def print_log(self):
         for i, (date, content, unused_com) in enumerate(self.parse()):
@@ -243,6 +357,8 @@ class History(object):
             return
         if not isdir(self.meta_dir):
             os.makedirs(self.meta_dir)
+        if isfile(self.checkpoints_path):
+            os.unlink(self.checkpoints_path)
         with open(self.path, 'w') as fo:
             write_head(fo)
             for dist in sorted(dists):
@@ -27,8 +27,10 @@ the standard library).
 
 from __future__ import print_function, division, absolute_import
 
+import atexit
 import errno
 import functools
+import hashlib
 import json
 import logging
 import os
@@ -41,14 +43,20 @@ import tarfile
 import time
 import traceback
 import re
-from os.path import (abspath, basename, dirname, isdir, isfile, islink,
+from os.path import (abspath, basename, dirname, isabs, isdir, isfile, islink,
                      join, relpath, normpath)
 from conda.config import url_channel
 from conda.compat import iteritems, iterkeys
 from conda import config
 
 try:
-    from conda.lock import Locked
+    import sqlite3
+except ImportError:
+    # Python may be built without sqlite
+    sqlite3 = None
+
+try:
+    from conda.lock import Locked, LockError, package_lock
 except ImportError:
     # Make sure this still works as a standalone script for the Anaconda
     # installer.
@@ -62,6 +70,9 @@ except ImportError:
         def __exit__(self, exc_type, exc_value, traceback):
             pass
 
+    LockError = RuntimeError
+    package_lock = Locked
+
 try:
     from conda.utils import win_path_to_unix
 except ImportError:
@@ -179,12 +190,40 @@ log.addHandler(NullHandler())
 LINK_HARD = 1
 LINK_SOFT = 2
 LINK_COPY = 3
+LINK_REFLINK = 4
 link_name_map = {
     LINK_HARD: 'hard-link',
     LINK_SOFT: 'soft-link',
     LINK_COPY: 'copy',
+    LINK_REFLINK: 'reflink',
 }
 
+# ioctl request to share the data of one file with another file (copy on
+# write), see ioctl_ficlone(2); supported by btrfs and XFS (on Linux only)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    Create `dst` as a copy-on-write clone of `src`, raising OSError when
+    this is not supported.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported", dst)
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported", dst)
+    with open(src, 'rb') as fi:
+        with open(dst, 'wb') as fo:
+            try:
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+            except (IOError, OSError) as e:
+                fo.close()
+                os.unlink(dst)
+                raise OSError(e.errno, e.strerror, dst)
+    shutil.copystat(src, dst)
+
 def _link(src, dst, linktype=LINK_HARD):
     if linktype == LINK_HARD:
         if on_win:
@@ -196,10 +235,16 @@ def _link(src, dst, linktype=LINK_HARD):
             win_soft_link(src, dst)
         else:
             os.symlink(src, dst)
-    elif linktype == LINK_COPY:
+    elif linktype in (LINK_COPY, LINK_REFLINK):
         # copy relative symlinks as symlinks
         if not on_win and islink(src) and not os.readlink(src).startswith('/'):
             os.symlink(os.readlink(src), dst)
+        elif linktype == LINK_REFLINK:
+            try:
+                reflink(src, dst)
+            except OSError as e:
+                log.debug("reflink failed (%s), copying %r" % (e, src))
+                shutil.copy2(src, dst)
         else:
             shutil.copy2(src, dst)
     else:
@@ -319,21 +364,26 @@ def read_has_prefix(path):
 class PaddingError(Exception):
     pass
 
+def _binary_replace_string(s, a, b):
+    """
+    Replace `a` with `b` in the null-terminated string `s`, padding the
+    result with null characters to the length of `s`.
+    """
+    occurances = s.count(a)
+    padding = (len(a) - len(b))*occurances
+    if padding < 0:
+        raise PaddingError(a, b, padding)
+    return s.replace(a, b) + b'\0' * padding
+
 def binary_replace(data, a, b):
     """
     Perform a binary replacement of `data`, where the placeholder `a` is
     replaced with `b` and the remaining string is padded with null characters.
     All input arguments are expected to be bytes objects.
     """
-
-    def replace(match):
-        occurances = match.group().count(a)
-        padding = (len(a) - len(b))*occurances
-        if padding < 0:
-            raise PaddingError(a, b, padding)
-        return match.group().replace(a, b) + b'\0' * padding
     pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
-    res = pat.sub(replace, data)
+    res = pat.sub(lambda match: _binary_replace_string(match.group(), a, b),
+                  data)
     assert len(res) == len(data)
     return res
 
@@ -358,13 +408,296 @@ def update_prefix(path, new_prefix, placeholder=prefix_placeholder,
 
     if new_data == data:
         return
+    _rewrite(path, new_data)
+
+def _rewrite(path, data):
     st = os.lstat(path)
     # Remove file before rewriting to avoid destroying hard-linked cache
     os.remove(path)
     with open(path, 'wb') as fo:
-        fo.write(new_data)
+        fo.write(data)
     os.chmod(path, stat.S_IMODE(st.st_mode))
 
+# The offsets of the placeholders in the has_prefix files of a package are
+# computed once, when the package is extracted, and stored in this file (in
+# the info directory of the extracted package), such that linking the package
+# does not need to search them again.  For each file, the placeholder, mode,
+# size and offsets are stored, where the offsets are those of the placeholders
+# in text mode, and [start, end] of the null-terminated strings containing
+# placeholders in binary mode.
+PREFIX_OFFSETS_FN = 'has_prefix_offsets.json'
+
+# files of at least this size are patched using mmap
+MMAP_MIN_SIZE = 2**20
+
+def find_prefix_offsets(data, placeholder, mode):
+    a = placeholder.encode('utf-8')
+    if mode == 'text':
+        res = []
+        i = data.find(a)
+        while i != -1:
+            res.append(i)
+            i = data.find(a, i + len(a))
+        return res
+    pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
+    return [list(match.span()) for match in pat.finditer(data)]
+
+def write_prefix_offsets(source_dir):
+    """
+    Write the offsets of the placeholders in the has_prefix files of the
+    extracted package `source_dir`.
+    """
+    info_dir = join(source_dir, 'info')
+    offsets = {}
+    for f, (placeholder, mode) in iteritems(read_has_prefix(join(info_dir,
+                                                                 'has_prefix'))):
+        path = join(source_dir, f)
+        if mode not in ('text', 'binary') or islink(path) or not isfile(path):
+            continue
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        offsets[f] = {'placeholder': placeholder, 'mode': mode,
+                      'size': len(data),
+                      'offsets': find_prefix_offsets(data, placeholder, mode)}
+    if offsets:
+        with open(join(info_dir, PREFIX_OFFSETS_FN), 'w') as fo:
+            json.dump(offsets, fo)
+
+def read_prefix_offsets(info_dir):
+    try:
+        with open(join(info_dir, PREFIX_OFFSETS_FN)) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return {}
+
+# The size, mode, mtime and SHA256 of the files of a package are computed
+# once per extracted package (when it is extracted, or for packages extracted
+# before, when they are first linked), and stored in this
+# file (in the info directory of the extracted package), mapping each file to
+# {"size": ..., "mode": ..., "mtime": ..., "sha256": ...}, or {"link": ...}
+# for symlinks.  link() records them, re-computed for the files in which the
+# placeholders were replaced, as the "manifest" of the linked package, which
+# verify_files() checks the files in the prefix against.
+FILES_MANIFEST_FN = 'files_manifest.json'
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fi:
+        while True:
+            chunk = fi.read(262144)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def _manifest_entry(path):
+    # the manifest entry of the file at path, or None if it does not exist
+    try:
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            return {'link': os.readlink(path)}
+        return {'size': st.st_size, 'mode': stat.S_IMODE(st.st_mode),
+                'mtime': st.st_mtime, 'sha256': file_sha256(path)}
+    except (IOError, OSError):
+        return None
+
+def _manifest_entries(dir_path, files):
+    entries = _map_jobs(_manifest_entry, [(join(dir_path, f),) for f in files],
+                        LINK_THREADS_MIN_FILES)
+    return {f: entry for f, entry in zip(files, entries) if entry is not None}
+
+def files_manifest(source_dir):
+    """
+    Return the manifest (see FILES_MANIFEST_FN) of the extracted package
+    `source_dir`, computing it if this was not done before.
+    """
+    path = join(source_dir, 'info', FILES_MANIFEST_FN)
+    try:
+        with open(path) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        pass
+    manifest = _manifest_entries(source_dir, list(yield_lines(
+        join(source_dir, 'info', 'files'))))
+    _save_files_manifest(source_dir, manifest)
+    return manifest
+
+def _save_files_manifest(source_dir, manifest):
+    path = join(source_dir, 'info', FILES_MANIFEST_FN)
+    # processes linking the package at the same time might all write it
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as fo:
+            json.dump(manifest, fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("could not write %s: %r" % (path, e))
+
+# With dedup_package_files, the files of each extracted package are replaced
+# by hard links to the objects in the directory below (in the package cache),
+# named after their SHA256 and mode, such that identical files are stored
+# only once across all packages.  Deduplicated packages are marked by the
+# file DEDUP_FN in their info directory.  Objects which are not linked
+# anywhere else anymore are removed by gc_objects().
+OBJECTS_DIR = '.objects'
+DEDUP_FN = 'deduplicated'
+
+def _object_path(pdir, entry):
+    return join(pdir, OBJECTS_DIR, entry['sha256'][:2],
+                '%s-%o' % (entry['sha256'], entry['mode']))
+
+def _dedup_file(path, obj):
+    # replace the file at path by a hard link to the object obj, which is
+    # created from the file when it does not exist yet, and return the mtime
+    # of the resulting file (None when the file was left alone)
+    try:
+        try:
+            os.makedirs(dirname(obj))
+        except OSError:
+            if not isdir(dirname(obj)):
+                raise
+        try:
+            os.link(path, obj)
+            return os.lstat(path).st_mtime
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = path + '.conda-dedup'
+        os.link(obj, tmp_path)
+        os.rename(tmp_path, path)
+        return os.lstat(path).st_mtime
+    except OSError as e:
+        log.debug("could not deduplicate %s (%s)" % (path, e))
+        return None
+
+def dedup_package(source_dir):
+    """
+    Replace the files of the extracted package `source_dir` by hard links to
+    the objects with the same content and mode (see OBJECTS_DIR).
+    """
+    manifest = files_manifest(source_dir)
+    fs = sorted(f for f, entry in iteritems(manifest) if 'sha256' in entry)
+    mtimes = _map_jobs(_dedup_file,
+                       [(join(source_dir, f),
+                         _object_path(dirname(source_dir), manifest[f]))
+                        for f in fs],
+                       LINK_THREADS_MIN_FILES)
+    # the files now have the mtime of the objects
+    for f, mtime in zip(fs, mtimes):
+        if mtime is not None:
+            manifest[f]['mtime'] = mtime
+    _save_files_manifest(source_dir, manifest)
+    with open(join(source_dir, 'info', DEDUP_FN), 'w'):
+        pass
+
+def is_deduplicated(source_dir):
+    return isfile(join(source_dir, 'info', DEDUP_FN))
+
+def gc_objects(pdir):
+    """
+    Remove the objects (see OBJECTS_DIR) of the package cache pdir which are
+    not linked into any package or environment anymore, and return their
+    number and total size.
+    """
+    count = size = 0
+    objects_dir = join(pdir, OBJECTS_DIR)
+    try:
+        subdirs = os.listdir(objects_dir)
+    except OSError:
+        return count, size
+    for subdir in subdirs:
+        try:
+            fns = os.listdir(join(objects_dir, subdir))
+        except OSError:
+            continue
+        for fn in fns:
+            path = join(objects_dir, subdir, fn)
+            try:
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    count += 1
+                    size += st.st_size
+            except OSError:
+                pass
+    return count, size
+
+def _link_manifest(prefix, source_dir, files, has_prefix_files):
+    # the manifest of the files of the package source_dir linked into prefix,
+    # where the files which were rewritten, and the absolute symlinks (which
+    # are copied as files), are taken from the prefix
+    manifest = files_manifest(source_dir)
+    res = {}
+    changed = []
+    for f in files:
+        entry = manifest.get(f)
+        if f in has_prefix_files or (entry and isabs(entry.get('link', ''))):
+            changed.append(f)
+        elif entry:
+            res[f] = entry
+    res.update(_manifest_entries(prefix, changed))
+    return res
+
+def patch_prefix(path, new_prefix, placeholder, mode, rec):
+    """
+    Same as update_prefix, but only the placeholders at the offsets in
+    `rec` (see write_prefix_offsets) are replaced.  Returns False (without
+    modifying the file) if `rec` does not match the file.
+    """
+    if (rec.get('placeholder') != placeholder or rec.get('mode') != mode or
+            islink(path)):
+        return False
+    if on_win and (placeholder != prefix_placeholder) and ('/' in placeholder):
+        new_prefix = new_prefix.replace('\\', '/')
+    a = placeholder.encode('utf-8')
+    b = new_prefix.encode('utf-8')
+    st = os.lstat(path)
+    if st.st_size != rec['size']:
+        return False
+    offsets = rec['offsets']
+    if not offsets or a == b:
+        return True
+
+    if mode == 'text':
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        parts = []
+        pos = 0
+        for i in offsets:
+            if data[i:i + len(a)] != a:
+                return False
+            parts.append(data[pos:i])
+            pos = i + len(a)
+        parts.append(data[pos:])
+        _rewrite(path, b.join(parts))
+        return True
+
+    if st.st_nlink > 1:
+        # patching in place would modify the other links
+        return False
+    with open(path, 'r+b') as fo:
+        if st.st_size >= MMAP_MIN_SIZE:
+            import mmap
+            buf = mmap.mmap(fo.fileno(), 0)
+        else:
+            buf = bytearray(fo.read())
+        try:
+            new = []
+            for start, end in offsets:
+                s = bytes(buf[start:end])
+                if not (s.startswith(a) and s.endswith(b'\0')):
+                    return False
+                new.append((start, _binary_replace_string(s, a, b)))
+            for start, s in new:
+                buf[start:start + len(s)] = s
+            if isinstance(buf, bytearray):
+                fo.seek(0)
+                fo.write(buf)
+        finally:
+            if not isinstance(buf, bytearray):
+                buf.close()
+    return True
+
 
 def _dist2pair(dist):
     dparts = dist.split('::', 1)
@@ -392,6 +725,8 @@ def create_meta(prefix, dist, info_dir, extra_info):
         os.makedirs(meta_dir)
     with open(join(meta_dir, _dist2filename(dist, '.json')), 'w') as fo:
         json.dump(meta, fo, indent=2, sort_keys=True)
+    put_prefix_state(prefix, _dist2filename(dist, '.json'), meta)
+    _update_file_owners(prefix, dist, meta)
 
 
 def mk_menus(prefix, files, remove=False):
@@ -536,6 +871,102 @@ def try_hard_link(pkgs_dir, prefix, dist):
         rm_rf(dst)
         rm_empty_dir(prefix)
 
+# The link capabilities only depend on the file systems of the package cache
+# and the prefix, so they are probed once for each pair of devices, and
+# remembered in <pkgs_dir>/cache/link_capabilities.json.  The file records a
+# fingerprint of the mount table, and is ignored once the mounts change.
+
+LINK_CAPABILITIES_FN = 'link_capabilities.json'
+link_capabilities_ = {}
+
+def _device(path):
+    # the device of path, or of its closest existing parent
+    while not os.path.exists(path) and dirname(path) != path:
+        path = dirname(path)
+    return os.stat(path).st_dev
+
+def _mounts_fingerprint():
+    for path in '/proc/self/mounts', '/etc/mtab':
+        try:
+            with open(path, 'rb') as fi:
+                return hashlib.md5(fi.read()).hexdigest()
+        except IOError:
+            pass
+    return None
+
+def _probe_link_capabilities(pkgs_dir, prefix):
+    name = '.conda-link-probe-%d' % os.getpid()
+    src = join(pkgs_dir, name)
+    dst = join(prefix, name)
+    res = {}
+    created = not isdir(prefix)
+    try:
+        if not isdir(pkgs_dir):
+            os.makedirs(pkgs_dir)
+        if created:
+            os.makedirs(prefix)
+        with open(src, 'w') as fo:
+            fo.write('probe')
+        for key, linktype in [('hard', LINK_HARD), ('soft', LINK_SOFT),
+                              ('reflink', LINK_REFLINK)]:
+            try:
+                if linktype == LINK_REFLINK:
+                    reflink(src, dst)
+                else:
+                    _link(src, dst, linktype)
+                # Some file systems (at least BeeGFS) create a symbolic link
+                # when a hard link between directories is not supported.
+                res[key] = linktype == LINK_SOFT or not islink(dst)
+            except (IOError, OSError):
+                res[key] = False
+            rm_rf(dst)
+    finally:
+        rm_rf(src)
+        if created:
+            rm_empty_dir(prefix)
+    return res
+
+def link_capabilities(pkgs_dir, prefix):
+    """
+    Return a dictionary telling whether files in `pkgs_dir` can be 'hard'
+    linked, 'soft' linked and 'reflink'ed into `prefix`.
+    """
+    devices = _device(pkgs_dir), _device(prefix)
+    if not any(devices):
+        # st_dev is not available (Python 2 on Windows)
+        return _probe_link_capabilities(pkgs_dir, prefix)
+    if devices in link_capabilities_:
+        return link_capabilities_[devices]
+
+    key = '%d:%d' % devices
+    path = join(pkgs_dir, 'cache', LINK_CAPABILITIES_FN)
+    mounts = _mounts_fingerprint()
+    data = {}
+    if mounts:
+        try:
+            with open(path) as fi:
+                data = json.load(fi)
+        except (IOError, ValueError):
+            pass
+        if data.get('mounts') != mounts:
+            data = {'mounts': mounts, 'devices': {}}
+    res = data.get('devices', {}).get(key)
+    if res is None:
+        res = _probe_link_capabilities(pkgs_dir, prefix)
+        log.debug("link capabilities of %s -> %s: %r" % (pkgs_dir, prefix, res))
+        if mounts:
+            data['devices'][key] = res
+            try:
+                if not isdir(dirname(path)):
+                    os.makedirs(dirname(path))
+                with open(path + '.tmp', 'w') as fo:
+                    json.dump(data, fo)
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError):
+                pass
+    link_capabilities_[devices] = res
+    return res
+
 # ------- package cache ----- construction
 
 # The current package cache does not support the ability to store multiple packages
@@ -547,6 +978,352 @@ def try_hard_link(pkgs_dir, prefix, dist):
 
 package_cache_ = {}
 fname_table = {}
+
+# To avoid stat()ing every entry of every package cache on startup, what is
+# known about the entries of each package cache directory is kept in the
+# file below (in its cache subdirectory), together with the mtime of the
+# directory.  When the mtime differs, the directory is listed again, and
+# only the new entries are looked at.  As a package directory can be
+# completed (e.g. by an extraction in another process) without changing the
+# mtime, the entries which are not extracted packages are looked at again
+# every time.
+PACKAGE_CACHE_INDEX_FN = 'package_cache.json'
+pkgs_dir_entries_ = {}
+
+def _pkgs_dir_entry(pdir, fn):
+    """
+    Return 'tarball' if fn is a package in pdir, 'extracted' if fn is an
+    extracted package in pdir, and None otherwise.
+    """
+    path = join(pdir, fn)
+    if fn.endswith('.tar.bz2'):
+        return 'tarball' if isfile(path) else None
+    if (isdir(path) and
+            isfile(join(path, 'info', 'files')) and
+            isfile(join(path, 'info', 'index.json'))):
+        return 'extracted'
+    return None
+
+def _save_pkgs_dir_entries(pdir, mtime, entries):
+    path = join(pdir, 'cache', PACKAGE_CACHE_INDEX_FN)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(tmp_path, 'w') as fo:
+            json.dump({'mtime': mtime, 'entries': entries}, fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write %s (%s)" % (path, e))
+
+def pkgs_dir_entries(pdir):
+    """
+    Return a dictionary mapping the entries of the package cache directory
+    pdir to what they are (see _pkgs_dir_entry).
+    """
+    entries = pkgs_dir_entries_.get(pdir)
+    if entries is not None:
+        return entries
+    try:
+        with open(join(pdir, 'cache', PACKAGE_CACHE_INDEX_FN)) as fi:
+            index = json.load(fi)
+    except (IOError, ValueError):
+        index = {}
+    try:
+        if not isdir(join(pdir, 'cache')):
+            # created first, as this changes the mtime of pdir
+            os.mkdir(join(pdir, 'cache'))
+    except OSError:
+        pass
+    try:
+        mtime = os.stat(pdir).st_mtime
+        old = index.get('entries', {})
+        fns = list(old) if index.get('mtime') == mtime else os.listdir(pdir)
+        entries = {fn: 'extracted' if old.get(fn) == 'extracted' else
+                   _pkgs_dir_entry(pdir, fn) for fn in fns}
+        if index.get('mtime') != mtime or entries != old:
+            _save_pkgs_dir_entries(pdir, mtime, entries)
+    except OSError:
+        entries = {}
+    pkgs_dir_entries_[pdir] = entries
+    return entries
+
+def update_pkgs_dir_entries(pdir, fns):
+    """
+    Look again at the entries `fns` of the package cache directory pdir,
+    after they have been created or removed.
+    """
+    if not isdir(pdir):
+        return
+    entries = pkgs_dir_entries(pdir)
+    for fn in fns:
+        entries[fn] = _pkgs_dir_entry(pdir, fn)
+        if entries[fn] is None and not os.path.lexists(join(pdir, fn)):
+            del entries[fn]
+    # the directory is listed again next time, as other entries might have
+    # changed in the meantime
+    _save_pkgs_dir_entries(pdir, None, entries)
+
+# The prefixes each extracted package is linked into are recorded in the
+# file below (in the cache subdirectory of the package cache), mapping the
+# names of the extracted packages to lists of prefixes.  Packages are only
+# recorded from the moment they are extracted on, such that packages which
+# were linked without being recorded are never considered unused.  As
+# prefixes can be removed without unlinking their packages, a prefix only
+# counts (see linked_prefixes) as long as the package is in its conda-meta.
+PACKAGE_REFS_FN = 'package_refs.json'
+
+def package_refs(pdir):
+    """
+    Return a dictionary mapping the recorded extracted packages of the
+    package cache pdir to the list of prefixes they are linked into.
+    """
+    try:
+        with open(join(pdir, 'cache', PACKAGE_REFS_FN)) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return {}
+
+def set_package_refs(pdir, fn, prefixes):
+    """
+    Record that the extracted package fn of the package cache pdir is
+    linked into `prefixes`, or stop recording it when `prefixes` is None.
+    """
+    with package_lock(pdir, PACKAGE_REFS_FN, exclusive=True):
+        refs = package_refs(pdir)
+        if prefixes is None:
+            if refs.pop(fn, None) is None:
+                return
+        else:
+            refs[fn] = sorted(set(prefixes))
+        _save_package_refs(pdir, refs)
+
+def _save_package_refs(pdir, refs):
+    path = join(pdir, 'cache', PACKAGE_REFS_FN)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(tmp_path, 'w') as fo:
+            json.dump(refs, fo, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write %s (%s)" % (path, e))
+
+def _update_package_refs(source_dir, add=None, remove=None):
+    # add the prefix `add` to, or remove `remove` from, the prefixes the
+    # extracted package source_dir is linked into, if it is recorded
+    pdir, fn = dirname(source_dir), basename(source_dir)
+    with package_lock(pdir, PACKAGE_REFS_FN, exclusive=True):
+        refs = package_refs(pdir)
+        prefixes = refs.get(fn)
+        if prefixes is None:
+            return
+        new_prefixes = set(prefixes) - {remove} | ({add} if add else set())
+        if new_prefixes != set(prefixes):
+            refs[fn] = sorted(new_prefixes)
+            _save_package_refs(pdir, refs)
+
+def linked_prefixes(pdir, fn, refs=None):
+    """
+    Return the list of prefixes the extracted package fn of the package
+    cache pdir is linked into, or None when this is not recorded.  `refs`
+    are the package_refs(pdir), when they were read already.
+    """
+    prefixes = (package_refs(pdir) if refs is None else refs).get(fn)
+    if prefixes is None:
+        return None
+    return [prefix for prefix in prefixes
+            if isfile(join(prefix, 'conda-meta', fn + '.json'))]
+
+# When a package is fetched, extracted or linked, the time is recorded in
+# memory (see touch_package), and at the end of execute_instructions saved
+# (see save_package_access) into the file below, in the cache subdirectory
+# of the package cache, mapping the names of the packages (without .tar.bz2)
+# to {"atime": <time of last use>, "size": <size of the extracted package>},
+# where the size is only known once evict_packages() computed it.
+PACKAGE_ACCESS_FN = 'package_access.json'
+package_access_ = {}
+# evict_packages() stops after this many seconds, and continues next time
+EVICT_TIME_LIMIT = 5
+
+def touch_package(pdir, fn):
+    """
+    Record that the package fn of the package cache pdir was just used.
+    """
+    package_access_.setdefault(pdir, {})[fn] = time.time()
+
+def package_access(pdir):
+    """
+    Return the dictionary of the recorded uses (see PACKAGE_ACCESS_FN) of
+    the packages of the package cache pdir, including unsaved ones.
+    """
+    try:
+        with open(join(pdir, 'cache', PACKAGE_ACCESS_FN)) as fi:
+            res = json.load(fi)
+    except (IOError, ValueError):
+        res = {}
+    for fn, atime in iteritems(package_access_.get(pdir, {})):
+        rec = res.setdefault(fn, {})
+        rec['atime'] = max(rec.get('atime', 0), atime)
+    return res
+
+def _save_package_access(pdir, access):
+    path = join(pdir, 'cache', PACKAGE_ACCESS_FN)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(tmp_path, 'w') as fo:
+            json.dump(access, fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write %s (%s)" % (path, e))
+
+def save_package_access():
+    """
+    Save the uses of packages recorded by touch_package().
+    """
+    for pdir in list(package_access_):
+        if isdir(pdir):
+            with package_lock(pdir, PACKAGE_ACCESS_FN, exclusive=True):
+                _save_package_access(pdir, package_access(pdir))
+        del package_access_[pdir]
+
+def _dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.lstat(join(root, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+def _hard_linked(path):
+    # whether a file of the extracted package path might be hard-linked
+    # (Python 2 on Windows reports no links at all)
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                if os.lstat(join(root, fn)).st_nlink != 1:
+                    return True
+            except OSError:
+                pass
+    return False
+
+def _in_use_by_links(path, fn, refs):
+    # whether the extracted package path is not recorded (see
+    # PACKAGE_REFS_FN) and hard-linked, where the files of deduplicated
+    # packages are always hard-linked (to their objects)
+    if fn in refs and is_deduplicated(path):
+        return False
+    return _hard_linked(path)
+
+def _forget_cached(path):
+    # remove the tarball or extracted package at path from package_cache_
+    fname_table.pop(path, None)
+    for dist, rec in list(iteritems(package_cache_)):
+        if path in rec['files'] or path in rec['dirs']:
+            rec['files'] = [fname for fname in rec['files'] if fname != path]
+            rec['dirs'] = [fname for fname in rec['dirs'] if fname != path]
+            if not (rec['files'] or rec['dirs']):
+                del package_cache_[dist]
+
+def evict_packages(pdir, max_size=None, max_count=None,
+                   time_limit=EVICT_TIME_LIMIT):
+    """
+    Remove the least recently used packages of the package cache pdir,
+    until they take at most `max_size` bytes and are at most `max_count`:
+    first tarballs, and then extracted packages which are not linked into
+    any environment.  Stops after `time_limit` seconds.  Returns the list
+    of removed tarballs and directories.
+    """
+    t0 = time.time()
+    entries = pkgs_dir_entries(pdir)
+    access = package_access(pdir)
+    refs = package_refs(pdir)
+    tarballs = {}
+    dirs = {}
+    for fn, kind in iteritems(entries):
+        if kind not in ('tarball', 'extracted'):
+            continue
+        path = join(pdir, fn)
+        name = fn[:-8] if kind == 'tarball' else fn
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        # packages used before their uses were recorded
+        rec = access.setdefault(name, {})
+        rec.setdefault('atime', st.st_mtime)
+        if kind == 'tarball':
+            tarballs[name] = st.st_size
+            continue
+        if 'size' not in rec:
+            if time.time() - t0 > time_limit:
+                # continued next time
+                log.debug("evict_packages: sizing %s timed out" % pdir)
+                _save_package_access(pdir, access)
+                return []
+            rec['size'] = _dir_size(path)
+        dirs[name] = rec['size']
+
+    def atime(name):
+        return access[name]['atime']
+
+    size = sum(tarballs.values()) + sum(dirs.values())
+    count = len(set(tarballs) | set(dirs))
+    removed = []
+    for kind, sizes in ('tarball', tarballs), ('extracted', dirs):
+        for name in sorted(sizes, key=atime):
+            if ((max_size is None or size <= max_size) and
+                    (max_count is None or count <= max_count)):
+                break
+            if time.time() - t0 > time_limit:
+                log.debug("evict_packages: %s timed out" % pdir)
+                break
+            path = join(pdir, name + '.tar.bz2' if kind == 'tarball' else name)
+            if kind == 'extracted' and (linked_prefixes(pdir, name, refs) or
+                                        _in_use_by_links(path, name, refs)):
+                continue
+            try:
+                # packages which are being used are skipped
+                with package_lock(pdir, name, exclusive=True, blocking=False):
+                    if kind == 'extracted' and linked_prefixes(pdir, name):
+                        continue
+                    log.debug("evicting %s" % path)
+                    rm_rf(path)
+            except LockError:
+                continue
+            update_pkgs_dir_entries(pdir, [basename(path)])
+            _forget_cached(path)
+            removed.append(path)
+            size -= sizes.pop(name)
+            if kind == 'extracted' or name not in dirs:
+                count -= 1
+            if kind == 'extracted':
+                set_package_refs(pdir, name, None)
+    # forget about the packages which are gone
+    with package_lock(pdir, PACKAGE_ACCESS_FN, exclusive=True):
+        _save_package_access(pdir, {name: rec for name, rec in
+                                    iteritems(access)
+                                    if name in tarballs or name in dirs})
+    return removed
+
+def evict_package_caches():
+    """
+    Evict packages (see evict_packages) from the writable package caches,
+    when a budget is configured (package_cache_size, package_cache_count).
+    """
+    if not (config.package_cache_size or config.package_cache_count):
+        return
+    for pdir in config.pkgs_dirs:
+        if isdir(pdir) and os.access(pdir, os.W_OK):
+            if evict_packages(pdir, config.package_cache_size,
+                              config.package_cache_count):
+                gc_objects(pdir)
+
 def add_cached_package(pdir, url, overwrite=False, urlstxt=False):
     """
     Adds a new package to the cache. The URL is used to determine the
@@ -556,6 +1333,13 @@ def add_cached_package(pdir, url, overwrite=False, urlstxt=False):
     cache, so that subsequent runs will correctly identify the package.
     """
     package_cache()
+    dist = url.rsplit('/', 1)[-1]
+    if dist.endswith('.tar.bz2'):
+        dist = dist[:-8]
+    update_pkgs_dir_entries(pdir, (dist + '.tar.bz2', dist))
+    _add_cached_package(pdir, url, pkgs_dir_entries(pdir), overwrite, urlstxt)
+
+def _add_cached_package(pdir, url, entries, overwrite=False, urlstxt=False):
     dist = url.rsplit('/', 1)[-1]
     if dist.endswith('.tar.bz2'):
         fname = dist
@@ -565,12 +1349,10 @@ def add_cached_package(pdir, url, overwrite=False, urlstxt=False):
     xpkg = join(pdir, fname)
     if not overwrite and xpkg in fname_table:
         return
-    if not isfile(xpkg):
+    if entries.get(fname) != 'tarball':
         xpkg = None
     xdir = join(pdir, dist)
-    if not (isdir(xdir) and
-            isfile(join(xdir, 'info', 'files')) and
-            isfile(join(xdir, 'info', 'index.json'))):
+    if entries.get(dist) != 'extracted':
         xdir = None
     if not (xpkg or xdir):
         return
@@ -612,13 +1394,14 @@ def package_cache():
     for pdir in config.pkgs_dirs:
         try:
             data = open(join(pdir, 'urls.txt')).read()
-            for url in data.split()[::-1]:
-                if '/' in url:
-                    add_cached_package(pdir, url)
-            for fn in os.listdir(pdir):
-                add_cached_package(pdir, '<unknown>/' + fn)
         except IOError:
             continue
+        entries = pkgs_dir_entries(pdir)
+        for url in data.split()[::-1]:
+            if '/' in url:
+                _add_cached_package(pdir, url, entries)
+        for fn in entries:
+            _add_cached_package(pdir, '<unknown>/' + fn, entries)
     del package_cache_['@']
     return package_cache_
 
@@ -670,11 +1453,14 @@ def rm_fetched(dist):
         return
     for fname in rec['files']:
         del fname_table[fname]
-        with Locked(dirname(fname)):
+        with package_lock(dirname(fname), basename(fname)[:-8],
+                          exclusive=True):
             rm_rf(fname)
+        update_pkgs_dir_entries(dirname(fname), [basename(fname)])
     for fname in rec['dirs']:
-        with Locked(dirname(fname)):
+        with package_lock(dirname(fname), basename(fname), exclusive=True):
             rm_rf(fname)
+        update_pkgs_dir_entries(dirname(fname), [basename(fname)])
     del package_cache_[dist]
 
 # ------- package cache ----- extracted
@@ -701,8 +1487,9 @@ def rm_extracted(dist):
     if rec is None:
         return
     for fname in rec['dirs']:
-        with Locked(dirname(fname)):
+        with package_lock(dirname(fname), basename(fname), exclusive=True):
             rm_rf(fname)
+        update_pkgs_dir_entries(dirname(fname), [basename(fname)])
     if rec['files']:
         rec['dirs'] = []
     else:
@@ -718,12 +1505,21 @@ def extract(dist):
     fname = rec['files'][0]
     assert url and fname
     pkgs_dir = dirname(fname)
-    with Locked(pkgs_dir):
+    with package_lock(pkgs_dir, basename(fname)[:-8], exclusive=True):
         path = fname[:-8]
         rm_rf(path)
         t = tarfile.open(fname)
         t.extractall(path=path)
         t.close()
+        try:
+            write_prefix_offsets(path)
+        except (IOError, OSError) as e:
+            log.debug("could not index the placeholders of %s: %r" % (dist, e))
+        # hashed here, such that linking the package only reads its manifest
+        files_manifest(path)
+        if basename(path) not in package_refs(pkgs_dir):
+            set_package_refs(pkgs_dir, basename(path), [])
+        touch_package(pkgs_dir, basename(path))
         if sys.platform.startswith('linux') and os.getuid() == 0:
             # When extracting as root, tarfile will by restore ownership
             # of extracted files.  However, we want root to be the owner
@@ -732,6 +1528,8 @@ def extract(dist):
                 for fn in files:
                     p = join(root, fn)
                     os.lchown(p, 0, 0)
+        if config.dedup_package_files and not on_win:
+            dedup_package(path)
         add_cached_package(pkgs_dir, url, overwrite=True)
 
 # Because the conda-meta .json files do not include channel names in
@@ -759,10 +1557,290 @@ def load_linked_data(prefix, dist, rec=None):
     rec['schannel'] = schannel
     cprefix = '' if schannel == 'defaults' else schannel + '::'
     rec['fn'] = dname + '.tar.bz2'
-    linked_data_[prefix][str(cprefix + dname)] = rec
+    dist = str(cprefix + dname)
+    linked_data_[prefix][dist] = rec
     return rec
 
 
+def _meta_dist(fn, rec):
+    # the canonical name of the package of the record rec in conda-meta/fn
+    _, schannel = url_channel(rec.get('url'))
+    cprefix = '' if schannel == 'defaults' else schannel + '::'
+    return cprefix + fn[:-5]
+
+
+# The reverse index of the files of the packages linked in a prefix is kept
+# in the file below (in the state subdirectory of conda-meta, such that
+# writing it does not change the mtime of conda-meta), together with the
+# size and mtime of the conda-meta/*.json files it was built from.  It is
+# updated when packages are linked and unlinked (and written at exit, or
+# before the prefix is moved), and only rebuilt from the records when it
+# does not match conda-meta.  file_owners_ maps each prefix to a tuple
+# (stats, owners) of the loaded index.
+FILE_OWNERS_FN = join('state', 'file_owners.json')
+file_owners_ = {}
+file_owners_changed_ = set()
+
+def _meta_stats(prefix):
+    # the [size, mtime] of each conda-meta/*.json file of prefix
+    meta_dir = join(prefix, 'conda-meta')
+    stats = {}
+    for fn in os.listdir(meta_dir):
+        if fn.endswith('.json'):
+            st = os.stat(join(meta_dir, fn))
+            stats[fn] = [st.st_size, st.st_mtime]
+    return stats
+
+def _load_file_owners(prefix):
+    # the (stats, owners) stored in the index file of prefix, or None
+    try:
+        with open(join(prefix, 'conda-meta', FILE_OWNERS_FN)) as fi:
+            index = json.load(fi)
+        return index['stats'], {f: set(dists)
+                                for f, dists in iteritems(index['owners'])}
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def save_file_owners(prefix):
+    """
+    Write the reverse index of the files of the packages linked in prefix
+    (see file_owners), when it has changed.
+    """
+    if prefix not in file_owners_changed_:
+        return
+    file_owners_changed_.discard(prefix)
+    stats, owners = file_owners_[prefix]
+    path = join(prefix, 'conda-meta', FILE_OWNERS_FN)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        # conda-meta itself is not created, as prefix might be gone
+        if not isdir(dirname(path)):
+            os.mkdir(dirname(path))
+        with open(tmp_path, 'w') as fo:
+            json.dump({'stats': stats,
+                       'owners': {f: sorted(dists)
+                                  for f, dists in iteritems(owners)}}, fo)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write %s (%s)" % (path, e))
+
+@atexit.register
+def save_all_file_owners():
+    """
+    Write the reverse indexes which have changed (see save_file_owners).
+    """
+    for prefix in list(file_owners_changed_):
+        save_file_owners(prefix)
+
+def forget_file_owners(prefix):
+    """
+    Forget the loaded reverse index of prefix (without writing it), e.g.
+    after prefix was moved.
+    """
+    file_owners_.pop(prefix, None)
+    file_owners_changed_.discard(prefix)
+
+def file_owners(prefix):
+    """
+    Return a dictionary mapping the files (relative paths) of the packages
+    linked in prefix to the set of packages (usually one) containing them.
+    """
+    cached = file_owners_.get(prefix)
+    if cached is not None:
+        return cached[1]
+    try:
+        stats = _meta_stats(prefix)
+    except OSError:
+        return {}
+    cached = _load_file_owners(prefix)
+    if cached is None or cached[0] != stats:
+        owners = {}
+        for dist, rec in iteritems(linked_data(prefix)):
+            for f in rec.get('files', ()):
+                owners.setdefault(f, set()).add(dist)
+        cached = stats, owners
+        file_owners_changed_.add(prefix)
+    file_owners_[prefix] = cached
+    return cached[1]
+
+def _update_file_owners(prefix, dist, rec):
+    # update the reverse index of prefix after the record of dist has been
+    # written to conda-meta, or removed from it (rec is None)
+    schannel, dname = _dist2pair(dist)
+    dist = dname if schannel == 'defaults' else schannel + '::' + dname
+    fn = dname + '.json'
+    cached = file_owners_.get(prefix)
+    try:
+        stats = _meta_stats(prefix)
+    except OSError:
+        return
+    if cached is None:
+        # a new prefix has no index yet
+        cached = _load_file_owners(prefix) or ({}, {})
+        old_stats = dict(cached[0])
+        old_stats.pop(fn, None)
+        stats.pop(fn, None)
+        if old_stats != stats:
+            # it is rebuilt the next time it is used
+            return
+        file_owners_[prefix] = cached
+    index_stats, owners = cached
+    if fn in index_stats:
+        for f in [f for f, dists in iteritems(owners) if dist in dists]:
+            owners[f].discard(dist)
+            if not owners[f]:
+                del owners[f]
+        del index_stats[fn]
+    if rec is not None:
+        for f in rec.get('files', ()):
+            owners.setdefault(f, set()).add(dist)
+        st = os.stat(join(prefix, 'conda-meta', fn))
+        index_stats[fn] = [st.st_size, st.st_mtime]
+    file_owners_changed_.add(prefix)
+
+
+# When prefix_state_db is enabled, the records of conda-meta/*.json are also
+# kept in a single SQLite database, together with the size and mtime of each
+# file, so that reading them does not require opening every file.  The
+# files of the records are indexed, to look up the packages containing a
+# file.  The JSON files remain the reference: the files whose size or mtime
+# differ from the database are read again.  As a file can be rewritten in
+# place without changing the mtime of conda-meta, this is checked for every
+# file, each time.
+PREFIX_STATE_FN = join('state', 'prefix.db')
+PREFIX_STATE_VERSION = 1
+
+def _open_prefix_state(prefix):
+    """
+    Return a connection to the state database of prefix, or None when it is
+    disabled or not available.
+    """
+    if not (config.prefix_state_db and sqlite3):
+        return None
+    # in a subdirectory, as the journal of the database would otherwise
+    # change the mtime of conda-meta
+    path = join(prefix, 'conda-meta', PREFIX_STATE_FN)
+    try:
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        con = sqlite3.connect(path, timeout=60)
+        with con:
+            if con.execute("PRAGMA user_version").fetchone()[0] != PREFIX_STATE_VERSION:
+                for table in 'meta', 'info', 'files':
+                    con.execute("DROP TABLE IF EXISTS %s" % table)
+                con.execute("PRAGMA user_version = %d" % PREFIX_STATE_VERSION)
+            con.execute("CREATE TABLE IF NOT EXISTS meta "
+                        "(fn TEXT PRIMARY KEY, size INTEGER, mtime REAL, rec TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS files (path TEXT, fn TEXT)")
+            con.execute("CREATE INDEX IF NOT EXISTS files_path ON files (path)")
+            con.execute("CREATE INDEX IF NOT EXISTS files_fn ON files (fn)")
+        return con
+    except (OSError, sqlite3.Error) as e:
+        log.debug("Could not open %s (%s)" % (path, e))
+        return None
+
+def _put_prefix_state(con, prefix, fn, rec):
+    st = os.stat(join(prefix, 'conda-meta', fn))
+    _delete_prefix_state(con, fn)
+    con.execute("INSERT INTO meta VALUES (?, ?, ?, ?)",
+                (fn, st.st_size, st.st_mtime, json.dumps(rec)))
+    con.executemany("INSERT INTO files VALUES (?, ?)",
+                    ((f, fn) for f in set(rec.get('files', ()))))
+
+def _delete_prefix_state(con, fn):
+    con.execute("DELETE FROM meta WHERE fn = ?", (fn,))
+    con.execute("DELETE FROM files WHERE fn = ?", (fn,))
+
+def _sync_prefix_state(con, prefix):
+    meta_dir = join(prefix, 'conda-meta')
+    stored = {fn: (size, fmtime) for fn, size, fmtime in
+              con.execute("SELECT fn, size, mtime FROM meta")}
+    fns = [fn for fn in os.listdir(meta_dir) if fn.endswith('.json')]
+    for fn in set(stored) - set(fns):
+        _delete_prefix_state(con, fn)
+    for fn in fns:
+        path = join(meta_dir, fn)
+        st = os.stat(path)
+        if stored.get(fn) == (st.st_size, st.st_mtime):
+            continue
+        try:
+            with open(path) as fi:
+                rec = json.load(fi)
+        except (IOError, ValueError) as e:
+            log.debug("Could not read %s (%s)" % (path, e))
+            continue
+        _put_prefix_state(con, prefix, fn, rec)
+
+def _query_prefix_state(prefix, sql, args=()):
+    # the rows of the query sql on the state database of prefix (brought in
+    # sync with conda-meta first), or None when the database is not used
+    con = _open_prefix_state(prefix)
+    if con is None:
+        return None
+    try:
+        with con:
+            _sync_prefix_state(con, prefix)
+            return con.execute(sql, args).fetchall()
+    except (OSError, sqlite3.Error) as e:
+        log.debug("Could not read the state of %s (%s)" % (prefix, e))
+        return None
+    finally:
+        con.close()
+
+def prefix_state_records(prefix):
+    """
+    Return the list of (filename, record) of conda-meta/*.json in prefix,
+    from its state database, or None when the database is not used.
+    """
+    rows = _query_prefix_state(prefix, "SELECT fn, rec FROM meta")
+    if rows is None:
+        return None
+    return [(fn, json.loads(rec)) for fn, rec in rows]
+
+def prefix_state_owners(prefix, path):
+    """
+    Return the set of the packages linked in prefix which contain the file
+    path (relative to prefix), from the state database of prefix, or None
+    when the database is not used.
+    """
+    rows = _query_prefix_state(
+        prefix, "SELECT meta.fn, meta.rec FROM files JOIN meta "
+        "ON files.fn = meta.fn WHERE files.path = ?", (path,))
+    if rows is None:
+        return None
+    return {_meta_dist(fn, json.loads(rec)) for fn, rec in rows}
+
+def put_prefix_state(prefix, fn, rec):
+    """
+    Store the record rec of conda-meta/fn in the state database of prefix.
+    """
+    con = _open_prefix_state(prefix)
+    if con is None:
+        return
+    try:
+        with con:
+            _put_prefix_state(con, prefix, fn, rec)
+    except (OSError, sqlite3.Error) as e:
+        log.debug("Could not update the state of %s (%s)" % (prefix, e))
+    finally:
+        con.close()
+
+def delete_prefix_state(prefix, fn):
+    """
+    Remove the record of conda-meta/fn from the state database of prefix.
+    """
+    con = _open_prefix_state(prefix)
+    if con is None:
+        return
+    try:
+        with con:
+            _delete_prefix_state(con, fn)
+    except sqlite3.Error as e:
+        log.debug("Could not update the state of %s (%s)" % (prefix, e))
+    finally:
+        con.close()
+
+
 def delete_linked_data(prefix, dist, delete=True):
     recs = linked_data_.get(prefix)
     if recs and dist in recs:
@@ -771,6 +1849,8 @@ def delete_linked_data(prefix, dist, delete=True):
         meta_path = join(prefix, 'conda-meta', _dist2filename(dist, '.json'))
         if isfile(meta_path):
             os.unlink(meta_path)
+        delete_prefix_state(prefix, _dist2filename(dist, '.json'))
+        _update_file_owners(prefix, dist, None)
 
 
 def load_meta(prefix, dist):
@@ -791,6 +1871,11 @@ def linked_data(prefix):
         recs = linked_data_[prefix] = {}
         meta_dir = join(prefix, 'conda-meta')
         if isdir(meta_dir):
+            records = prefix_state_records(prefix)
+            if records is not None:
+                for fn, rec in records:
+                    load_linked_data(prefix, _meta_dist(fn, rec), rec)
+                return recs
             for fn in os.listdir(meta_dir):
                 if fn.endswith('.json'):
                     load_linked_data(prefix, fn[:-5])
@@ -811,17 +1896,6 @@ def is_linked(prefix, dist):
     """
     return load_meta(prefix, dist)
 
-def delete_trash(prefix=None):
-    from conda import config
-
-    for pkg_dir in config.pkgs_dirs:
-        trash_dir = join(pkg_dir, '.trash')
-        try:
-            log.debug("Trying to delete the trash dir %s" % trash_dir)
-            rm_rf(trash_dir, max_retries=1, trash=False)
-        except OSError as e:
-            log.debug("Could not delete the trash dir %s (%s)" % (trash_dir, e))
-
 def move_to_trash(prefix, f, tempdir=None):
     """
     Move a file f from prefix to the trash
@@ -832,15 +1906,90 @@ def move_to_trash(prefix, f, tempdir=None):
     """
     return move_path_to_trash(join(prefix, f))
 
-def move_path_to_trash(path):
+# Moving a path to the trash does not delete anything.  Instead, the trash is
+# reaped at the end of execute_instructions, in a background process (see
+# reap_trash_in_background).  Entries younger than TRASH_MIN_AGE seconds are
+# left alone, as (on Windows) the files moved there may still be in use, and
+# reaping stops once TRASH_REAP_MAX_SIZE bytes are deleted.
+TRASH_MIN_AGE = 60
+TRASH_REAP_MAX_SIZE = 2**28
+
+def trash_entries(min_age=0):
     """
-    Move a path to the trash
+    Return the paths in the trash directories which are at least `min_age`
+    seconds old, the oldest first.
     """
-    # Try deleting the trash every time we use it.
-    delete_trash()
+    now = time.time()
+    res = []
+    for pkg_dir in config.pkgs_dirs:
+        trash_dir = join(pkg_dir, '.trash')
+        try:
+            fns = os.listdir(trash_dir)
+        except OSError:
+            continue
+        for fn in fns:
+            path = join(trash_dir, fn)
+            try:
+                mtime = os.lstat(path).st_mtime
+            except OSError:
+                continue
+            if now - mtime >= min_age:
+                res.append((mtime, path))
+    return [path for unused_mtime, path in sorted(res)]
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.lstat(join(root, fn)).st_size
+            except OSError:
+                pass
+    return size
 
-    from conda import config
+def reap_trash(min_age=TRASH_MIN_AGE, max_size=None):
+    """
+    Delete the entries of the trash which are at least `min_age` seconds
+    old, the oldest first, and stop once `max_size` bytes were deleted.
+    Returns the number of bytes deleted.
+    """
+    deleted = 0
+    for path in trash_entries(min_age):
+        if max_size is not None and deleted >= max_size:
+            break
+        size = _tree_size(path) if isdir(path) else os.lstat(path).st_size
+        try:
+            rm_rf(path, max_retries=1, trash=False)
+        except OSError as e:
+            log.debug("Could not delete %s from the trash (%s)" % (path, e))
+            continue
+        deleted += size
+    return deleted
 
+REAP_TRASH_SCRIPT = """\
+import sys
+from conda.install import TRASH_REAP_MAX_SIZE, reap_trash
+sys.stdout.write('ok\\n')
+sys.stdout.close()
+reap_trash(max_size=TRASH_REAP_MAX_SIZE)
+"""
+
+def reap_trash_in_background():
+    """
+    Reap the trash in a separate process, when there is anything to reap.
+    """
+    if not trash_entries(TRASH_MIN_AGE):
+        return
+    # the handshake fails when sys.executable cannot import conda (e.g. in
+    # frozen or embedded installations)
+    if not _spawn_detached([sys.executable, '-c', REAP_TRASH_SCRIPT],
+                           handshake=True):
+        reap_trash(max_size=TRASH_REAP_MAX_SIZE)
+
+def move_path_to_trash(path):
+    """
+    Move a path to the trash
+    """
     for pkg_dir in config.pkgs_dirs:
         import tempfile
         trash_dir = join(pkg_dir, '.trash')
@@ -852,7 +2001,13 @@ def move_path_to_trash(path):
                 continue
 
         trash_dir = tempfile.mkdtemp(dir=trash_dir)
-        trash_dir = join(trash_dir, relpath(os.path.dirname(path), config.root_dir))
+        try:
+            rel = relpath(os.path.dirname(path), config.root_dir)
+        except ValueError:  # on another drive (on Windows)
+            rel = os.pardir
+        if not rel.startswith(os.pardir):
+            # paths outside of the root would end up outside of the trash
+            trash_dir = join(trash_dir, rel)
 
         try:
             os.makedirs(trash_dir)
@@ -870,10 +2025,178 @@ def move_path_to_trash(path):
     log.debug("Could not move %s to trash" % path)
     return False
 
-def link(prefix, dist, linktype=LINK_HARD, index=None):
+# the files of packages with at least LINK_THREADS_MIN_FILES files are linked
+# using a pool of LINK_THREADS threads
+LINK_THREADS = 4
+LINK_THREADS_MIN_FILES = 256
+# likewise, the placeholders of packages with at least PREFIX_THREADS_MIN_FILES
+# has_prefix files are replaced using the pool
+PREFIX_THREADS_MIN_FILES = 16
+
+
+def make_dirs(prefix, files):
+    """
+    Create all directories (within `prefix`) needed for `files`, and return
+    the set of those which did not exist before.  Each directory is only
+    looked at once, and not at all when its parent was just created.
+    """
+    new_dirs = set()
+    for d in sorted(set(dirname(f) for f in files)):
+        if (d and dirname(d) in new_dirs) or not isdir(join(prefix, d)):
+            os.makedirs(join(prefix, d))
+            new_dirs.add(d)
+    return new_dirs
+
+
+def link_file(src, dst, linktype, fresh=False):
+    """
+    Link `src` to `dst`, replacing any existing file, unless `fresh` is
+    True, i.e. nothing can exist at `dst`.
+    """
+    if not fresh and os.path.exists(dst):
+        log.warn("file already exists: %r" % dst)
+        try:
+            os.unlink(dst)
+        except OSError:
+            log.error('failed to unlink: %r' % dst)
+            if on_win:
+                try:
+                    move_path_to_trash(dst)
+                except ImportError:
+                    # This shouldn't be an issue in the installer anyway
+                    pass
+    try:
+        _link(src, dst, linktype)
+    except OSError as e:
+        log.error('failed to link (src=%r, dst=%r, type=%r, error=%r)' %
+                  (src, dst, linktype, e))
+
+
+def _map_jobs(func, jobs, min_jobs):
+    """
+    Return the list of func(*args) for each tuple of arguments in `jobs`.
+    When there are at least `min_jobs` jobs, they are run using a pool of
+    LINK_THREADS threads.
+    """
+    if len(jobs) >= min_jobs:
+        try:
+            import concurrent.futures
+            executor = concurrent.futures.ThreadPoolExecutor(LINK_THREADS)
+        except (ImportError, RuntimeError):
+            # concurrent.futures is not available in the standalone installer
+            # on Python 2, and RuntimeError is raised when threads are limited
+            pass
+        else:
+            try:
+                return list(executor.map(lambda args: func(*args), jobs))
+            finally:
+                executor.shutdown(wait=True)
+    return [func(*args) for args in jobs]
+
+
+def link_files(jobs):
+    """
+    Call link_file() for each tuple of arguments in `jobs`.
+    """
+    _map_jobs(link_file, jobs, LINK_THREADS_MIN_FILES)
+
+
+def _update_prefix_file(path, new_prefix, placeholder, mode, rec):
+    """
+    Replace the placeholder in `path`, using the offsets `rec` when
+    possible.  Returns True when the placeholder is too short.
+    """
+    try:
+        if not (rec and patch_prefix(path, new_prefix, placeholder, mode, rec)):
+            update_prefix(path, new_prefix, placeholder, mode)
+    except PaddingError:
+        return True
+    return False
+
+
+def update_prefix_files(prefix, has_prefix_files, prefix_offsets=None,
+                        suffix='', new_prefix=None):
+    """
+    Replace the placeholders in the `has_prefix_files` (as returned by
+    read_has_prefix) linked into `prefix` (with `suffix` appended to their
+    names) by `new_prefix` (defaults to `prefix`), using a pool of threads
+    for packages with at least PREFIX_THREADS_MIN_FILES such files.  Returns
+    the list of (file, placeholder) for which the placeholder is too short.
+    """
+    new_prefix = new_prefix or prefix
+    prefix_offsets = prefix_offsets or {}
+    jobs = {}
+    # files which resolve to the same path as an earlier file (through
+    # symlinks) are not rewritten concurrently with it, but afterwards
+    later = {}
+    seen = set()
+    for f in sorted(has_prefix_files):
+        placeholder, mode = has_prefix_files[f]
+        path = join(prefix, f) + suffix
+        realpath = os.path.realpath(path)
+        (later if realpath in seen else jobs)[f] = (
+            path, new_prefix, placeholder, mode, prefix_offsets.get(f))
+        seen.add(realpath)
+    fs = list(jobs) + list(later)
+    too_short = (_map_jobs(_update_prefix_file, list(jobs.values()),
+                           PREFIX_THREADS_MIN_FILES) +
+                 [_update_prefix_file(*job) for job in later.values()])
+    return [(f, has_prefix_files[f][0])
+            for f, failed in zip(fs, too_short) if failed]
+
+
+def _link_jobs(source_dir, prefix, files, has_prefix_files, no_link,
+               linktype, new_dirs=(), suffix=''):
+    # the arguments of link_file() for linking `files` to `prefix`, where
+    # `suffix` is appended to the destination paths
+    jobs = []
+    for f in files:
+        src = join(source_dir, f)
+        lt = linktype
+        if ((f in has_prefix_files or f in no_link or islink(src)) and
+                linktype != LINK_REFLINK):
+            lt = LINK_COPY
+        # nothing can be in the way of files in newly created directories
+        jobs.append((src, join(prefix, f) + suffix, lt, dirname(f) in new_dirs))
+    return jobs
+
+
+def _exit_too_short(dist, too_short):
+    placeholders = {}
+    for f, placeholder in too_short:
+        placeholders.setdefault(placeholder, []).append(f)
+    sys.exit(''.join("ERROR: placeholder '%s' too short in: %s\n%s" %
+                     (placeholder, dist, ''.join('  %s\n' % f for f in sorted(fs)))
+                     for placeholder, fs in sorted(placeholders.items())))
+
+
+def _create_link_meta(prefix, dist, source_dir, files, linktype, index,
+                      has_prefix_files):
+    meta_dict = index.get(dist + '.tar.bz2', {})
+    meta_dict['url'] = read_url(dist)
+    try:
+        alt_files_path = join(prefix, 'conda-meta', _dist2filename(dist, '.files'))
+        meta_dict['files'] = list(yield_lines(alt_files_path))
+        os.unlink(alt_files_path)
+    except IOError:
+        meta_dict['files'] = files
+    meta_dict['link'] = {'source': source_dir,
+                         'type': link_name_map.get(linktype)}
+    meta_dict['manifest'] = _link_manifest(prefix, source_dir, files,
+                                           has_prefix_files)
+    if 'icon' in meta_dict:
+        meta_dict['icondata'] = read_icondata(source_dir)
+
+    create_meta(prefix, dist, join(source_dir, 'info'), meta_dict)
+
+
+def link(prefix, dist, linktype=LINK_HARD, index=None, target_prefix=None):
     '''
     Set up a package in a specified (environment) prefix.  We assume that
-    the package has been extracted (using extract() above).
+    the package has been extracted (using extract() above).  When the prefix
+    is going to be moved to `target_prefix`, the placeholders are replaced
+    by `target_prefix` instead, and creating the menus and running the
+    post-link script is left to the caller, once the prefix was moved.
     '''
     index = index or {}
     source_dir = is_extracted(dist)
@@ -890,65 +2213,264 @@ def link(prefix, dist, linktype=LINK_HARD, index=None):
     has_prefix_files = read_has_prefix(join(info_dir, 'has_prefix'))
     no_link = read_no_link(info_dir)
 
-    with Locked(prefix), Locked(pkgs_dir):
-        for f in files:
-            src = join(source_dir, f)
-            dst = join(prefix, f)
-            dst_dir = dirname(dst)
-            if not isdir(dst_dir):
-                os.makedirs(dst_dir)
-            if os.path.exists(dst):
-                log.warn("file already exists: %r" % dst)
-                try:
-                    os.unlink(dst)
-                except OSError:
-                    log.error('failed to unlink: %r' % dst)
-                    if on_win:
-                        try:
-                            move_path_to_trash(dst)
-                        except ImportError:
-                            # This shouldn't be an issue in the installer anyway
-                            pass
-
-            lt = linktype
-            if f in has_prefix_files or f in no_link or islink(src):
-                lt = LINK_COPY
-            try:
-                _link(src, dst, lt)
-            except OSError as e:
-                log.error('failed to link (src=%r, dst=%r, type=%r, error=%r)' %
-                          (src, dst, lt, e))
+    with Locked(prefix), package_lock(pkgs_dir, basename(source_dir)):
+        t0 = time.time()
+        new_dirs = make_dirs(prefix, files)
+        link_files(_link_jobs(source_dir, prefix, files, has_prefix_files,
+                              no_link, linktype, new_dirs))
+        dt = time.time() - t0
+        log.debug('linked %d files of %s in %.3f sec. (%.0f files/sec.)' %
+                  (len(files), dist, dt, len(files) / dt if dt else 0))
 
         if name_dist(dist) == '_cache':
             return
 
-        for f in sorted(has_prefix_files):
-            placeholder, mode = has_prefix_files[f]
-            try:
-                update_prefix(join(prefix, f), prefix, placeholder, mode)
-            except PaddingError:
-                sys.exit("ERROR: placeholder '%s' too short in: %s\n" %
-                         (placeholder, dist))
+        too_short = update_prefix_files(prefix, has_prefix_files,
+                                        read_prefix_offsets(info_dir),
+                                        new_prefix=target_prefix)
+        if too_short:
+            _exit_too_short(dist, too_short)
+
+        if target_prefix is None:
+            mk_menus(prefix, files, remove=False)
+
+            if not run_script(prefix, dist, 'post-link'):
+                sys.exit("Error: post-link failed for: %s" % dist)
+
+        _create_link_meta(prefix, dist, source_dir, files, linktype, index,
+                          has_prefix_files)
+        _update_package_refs(source_dir, add=target_prefix or prefix)
+        touch_package(pkgs_dir, basename(source_dir))
+
 
+# suffixes of the new files staged by update(), and of the backups of the
+# files they replace
+STAGED_SUFFIX = '.conda-new'
+BACKUP_SUFFIX = '.conda-old'
+
+
+def _backup(path, backup):
+    # keep the file at path (which is about to be replaced) as backup
+    if islink(path):
+        os.symlink(os.readlink(path), backup)
+        return
+    try:
+        os.link(path, backup)
+    except OSError:
+        shutil.copy2(path, backup)
+
+
+def _restore_update(prefix, files, swapped, replaced):
+    # undo the swap of update(): restore the backups of the `replaced` files
+    # which were `swapped`, and remove all other new and staged files
+    swapped = set(swapped)
+    for f in replaced:
+        dst = join(prefix, f)
+        if f in swapped:
+            os.rename(dst + BACKUP_SUFFIX, dst)
+        else:
+            rm_rf(dst + BACKUP_SUFFIX)
+    for f in files:
+        if f in swapped and f not in replaced:
+            rm_rf(join(prefix, f))
+        rm_rf(join(prefix, f) + STAGED_SUFFIX)
+
+
+def update(prefix, old_dist, dist, linktype=LINK_HARD, index=None):
+    """
+    Replace the linked package `old_dist` with `dist` (typically a newer
+    version of the same package), such that each of the files of `dist` is
+    swapped in with a single rename, instead of all files of `old_dist`
+    being missing until `dist` is linked.  Files of `old_dist` which are not
+    in `dist` are removed afterwards.  When swapping the files in or the
+    post-link script of `dist` fails, `old_dist` is restored.  The pre-unlink
+    script of `old_dist` only runs once the files were swapped in.
+    """
+    if on_win:
+        # files which are in use cannot be replaced on Windows
+        unlink(prefix, old_dist)
+        link(prefix, dist, linktype, index)
+        return
+
+    index = index or {}
+    source_dir = is_extracted(dist)
+    assert source_dir is not None
+    pkgs_dir = dirname(source_dir)
+    log.debug('pkgs_dir=%r, prefix=%r, old_dist=%r, dist=%r, linktype=%r' %
+              (pkgs_dir, prefix, old_dist, dist, linktype))
+
+    if not run_script(source_dir, dist, 'pre-link', prefix):
+        sys.exit('Error: pre-link failed: %s' % dist)
+
+    info_dir = join(source_dir, 'info')
+    files = list(yield_lines(join(info_dir, 'files')))
+    has_prefix_files = read_has_prefix(join(info_dir, 'has_prefix'))
+    no_link = read_no_link(info_dir)
+
+    with Locked(prefix), package_lock(pkgs_dir, basename(source_dir)):
+        old_files = load_meta(prefix, old_dist)['files']
+
+        # stage the new files next to their destinations
+        make_dirs(prefix, files)
+        link_files(_link_jobs(source_dir, prefix, files, has_prefix_files,
+                              no_link, linktype, suffix=STAGED_SUFFIX))
+        too_short = update_prefix_files(prefix, has_prefix_files,
+                                        read_prefix_offsets(info_dir),
+                                        suffix=STAGED_SUFFIX)
+        if too_short:
+            for f in files:
+                rm_rf(join(prefix, f) + STAGED_SUFFIX)
+            _exit_too_short(dist, too_short)
+
+        # swap them in
+        swapped = []
+        replaced = []
+        try:
+            for f in files:
+                dst = join(prefix, f)
+                if os.path.lexists(dst):
+                    _backup(dst, dst + BACKUP_SUFFIX)
+                    replaced.append(f)
+                os.rename(dst + STAGED_SUFFIX, dst)
+                swapped.append(f)
+        except (IOError, OSError) as e:
+            _restore_update(prefix, files, swapped, replaced)
+            sys.exit("Error: could not update %s to %s (%s was restored): %s"
+                     % (old_dist, dist, old_dist, e))
+
+        run_script(prefix, old_dist, 'pre-unlink')
+        mk_menus(prefix, old_files, remove=True)
         mk_menus(prefix, files, remove=False)
 
         if not run_script(prefix, dist, 'post-link'):
-            sys.exit("Error: post-link failed for: %s" % dist)
+            log.debug("post-link of %s failed, restoring %s" % (dist, old_dist))
+            mk_menus(prefix, files, remove=True)
+            _restore_update(prefix, files, swapped, replaced)
+            mk_menus(prefix, old_files, remove=False)
+            sys.exit("Error: post-link failed for: %s (%s was restored)" %
+                     (dist, old_dist))
+
+        for f in replaced:
+            rm_rf(join(prefix, f) + BACKUP_SUFFIX)
+        dst_dirs = set()
+        for f in set(old_files) - set(files):
+            dst = join(prefix, f)
+            dst_dirs.add(dirname(dst))
+            try:
+                os.unlink(dst)
+            except OSError:  # file might not exist
+                log.debug("could not remove file: '%s'" % dst)
+        for path in sorted(dst_dirs, key=len, reverse=True):
+            while len(path) > len(prefix):
+                rm_empty_dir(path)
+                path = dirname(path)
 
-        meta_dict = index.get(dist + '.tar.bz2', {})
-        meta_dict['url'] = read_url(dist)
-        try:
-            alt_files_path = join(prefix, 'conda-meta', _dist2filename(dist, '.files'))
-            meta_dict['files'] = list(yield_lines(alt_files_path))
-            os.unlink(alt_files_path)
-        except IOError:
-            meta_dict['files'] = files
-        meta_dict['link'] = {'source': source_dir,
-                             'type': link_name_map.get(linktype)}
-        if 'icon' in meta_dict:
-            meta_dict['icondata'] = read_icondata(source_dir)
+        old_source_dir = load_meta(prefix, old_dist).get('link', {}).get('source')
+        delete_linked_data(prefix, old_dist, delete=True)
+        _create_link_meta(prefix, dist, source_dir, files, linktype, index,
+                          has_prefix_files)
+        if old_source_dir:
+            _update_package_refs(old_source_dir, remove=prefix)
+        _update_package_refs(source_dir, add=prefix)
+        touch_package(pkgs_dir, basename(source_dir))
 
-        create_meta(prefix, dist, info_dir, meta_dict)
+
+def _verify_file(path, entry, deep):
+    # the problem with the file at path, according to its manifest entry
+    try:
+        st = os.lstat(path)
+        if 'link' in entry:
+            if (not stat.S_ISLNK(st.st_mode) or
+                    os.readlink(path) != entry['link']):
+                return 'modified'
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            # soft-linked into the prefix
+            st = os.stat(path)
+        if st.st_size != entry['size']:
+            return 'modified'
+        if deep:
+            if file_sha256(path) != entry['sha256']:
+                return 'modified'
+        elif st.st_mtime != entry['mtime']:
+            return 'modified'
+    except (IOError, OSError):
+        return 'missing'
+    if stat.S_IMODE(st.st_mode) != entry['mode']:
+        return 'mode'
+    return None
+
+
+def verify_files(prefix, dists=None, deep=False):
+    """
+    Check the files of the packages `dists` (defaults to all packages)
+    linked into `prefix` against the manifests recorded when they were
+    linked, using a pool of threads.  By default, only the size and mtime of
+    the files are compared, and when `deep` is True, their SHA256 instead.
+    Packages linked without a manifest are skipped.  Returns the list of
+    (dist, file, problem), where problem is 'missing', 'modified' or 'mode'.
+    """
+    keys = []
+    jobs = []
+    for dist in sorted(linked_data(prefix) if dists is None else dists):
+        manifest = (load_meta(prefix, dist) or {}).get('manifest') or {}
+        for f in sorted(manifest):
+            keys.append((dist, f))
+            jobs.append((join(prefix, f), manifest[f], deep))
+    problems = _map_jobs(_verify_file, jobs, LINK_THREADS_MIN_FILES)
+    return [(dist, f, problem)
+            for (dist, f), problem in zip(keys, problems) if problem]
+
+
+def relink_files(prefix, dist, files):
+    """
+    Link the `files` of the linked package `dist` into `prefix` again, e.g.
+    the damaged files found by verify_files(), without touching its other
+    files.  Exits when the package is not in the package cache, or when the
+    files are damaged in the package cache as well (which happens when they
+    were hard-linked).
+    """
+    meta = load_meta(prefix, dist)
+    source_dir = is_extracted(dist)
+    if meta is None or source_dir is None:
+        sys.exit("Error: %s is not linked, or not extracted, in %s" %
+                 (dist, prefix))
+    pkgs_dir = dirname(source_dir)
+    info_dir = join(source_dir, 'info')
+    has_prefix_files = read_has_prefix(join(info_dir, 'has_prefix'))
+    no_link = read_no_link(info_dir)
+    linktype = {name: lt for lt, name in iteritems(link_name_map)}.get(
+        meta.get('link', {}).get('type'), LINK_COPY)
+    manifest = meta.get('manifest') or {}
+    files = sorted(files)
+
+    with Locked(prefix), package_lock(pkgs_dir, basename(source_dir)):
+        cache_manifest = files_manifest(source_dir)
+        damaged = [f for f in files if f in manifest and
+                   manifest[f] == cache_manifest.get(f) and
+                   _verify_file(join(source_dir, f), manifest[f], True)]
+        if damaged:
+            sys.exit("Error: files of %s are damaged in the package cache:\n"
+                     "%s(use 'conda install --force' to re-install it)" %
+                     (dist, ''.join('  %s\n' % f for f in damaged)))
+        for f in files:
+            if os.path.lexists(join(prefix, f)):
+                os.unlink(join(prefix, f))
+        make_dirs(prefix, files)
+        link_files(_link_jobs(source_dir, prefix, files, has_prefix_files,
+                              no_link, linktype))
+        too_short = update_prefix_files(
+            prefix, {f: has_prefix_files[f]
+                     for f in files if f in has_prefix_files},
+            read_prefix_offsets(info_dir))
+        if too_short:
+            _exit_too_short(dist, too_short)
+
+        meta = dict(meta)
+        meta['manifest'] = dict(manifest)
+        meta['manifest'].update(_link_manifest(prefix, source_dir, files,
+                                               has_prefix_files))
+        create_meta(prefix, dist, info_dir, meta)
 
 
 def unlink(prefix, dist):
@@ -981,6 +2503,8 @@ def unlink(prefix, dist):
 
         # remove the meta-file last
         delete_linked_data(prefix, dist, delete=True)
+        if meta.get('link', {}).get('source'):
+            _update_package_refs(meta['link']['source'], remove=prefix)
 
         dst_dirs2 = set()
         for path in dst_dirs1:
@@ -995,6 +2519,92 @@ def unlink(prefix, dist):
             rm_empty_dir(path)
 
 
+def rename_to_trash(path):
+    """
+    Move `path` into a trash directory by renaming it, which is atomic and
+    does not depend on the size of `path`.  The trash directories of the
+    package caches are tried first, then a hidden directory next to `path`
+    (when the caches are on other file systems).  Returns the directory
+    containing `path` in the trash, or None.
+    """
+    import tempfile
+
+    trash_dirs = [join(pkgs_dir, '.trash') for pkgs_dir in config.pkgs_dirs]
+    trash_dirs.append(dirname(abspath(path)))
+    for trash_dir in trash_dirs:
+        try:
+            if not isdir(trash_dir):
+                os.makedirs(trash_dir)
+            tmp_dir = tempfile.mkdtemp(prefix='.conda-trash-', dir=trash_dir)
+        except OSError:
+            continue
+        try:
+            os.rename(path, join(tmp_dir, basename(path)))
+            return tmp_dir
+        except OSError as e:
+            log.debug("Could not rename %s into %s (%s)" % (path, tmp_dir, e))
+            rm_empty_dir(tmp_dir)
+    return None
+
+
+def _spawn_detached(args, handshake=False):
+    """
+    Start the command `args` in a process which outlives this one.  Returns
+    False if the process could not be started, or with `handshake`, when it
+    does not write the line "ok" to its stdout (once it is ready).
+    """
+    kwargs = {}
+    if on_win:
+        kwargs['creationflags'] = 0x00000008  # DETACHED_PROCESS
+    else:
+        kwargs['preexec_fn'] = os.setsid
+        kwargs['close_fds'] = True
+    try:
+        with open(os.devnull, 'w') as devnull:
+            p = subprocess.Popen(args, stdin=devnull,
+                                 stdout=subprocess.PIPE if handshake else devnull,
+                                 stderr=devnull, **kwargs)
+    except OSError as e:
+        log.debug("Could not start %r (%s)" % (args, e))
+        return False
+    if handshake:
+        ready = p.stdout.readline().strip() == b'ok'
+        p.stdout.close()
+        if not ready:
+            log.debug("%r failed (exit code %s)" % (args, p.wait()))
+            return False
+    return True
+
+
+def delete_in_background(path):
+    """
+    Delete `path` in a separate process which outlives this one.  Returns
+    False if the process could not be started.
+    """
+    return _spawn_detached([
+        sys.executable, '-c',
+        'import shutil, sys; shutil.rmtree(sys.argv[1], ignore_errors=True)',
+        path])
+
+
+def remove_prefix(prefix):
+    """
+    Remove the environment `prefix` as a whole.  The pre-unlink scripts of
+    its packages are run and their menus are removed, but instead of
+    unlinking each file, the prefix is renamed into the trash and deleted
+    in the background.
+    """
+    with Locked(prefix):
+        for dist in sorted(linked(prefix)):
+            run_script(prefix, dist, 'pre-unlink')
+            meta = load_meta(prefix, dist)
+            mk_menus(prefix, meta['files'], remove=True)
+        trash_dir = rename_to_trash(prefix)
+    linked_data_.pop(prefix, None)
+    if trash_dir is None or not delete_in_background(trash_dir):
+        rm_rf(trash_dir or prefix)
+
+
 def messages(prefix):
     path = join(prefix, '.messages.txt')
     try:
@@ -1075,9 +2685,13 @@ def main():
     else:
         idists = sorted(extracted(pkgs_dir))
 
-    linktype = (LINK_HARD
-                if try_hard_link(pkgs_dir, prefix, idists[0]) else
-                LINK_COPY)
+    caps = link_capabilities(pkgs_dir, prefix)
+    if caps['hard']:
+        linktype = LINK_HARD
+    elif caps['reflink']:
+        linktype = LINK_REFLINK
+    else:
+        linktype = LINK_COPY
     if opts.verbose:
         print("linktype: %s" % link_name_map[linktype])
 
@@ -14,15 +14,17 @@ FETCH = 'FETCH'
 EXTRACT = 'EXTRACT'
 UNLINK = 'UNLINK'
 LINK = 'LINK'
+UPDATE = 'UPDATE'
 RM_EXTRACTED = 'RM_EXTRACTED'
 RM_FETCHED = 'RM_FETCHED'
 PREFIX = 'PREFIX'
+TARGET_PREFIX = 'TARGET_PREFIX'
 PRINT = 'PRINT'
 PROGRESS = 'PROGRESS'
 SYMLINK_CONDA = 'SYMLINK_CONDA'
 
 
-progress_cmds = set([EXTRACT, RM_EXTRACTED, LINK, UNLINK])
+progress_cmds = set([EXTRACT, RM_EXTRACTED, LINK, UNLINK, UPDATE])
 action_codes = (
     FETCH,
     EXTRACT,
@@ -38,6 +40,10 @@ def PREFIX_CMD(state, arg):
     state['prefix'] = arg
 
 
+def TARGET_PREFIX_CMD(state, arg):
+    state['target_prefix'] = arg
+
+
 def PRINT_CMD(state, arg):
     getLogger('print').info(arg)
 
@@ -73,19 +79,27 @@ def split_linkarg(arg):
 
 def LINK_CMD(state, arg):
     dist, lt = split_linkarg(arg)
-    install.link(state['prefix'], dist, lt, index=state['index'])
+    install.link(state['prefix'], dist, lt, index=state['index'],
+                 target_prefix=state.get('target_prefix'))
 
 
 def UNLINK_CMD(state, arg):
     install.unlink(state['prefix'], arg)
 
 
+def UPDATE_CMD(state, arg):
+    "arg is 'dist linktype old_dist'"
+    dist, lt, old_dist = arg.split()
+    install.update(state['prefix'], old_dist, dist, int(lt), index=state['index'])
+
+
 def SYMLINK_CONDA_CMD(state, arg):
     install.symlink_conda(state['prefix'], arg, find_parent_shell())
 
 # Map instruction to command (a python function)
 commands = {
     PREFIX: PREFIX_CMD,
+    TARGET_PREFIX: TARGET_PREFIX_CMD,
     PRINT: PRINT_CMD,
     FETCH: FETCH_CMD,
     PROGRESS: PROGRESS_CMD,
@@ -94,6 +108,7 @@ commands = {
     RM_FETCHED: RM_FETCHED_CMD,
     LINK: LINK_CMD,
     UNLINK: UNLINK_CMD,
+    UPDATE: UPDATE_CMD,
     SYMLINK_CONDA: SYMLINK_CONDA_CMD,
 }
 
@@ -123,7 +138,7 @@ def execute_instructions(plan, index=None, verbose=False, _commands=None):
 
         if state['i'] is not None and instruction in progress_cmds:
             state['i'] += 1
-            getLogger('progress.update').info((install.name_dist(arg),
+            getLogger('progress.update').info((install.name_dist(arg.split()[0]),
                                                state['i'] - 1))
         cmd = _commands.get(instruction)
 
@@ -138,3 +153,6 @@ def execute_instructions(plan, index=None, verbose=False, _commands=None):
             getLogger('progress.stop').info(None)
 
     install.messages(state['prefix'])
+    install.save_package_access()
+    install.evict_package_caches()
+    install.reap_trash_in_background()
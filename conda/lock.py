@@ -14,18 +14,58 @@ For now, there is one global lock for all of conda, because some things happen
 globally (such as downloading packages).
 
 We don't raise an error if the lock is named with the current PID
+
+The packages of the package caches are locked with FileLock instead (see
+package_lock), which uses fcntl locks: shared ones for reading or linking a
+package, and exclusive ones for writing, extracting or removing it.  Waiting
+for them blocks (instead of polling), and as the operating system releases
+them when their process ends, they can never be stale.
 """
 
+import errno
 import logging
 import os
+import sys
 import time
 
 from conda.exceptions import LockError
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 LOCKFN = '.conda_lock'
+# the directory of the lock files of each package cache (see package_lock)
+LOCKS_DIR = '.locks'
 
 
 stdoutlog = logging.getLogger('stdoutlog')
+log = logging.getLogger(__name__)
+
+
+def pid_running(pid):
+    """
+    Return whether the process `pid` is (or might be) running.
+    """
+    if sys.platform == 'win32':
+        # os.kill() would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def lock_pid(path):
+    """
+    Return the PID of the process the lock directory `path` (of Locked) was
+    created by, or None.
+    """
+    pid = os.path.basename(path)[len(LOCKFN) + 1:]
+    return int(pid) if pid.isdigit() else None
 
 
 class Locked(object):
@@ -68,3 +108,99 @@ class Locked(object):
             os.rmdir(self.path)
         except OSError:
             pass
+
+
+class FileLock(object):
+    """
+    Context manager holding a shared or exclusive lock on the file `path`
+    (which is created when needed).  Waits until the lock can be acquired,
+    or raises LockError right away when `blocking` is False.  Without fcntl
+    (on Windows), nothing is locked.
+    """
+    def __init__(self, path, exclusive=False, blocking=True):
+        self.path = path
+        self.exclusive = exclusive
+        self.blocking = blocking
+        self.fd = None
+
+    def _holder(self):
+        # the PID of the process which last held the lock exclusively
+        try:
+            with open(self.path) as fi:
+                return int(fi.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _open(self):
+        dir_path = os.path.dirname(self.path)
+        if not os.path.isdir(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                if not os.path.isdir(dir_path):
+                    raise
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        op = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        while True:
+            try:
+                fd = self._open()
+            except OSError as e:
+                # nothing is written into read-only package caches anyway
+                if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                    raise
+                log.debug("not locking %s (%s)" % (self.path, e))
+                return
+            try:
+                try:
+                    fcntl.flock(fd, op | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    if not self.blocking:
+                        raise LockError("LOCKERROR: %s is locked (by PID %s)"
+                                        % (self.path, self._holder()))
+                    log.debug("waiting for %s (locked by PID %s)" %
+                              (self.path, self._holder()))
+                    fcntl.flock(fd, op)
+                # the lock file might have been replaced in the meantime
+                if os.path.samestat(os.fstat(fd), os.stat(self.path)):
+                    break
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+        if self.exclusive:
+            os.ftruncate(fd, 0)
+            os.write(fd, ('%d\n' % os.getpid()).encode('ascii'))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            # closing the file releases the lock
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def package_lock(pkgs_dir, name, exclusive=False, blocking=True):
+    """
+    Return the lock (see FileLock) of the package `name` (the tarball and the
+    extracted package, i.e. the filename without .tar.bz2), or of another
+    file of the package cache `pkgs_dir`.
+    """
+    return FileLock(os.path.join(pkgs_dir, LOCKS_DIR, name + '.lock'),
+                    exclusive, blocking)
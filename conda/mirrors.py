@@ -0,0 +1,254 @@
+# (c) 2016 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+"""
+Latency-aware selection among channel mirrors.
+
+A mirror set is declared in .condarc under the ``channel_mirrors`` key,
+mapping a channel base URL to a list of equivalent base URLs:
+
+    channel_mirrors:
+      https://repo.continuum.io/pkgs/free:
+        - http://mirror-a.example.com/pkgs/free
+        - http://mirror-b.example.com/pkgs/free
+
+The channel URL itself is always a member of its own set.  For every
+mirror we keep a moving average of the request latency and of the
+download throughput, along with a count of consecutive failures.  These
+statistics are stored in the package cache (``<pkgs_dir>/cache/mirrors.json``)
+so that later invocations start out routing to the best mirror.
+"""
+from __future__ import print_function, division, absolute_import
+
+import atexit
+import json
+import os
+import threading
+import time
+from logging import getLogger
+from os.path import join
+
+from conda import config
+from conda.compat import iteritems
+
+log = getLogger(__name__)
+
+STATS_FN = 'mirrors.json'
+# weight given to a new sample in the moving averages
+ALPHA = 0.3
+# seconds during which a failed mirror is only used as a last resort
+FAILURE_COOLDOWN = 300
+PROBE_TIMEOUT = 5
+# the statistics are written at most once in this many seconds (and when
+# the process exits)
+SAVE_INTERVAL = 10
+
+_lock = threading.Lock()
+_stats = None
+_last_save = 0
+_unsaved = False
+
+
+def mirror_sets():
+    """
+    Return a dictionary mapping each normalized base URL (with a trailing
+    slash) to the list of all base URLs of its mirror set.
+    """
+    res = {}
+    for channel, mirrors in iteritems(config.get_channel_mirrors()):
+        members = [channel.rstrip('/') + '/']
+        for url in mirrors:
+            url = url.rstrip('/') + '/'
+            if url not in members:
+                members.append(url)
+        for url in members:
+            res[url] = members
+    return res
+
+
+def split_mirror_url(url):
+    """
+    Return tuple(base, members, suffix) for a URL which falls under a
+    mirror set, or (None, [], url) otherwise.
+    """
+    best = None
+    for base, members in iteritems(mirror_sets()):
+        if url.startswith(base) and (best is None or len(base) > len(best[0])):
+            best = base, members
+    if best is None:
+        return None, [], url
+    base, members = best
+    return base, members, url[len(base):]
+
+
+def stats_path():
+    return join(config.pkgs_dirs[0], 'cache', STATS_FN)
+
+
+def load_stats():
+    global _stats
+    if _stats is None:
+        try:
+            with open(stats_path()) as fi:
+                _stats = json.load(fi)
+        except (IOError, ValueError):
+            _stats = {}
+    return _stats
+
+
+def save_stats():
+    global _last_save, _unsaved
+    _last_save = time.time()
+    _unsaved = False
+    path = stats_path()
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'w') as fo:
+            json.dump(_stats, fo, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write mirror statistics %s (%s)" % (path, e))
+
+
+def _changed():
+    # called (holding _lock) after the statistics were changed
+    global _unsaved
+    _unsaved = True
+    if time.time() - _last_save > SAVE_INTERVAL:
+        save_stats()
+
+
+@atexit.register
+def flush_stats():
+    """
+    Write the statistics which were not written yet.
+    """
+    with _lock:
+        if _unsaved:
+            save_stats()
+
+
+def _average(old, new):
+    if old is None:
+        return new
+    return (1 - ALPHA) * old + ALPHA * new
+
+
+def _update(url, **kwargs):
+    base, members, unused_suffix = split_mirror_url(url)
+    if base is None:
+        return
+    with _lock:
+        rec = load_stats().setdefault(base, {})
+        for key, value in iteritems(kwargs):
+            if key in ('latency', 'throughput'):
+                value = _average(rec.get(key), value)
+            rec[key] = value
+        _changed()
+
+
+def record_latency(url, seconds):
+    """
+    Record a successful request to `url`, which took `seconds` until the
+    response headers arrived.
+    """
+    _update(url, latency=seconds, failures=0)
+
+
+def record_throughput(url, nbytes, seconds):
+    """
+    Record that `nbytes` were downloaded from `url` in `seconds`.
+    """
+    if nbytes and seconds > 0:
+        _update(url, throughput=nbytes / seconds)
+
+
+def record_failure(url):
+    """
+    Record a failed request (connection error or server error) to `url`.
+    """
+    base, unused_members, unused_suffix = split_mirror_url(url)
+    if base is None:
+        return
+    with _lock:
+        rec = load_stats().setdefault(base, {})
+        rec['failures'] = rec.get('failures', 0) + 1
+        rec['last_failure'] = time.time()
+        _changed()
+
+
+def is_healthy(base, now=None):
+    rec = load_stats().get(base, {})
+    if not rec.get('failures'):
+        return True
+    return (now or time.time()) - rec.get('last_failure', 0) > FAILURE_COOLDOWN
+
+
+def rank(members):
+    """
+    Order the base URLs of a mirror set best first: healthy mirrors before
+    failing ones, then by latency (unknown latency last), with the
+    throughput as a tie-breaker.
+    """
+    stats = load_stats()
+    now = time.time()
+
+    def key(base):
+        rec = stats.get(base, {})
+        latency = rec.get('latency')
+        return (not is_healthy(base, now),
+                latency is None,
+                latency or 0,
+                -(rec.get('throughput') or 0),
+                members.index(base))
+    return sorted(members, key=key)
+
+
+def probe(members, session):
+    """
+    Measure the latency of all mirrors in `members` for which no statistics
+    are known yet, by sending HEAD requests in parallel.  Mirrors whose
+    probe failed are only probed again after FAILURE_COOLDOWN.
+    """
+    stats = load_stats()
+    now = time.time()
+
+    def probe_(base):
+        start = time.time()
+        try:
+            resp = session.head(base, timeout=PROBE_TIMEOUT,
+                                proxies=session.proxies)
+            if resp.status_code >= 500:
+                raise IOError(resp.status_code)
+        except Exception as e:
+            log.debug("Probing mirror %s failed (%s)" % (base, e))
+            record_failure(base)
+        else:
+            record_latency(base, time.time() - start)
+
+    threads = [threading.Thread(target=probe_, args=(base,))
+               for base in members if 'latency' not in stats.get(base, {}) and
+               is_healthy(base, now)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join(PROBE_TIMEOUT + 1)
+
+
+def mirror_urls(url, session=None):
+    """
+    Return the list of URLs under which `url` is available, ordered from
+    the most to the least preferable mirror.  If `url` does not belong to
+    a mirror set, the list contains only `url` itself.
+    """
+    base, members, suffix = split_mirror_url(url)
+    if base is None:
+        return [url]
+    if session is not None:
+        probe(members, session)
+    return [m + suffix for m in rank(members)]
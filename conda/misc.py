@@ -3,20 +3,28 @@
 
 from __future__ import print_function, division, absolute_import
 
+import codecs
+import hashlib
+import json
 import os
 import re
 import shutil
 import sys
+import tempfile
 from collections import defaultdict
 from os.path import (abspath, basename, dirname, expanduser, exists,
-                     isdir, isfile, islink, join, relpath)
+                     isdir, isfile, islink, join)
 
 from conda import config
 from conda import install
 from conda.api import get_index
-from conda.compat import iteritems
-from conda.instructions import RM_EXTRACTED, EXTRACT, UNLINK, LINK
-from conda.plan import ensure_linked_actions, execute_actions
+from conda.compat import iteritems, scandir
+from conda.history import History
+from conda.instructions import (RM_FETCHED, FETCH, RM_EXTRACTED, EXTRACT,
+                                UNLINK, LINK, SYMLINK_CONDA, PREFIX,
+                                TARGET_PREFIX, execute_instructions,
+                                split_linkarg)
+from conda.plan import ensure_linked_actions, execute_actions, plan_from_actions
 from conda.resolve import Resolve
 
 
@@ -25,10 +33,12 @@ def conda_installed_files(prefix, exclude_self_build=False):
     Return the set of files which have been installed (using conda) into
     a given prefix.
     """
+    if not exclude_self_build:
+        return set(install.file_owners(prefix))
     res = set()
     for dist in install.linked(prefix):
         meta = install.is_linked(prefix, dist)
-        if exclude_self_build and 'file_hash' in meta:
+        if 'file_hash' in meta:
             continue
         res.update(set(meta['files']))
     return res
@@ -55,7 +65,7 @@ url_pat = re.compile(r'(?P<url>.+)/(?P<fn>[^/#]+\.tar\.bz2)'
                      r'(:?#(?P<md5>[0-9a-f]{32}))?$')
 def explicit(urls, prefix, verbose=True):
     import conda.fetch as fetch
-    from conda.utils import md5_file
+    from conda.utils import cached_md5_file
 
     dists = []
     for url in urls:
@@ -77,7 +87,7 @@ def explicit(urls, prefix, verbose=True):
         pkg_path = join(config.pkgs_dirs[0], fn)
         if isfile(pkg_path):
             try:
-                if md5_file(pkg_path) != info['md5']:
+                if cached_md5_file(pkg_path) != info['md5']:
                     install.rm_rf(pkg_path)
                     fetch.fetch_pkg(info)
             except KeyError:
@@ -95,50 +105,161 @@ def rel_path(prefix, path, windows_forward_slashes=True):
     return res
 
 
-def walk_prefix(prefix, ignore_predefined_files=True, windows_forward_slashes=True):
+# the entries at the top of a prefix, and in its bin directory, which are
+# not considered to be files of the environment
+PREFIX_IGNORE = {'pkgs', 'envs', 'conda-bld', 'conda-meta', '.conda_lock',
+                 'users', 'LICENSE.txt', 'info', 'conda-recipes', '.index',
+                 '.unionfs', '.nonadmin'}
+BIN_IGNORE = {'conda', 'activate', 'deactivate'}
+# number of threads walking the top-level directories of a prefix
+WALK_THREADS = 8
+# where untracked() remembers the directories which only contain files of
+# packages (in the subdirectory of conda-meta also used by the prefix state
+# database)
+OWNED_DIRS_FN = join('state', 'owned_dirs.json')
+
+
+def _walk_subtree(prefix, top, ignore_bin, tracked=None, owned_dirs=None):
     """
-    Return the set of all files in a given prefix directory.
+    Return the list of files (relative paths, with forward slashes) below
+    the top-level directory `top` of prefix, and the dictionary of the
+    directories which only contain files for which tracked(path) is true,
+    mapping them to their mtime and their subdirectories.  These files are
+    not returned, and the directories of `owned_dirs` (as returned before)
+    which still have the same mtime are not listed again.
     """
-    res = set()
-    prefix = abspath(prefix)
-    ignore = {'pkgs', 'envs', 'conda-bld', 'conda-meta', '.conda_lock',
-              'users', 'LICENSE.txt', 'info', 'conda-recipes', '.index',
-              '.unionfs', '.nonadmin'}
-    binignore = {'conda', 'activate', 'deactivate'}
-    if sys.platform == 'darwin':
-        ignore.update({'python.app', 'Launcher.app'})
-    for fn in os.listdir(prefix):
-        if ignore_predefined_files and fn in ignore:
+    files = []
+    new_owned_dirs = {}
+    todo = [top]
+    while todo:
+        rel = todo.pop()
+        path = join(prefix, rel)
+        if tracked is not None:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            cached = owned_dirs.get(rel)
+            if cached and cached[0] == mtime:
+                # no entry was added or removed since
+                new_owned_dirs[rel] = cached
+                todo.extend(cached[1])
+                continue
+        try:
+            entries = list(scandir(path))
+        except OSError:
             continue
-        if isfile(join(prefix, fn)):
-            res.add(fn)
+        subdirs = []
+        all_owned = True
+        for entry in entries:
+            f = rel + '/' + entry.name
+            if entry.is_dir() and not entry.is_symlink():
+                subdirs.append(f)
+            elif ignore_bin and rel == 'bin' and entry.name in BIN_IGNORE:
+                continue
+            elif tracked is None or not tracked(f):
+                files.append(f)
+                all_owned = False
+        todo.extend(subdirs)
+        if tracked is not None and all_owned:
+            new_owned_dirs[rel] = [mtime, subdirs]
+    return files, new_owned_dirs
+
+
+def _walk_prefix(prefix, ignore_predefined_files=True, tracked=None, owned_dirs=None):
+    # walk_prefix, walking the top-level directories in parallel, and
+    # skipping the tracked files (see _walk_subtree)
+    ignore = set()
+    if ignore_predefined_files:
+        ignore = PREFIX_IGNORE
+        if sys.platform == 'darwin':
+            ignore = ignore | {'python.app', 'Launcher.app'}
+    files = []
+    tops = []
+    for entry in scandir(prefix):
+        if entry.name in ignore:
             continue
-        for root, dirs, files in os.walk(join(prefix, fn)):
-            should_ignore = ignore_predefined_files and root == join(prefix, 'bin')
-            for fn2 in files:
-                if should_ignore and fn2 in binignore:
-                    continue
-                res.add(relpath(join(root, fn2), prefix))
-            for dn in dirs:
-                path = join(root, dn)
-                if islink(path):
-                    res.add(relpath(path, prefix))
-
-    if sys.platform == 'win32' and windows_forward_slashes:
-        return {path.replace('\\', '/') for path in res}
+        if entry.is_file():
+            if tracked is None or not tracked(entry.name):
+                files.append(entry.name)
+        elif entry.is_dir():
+            tops.append(entry.name)
+
+    def walk(top):
+        return _walk_subtree(prefix, top, ignore_predefined_files,
+                             tracked, owned_dirs or {})
+    try:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(WALK_THREADS)
+    except (ImportError, RuntimeError):
+        results = [walk(top) for top in tops]
     else:
-        return res
+        try:
+            results = list(executor.map(walk, tops))
+        finally:
+            executor.shutdown(wait=True)
+
+    new_owned_dirs = {}
+    for subtree_files, subtree_owned_dirs in results:
+        files.extend(subtree_files)
+        new_owned_dirs.update(subtree_owned_dirs)
+    return files, new_owned_dirs
+
+
+def walk_prefix(prefix, ignore_predefined_files=True, windows_forward_slashes=True):
+    """
+    Return the set of all files in a given prefix directory.
+    """
+    files, unused_owned_dirs = _walk_prefix(abspath(prefix), ignore_predefined_files)
+    if sys.platform == 'win32' and not windows_forward_slashes:
+        return {f.replace('/', '\\') for f in files}
+    return set(files)
+
+
+def _untracked_files(prefix, tracked, key):
+    """
+    Return the files of prefix for which tracked(path) is false, using (and
+    updating) the directories found to only contain tracked files by a
+    previous call with the same key.
+    """
+    path = join(prefix, 'conda-meta', OWNED_DIRS_FN)
+    try:
+        with open(path) as fi:
+            data = json.load(fi)
+        if data.get('key') != key:
+            data = {}
+    except (IOError, ValueError):
+        data = {}
+    files, owned_dirs = _walk_prefix(prefix, tracked=tracked,
+                                     owned_dirs=data.get('dirs'))
+    if owned_dirs != data.get('dirs') and isdir(join(prefix, 'conda-meta')):
+        tmp_path = '%s.%d' % (path, os.getpid())
+        try:
+            if not isdir(dirname(path)):
+                os.makedirs(dirname(path))
+            with open(tmp_path, 'w') as fo:
+                json.dump({'key': key, 'dirs': owned_dirs}, fo)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+    return files
 
 
 def untracked(prefix, exclude_self_build=False):
     """
     Return (the set) of all untracked files for a given prefix.
     """
+    prefix = abspath(prefix)
     conda_files = conda_installed_files(prefix, exclude_self_build)
-    return {path for path in walk_prefix(prefix) - conda_files
-            if not (path.endswith('~') or
-                    (sys.platform == 'darwin' and path.endswith('.DS_Store')) or
-                    (path.endswith('.pyc') and path[:-1] in conda_files))}
+    # the files of packages only change when packages are (un)linked
+    key = hashlib.md5(json.dumps([exclude_self_build, sorted(install.linked(prefix))])
+                      .encode('utf-8')).hexdigest()
+
+    def tracked(path):
+        return (path in conda_files or path.endswith('~') or
+                (sys.platform == 'darwin' and path.endswith('.DS_Store')) or
+                (path.endswith('.pyc') and path[:-1] in conda_files))
+    return set(_untracked_files(prefix, tracked, key))
 
 
 def which_prefix(path):
@@ -167,10 +288,12 @@ def which_package(path):
     prefix = which_prefix(path)
     if prefix is None:
         raise RuntimeError("could not determine conda prefix from: %s" % path)
-    for dist in install.linked(prefix):
-        meta = install.is_linked(prefix, dist)
-        if any(abspath(join(prefix, f)) == path for f in meta['files']):
-            yield dist
+    f = rel_path(prefix, path)
+    dists = install.prefix_state_owners(prefix, f)
+    if dists is None:
+        dists = install.file_owners(prefix).get(f, ())
+    for dist in sorted(dists):
+        yield dist
 
 
 def discard_conda(dists):
@@ -199,45 +322,138 @@ def append_env(prefix):
         pass
 
 
-def clone_env(prefix1, prefix2, verbose=True, quiet=False, index=None):
-    """
-    clone existing prefix1 into new prefix2
-    """
-    untracked_files = untracked(prefix1)
-    dists = discard_conda(install.linked(prefix1))
+# untracked files are cloned using a pool of CLONE_THREADS threads, reading
+# them in chunks of CLONE_CHUNK_SIZE bytes
+CLONE_THREADS = 8
+CLONE_CHUNK_SIZE = 2**20
 
-    if verbose:
-        print('Packages: %d' % len(dists))
-        print('Files: %d' % len(untracked_files))
 
-    for f in untracked_files:
-        src = join(prefix1, f)
+def _contains_prefix(path, a):
+    # whether the file at path is UTF-8 text containing the bytes a
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    found = False
+    # the last k bytes read, which may hold the start of a
+    k = len(a) - 1
+    tail = b''
+    with open(path, 'rb') as fi:
+        while True:
+            chunk = fi.read(CLONE_CHUNK_SIZE)
+            try:
+                decoder.decode(chunk, final=not chunk)
+            except UnicodeDecodeError:  # data is binary
+                return False
+            if not chunk:
+                return found
+            if not found:
+                found = a in chunk or a in tail + chunk[:k]
+                tail = (tail + chunk[-k:])[-k:] if k else b''
+
+
+def _replace_prefix(src, dst, a, b):
+    # copy src to dst, replacing the bytes a by b, without reading all of src
+    # into memory
+    buf = b''
+    with open(src, 'rb') as fi:
+        with open(dst, 'wb') as fo:
+            while True:
+                chunk = fi.read(CLONE_CHUNK_SIZE)
+                parts = (buf + chunk).split(a)
+                buf = parts.pop()
+                for part in parts:
+                    fo.write(part)
+                    fo.write(b)
+                # only the end of buf can be the start of a
+                n = len(buf) - len(a) + 1 if chunk else len(buf)
+                if n > 0:
+                    fo.write(buf[:n])
+                    buf = buf[n:]
+                if not chunk:
+                    break
+    shutil.copystat(src, dst)
+
+
+def _clone_file(src, dst, prefix1, prefix2, caps):
+    # clone the file src into dst, replacing prefix1 by prefix2 if it is a
+    # text file containing it, and otherwise reflinking, hard-linking or
+    # copying it, depending on what caps tells is (still) possible
+    if islink(src):
+        os.symlink(os.readlink(src), dst)
+        return
+    a = prefix1 if isinstance(prefix1, bytes) else prefix1.encode('utf-8')
+    b = prefix2 if isinstance(prefix2, bytes) else prefix2.encode('utf-8')
+    try:
+        contains_prefix = _contains_prefix(src, a)
+    except IOError:  # src cannot be read
+        return
+    if contains_prefix:
+        _replace_prefix(src, dst, a, b)
+        return
+    if caps['reflink']:
+        try:
+            install.reflink(src, dst)
+            return
+        except OSError:
+            caps['reflink'] = False
+    if caps['hard']:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            caps['hard'] = False
+    shutil.copy2(src, dst)
+
+
+def clone_files(prefix1, prefix2, files, always_copy=False):
+    """
+    Clone the (untracked) `files` of prefix1 into prefix2, using a pool of
+    threads.  The text files containing prefix1 are rewritten (in a
+    streaming fashion) with prefix2 instead, while the other files are
+    reflinked, or (unless `always_copy` is True) hard-linked when reflinks
+    are not supported, and only copied otherwise.
+    """
+    jobs = []
+    for f in files:
         dst = join(prefix2, f)
         dst_dir = dirname(dst)
         if islink(dst_dir) or isfile(dst_dir):
             os.unlink(dst_dir)
         if not isdir(dst_dir):
             os.makedirs(dst_dir)
-        if islink(src):
-            os.symlink(os.readlink(src), dst)
-            continue
+        jobs.append((join(prefix1, f), dst))
 
-        try:
-            with open(src, 'rb') as fi:
-                data = fi.read()
-        except IOError:
-            continue
+    caps = {'reflink': True,
+            'hard': not (always_copy or config.always_copy or
+                         sys.platform == 'win32')}
+
+    def clone(job):
+        _clone_file(job[0], job[1], prefix1, prefix2, caps)
 
+    try:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(CLONE_THREADS)
+    except (ImportError, RuntimeError):
+        for job in jobs:
+            clone(job)
+    else:
         try:
-            s = data.decode('utf-8')
-            s = s.replace(prefix1, prefix2)
-            data = s.encode('utf-8')
-        except UnicodeDecodeError:  # data is binary
-            pass
+            list(executor.map(clone, jobs))
+        finally:
+            executor.shutdown(wait=True)
 
-        with open(dst, 'wb') as fo:
-            fo.write(data)
-        shutil.copystat(src, dst)
+
+def clone_env(prefix1, prefix2, verbose=True, quiet=False, index=None,
+              always_copy=False):
+    """
+    clone existing prefix1 into new prefix2
+    """
+    untracked_files = untracked(prefix1)
+    dists = discard_conda(install.linked(prefix1))
+
+    if verbose:
+        print('Packages: %d' % len(dists))
+        print('Files: %d' % len(untracked_files))
+
+    clone_files(prefix1, prefix2, untracked_files, always_copy)
 
     if index is None:
         index = get_index()
@@ -245,12 +461,142 @@ def clone_env(prefix1, prefix2, verbose=True, quiet=False, index=None):
     r = Resolve(index)
     sorted_dists = r.dependency_sort(dists)
 
-    actions = ensure_linked_actions(sorted_dists, prefix2)
+    actions = ensure_linked_actions(sorted_dists, prefix2,
+                                    always_copy=always_copy)
     execute_actions(actions, index=index, verbose=not quiet)
 
     return actions, untracked_files
 
 
+def copy_files(prefix1, prefix2, files):
+    """
+    Copy `files` (paths relative to prefix1) from prefix1 to prefix2,
+    keeping symbolic links as they are.
+    """
+    for f in files:
+        src = join(prefix1, f)
+        dst = join(prefix2, f)
+        dst_dir = dirname(dst)
+        if not isdir(dst_dir):
+            os.makedirs(dst_dir)
+        try:
+            if islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                shutil.copy2(src, dst)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Warning: could not copy %s: %s\n" % (src, e))
+
+
+def swap_prefix(prefix, staging):
+    """
+    Replace the environment `prefix` by the directory `staging`, which is
+    next to the real path of `prefix`.  When `prefix` is a symbolic link, it
+    is atomically pointed to `staging`, otherwise `prefix` is renamed into
+    the trash and `staging` renamed to `prefix`.  The old environment is
+    deleted in the background.
+    """
+    old = os.path.realpath(prefix)
+    install.save_file_owners(staging)
+    if islink(prefix):
+        tmp_link = '%s.conda-swap-%d' % (prefix, os.getpid())
+        os.symlink(staging, tmp_link)
+        os.rename(tmp_link, prefix)
+        trash_dir = install.rename_to_trash(old)
+    else:
+        trash_dir = install.rename_to_trash(prefix)
+        if trash_dir is None:
+            install.rm_rf(staging)
+            sys.exit("Error: could not move %s out of the way" % prefix)
+        os.rename(staging, prefix)
+    install.linked_data_.pop(prefix, None)
+    install.linked_data_.pop(staging, None)
+    install.forget_file_owners(prefix)
+    install.forget_file_owners(staging)
+    if trash_dir is None or not install.delete_in_background(trash_dir):
+        install.rm_rf(trash_dir or old)
+
+
+def swap_execute_actions(actions, index=None, verbose=False):
+    """
+    Execute `actions` by building the resulting environment in a staging
+    directory next to the prefix, which is then swapped with the prefix
+    (see swap_prefix), such that processes using the environment never see
+    it partially updated.  The packages which stay installed are linked
+    again from the package cache, and the untracked files, as well as the
+    files of these packages which were modified in the prefix, are copied.
+    The packages which stay installed but are not in the package cache
+    (e.g. local builds), or were linked without a manifest (such that their
+    modified files cannot be found), are copied from the prefix as well.
+    The pre-unlink scripts of the removed packages are run just before the
+    swap, and the post-link scripts of the new packages right after it,
+    such that they all see the real prefix as PREFIX.
+
+    The root environment (which contains the package cache) and
+    environments on Windows (where directories which are in use cannot be
+    renamed) are updated in place, using execute_actions.
+    """
+    prefix = abspath(actions[PREFIX])
+    if (sys.platform == 'win32' or not isdir(prefix) or
+            abspath(config.root_dir) == prefix):
+        return execute_actions(actions, index=index, verbose=verbose)
+
+    unlink = set(actions.get(UNLINK, []))
+    keep = [dist for dist in install.linked(prefix) if dist not in unlink]
+    copied = [dist for dist in keep if not install.is_extracted(dist) or
+              not (install.load_meta(prefix, dist) or {}).get('manifest')]
+    relinked = [dist for dist in keep if dist not in copied]
+    real_prefix = os.path.realpath(prefix)
+    with install.Locked(prefix), History(prefix):
+        staging = tempfile.mkdtemp(prefix='.%s.conda-' % basename(real_prefix),
+                                   dir=dirname(real_prefix))
+        try:
+            staged = ensure_linked_actions(relinked, staging, index=index)
+            for op in (RM_FETCHED, FETCH, RM_EXTRACTED, EXTRACT, LINK,
+                       SYMLINK_CONDA):
+                staged[op].extend(arg for arg in actions.get(op, [])
+                                  if arg not in staged[op])
+            staged['op_order'] += (SYMLINK_CONDA,)
+            staged[TARGET_PREFIX] = prefix
+
+            files = untracked(prefix)
+            meta_dir = join(prefix, 'conda-meta')
+            files.update(join('conda-meta', fn) for fn in os.listdir(meta_dir)
+                         if not fn.endswith('.json') and isfile(join(meta_dir, fn)))
+            files.update(join('bin', fn) for fn in ('conda', 'activate', 'deactivate')
+                         if islink(join(prefix, 'bin', fn)))
+            for dist in copied:
+                files.update(install.load_meta(prefix, dist)['files'])
+                files.add(join('conda-meta', dist.split('::', 1)[-1] + '.json'))
+            copy_files(prefix, staging, files)
+
+            execute_instructions(plan_from_actions(staged), index, verbose)
+
+            # keep the changes made to the files of the packages which stay
+            # (the linked files may be hard links into the package cache)
+            modified = install.verify_files(prefix, relinked)
+            for dist, f, problem in modified:
+                if os.path.lexists(join(staging, f)):
+                    os.unlink(join(staging, f))
+            copy_files(prefix, staging, [f for dist, f, problem in modified
+                                         if problem != 'missing'])
+        except BaseException:
+            install.linked_data_.pop(staging, None)
+            install.rm_rf(staging)
+            raise
+
+        for dist in sorted(unlink):
+            install.run_script(prefix, dist, 'pre-unlink')
+            install.mk_menus(prefix, install.load_meta(prefix, dist)['files'],
+                             remove=True)
+        swap_prefix(prefix, staging)
+        for arg in actions.get(LINK, []):
+            dist = split_linkarg(arg)[0]
+            install.mk_menus(prefix, install.load_meta(prefix, dist)['files'])
+            if not install.run_script(prefix, dist, 'post-link'):
+                sys.exit("Error: post-link failed for: %s" % dist)
+
+
 def install_local_packages(prefix, paths, verbose=False):
     # copy packages to pkgs dir
     pkgs_dir = config.pkgs_dirs[0]
@@ -11,7 +11,6 @@ NOTE:
 from __future__ import print_function, division, absolute_import
 
 import sys
-import os
 from logging import getLogger
 from collections import defaultdict
 from os.path import abspath, basename, dirname, join, exists
@@ -20,7 +19,7 @@ from conda import config
 from conda import install
 from conda.history import History
 from conda.resolve import MatchSpec, Resolve, Package
-from conda.utils import md5_file, human_bytes
+from conda.utils import cached_md5_file, human_bytes
 from conda import instructions as inst
 from conda.exceptions import CondaException
 
@@ -208,7 +207,34 @@ def add_unlink(actions, dist):
     actions[inst.UNLINK].append(dist)
 
 
+def staged_update_actions(actions):
+    """
+    Return a copy of `actions` in which each package which is unlinked and
+    linked again (in another version) is updated in place instead.
+    """
+    unlink = {install.name_dist(dist): dist for dist in actions.get(inst.UNLINK, [])}
+    res = defaultdict(list, actions)
+    res[inst.UNLINK] = list(actions.get(inst.UNLINK, []))
+    res[inst.LINK] = []
+    for arg in actions.get(inst.LINK, []):
+        dist, lt = inst.split_linkarg(arg)
+        old_dist = unlink.get(install.name_dist(dist))
+        if old_dist is None:
+            res[inst.LINK].append(arg)
+            continue
+        res[inst.UNLINK].remove(old_dist)
+        res[inst.UPDATE].append('%s %d %s' % (dist, lt, old_dist))
+    if res[inst.UPDATE]:
+        op_order = list(actions.get('op_order') or inst.action_codes)
+        op_order.insert(op_order.index(inst.LINK), inst.UPDATE)
+        res['op_order'] = tuple(op_order)
+    return res
+
+
 def plan_from_actions(actions):
+    if config.staged_updates and sys.platform != 'win32':
+        actions = staged_update_actions(actions)
+
     if 'op_order' in actions and actions['op_order']:
         op_order = actions['op_order']
     else:
@@ -216,6 +242,8 @@ def plan_from_actions(actions):
 
     assert inst.PREFIX in actions and actions[inst.PREFIX]
     res = [('PREFIX', '%s' % actions[inst.PREFIX])]
+    if actions.get(inst.TARGET_PREFIX):
+        res.append((inst.TARGET_PREFIX, actions[inst.TARGET_PREFIX]))
 
     if sys.platform == 'win32':
         # Always link/unlink menuinst first on windows in case a subsequent
@@ -236,7 +264,9 @@ def plan_from_actions(actions):
             continue
         if not actions[op]:
             continue
-        if '_' not in op:
+        if op == inst.UPDATE:
+            res.append((inst.PRINT, 'Updating packages ...'))
+        elif '_' not in op:
             res.append((inst.PRINT, '%sing packages ...' % op.capitalize()))
         if op in inst.progress_cmds:
             res.append((inst.PROGRESS, '%d' % len(actions[op])))
@@ -260,7 +290,7 @@ def ensure_linked_actions(dists, prefix, index=None, force=False, always_copy=Fa
             # Test the MD5, and possibly re-fetch
             fn = dist + '.tar.bz2'
             try:
-                if md5_file(fetched_in) != index[fn]['md5']:
+                if cached_md5_file(fetched_in) != index[fn]['md5']:
                     # RM_FETCHED now removes the extracted data too
                     actions[inst.RM_FETCHED].append(dist)
                     # Re-fetch, re-extract, re-link
@@ -293,33 +323,25 @@ def ensure_linked_actions(dists, prefix, index=None, force=False, always_copy=Fa
 
         try:
             # Determine what kind of linking is necessary
-            if not extracted_in:
-                # If not already extracted, create some dummy
-                # data to test with
-                install.rm_rf(fetched_dist)
-                ppath = join(fetched_dist, 'info')
-                os.makedirs(ppath)
-                index_json = join(ppath, 'index.json')
-                with open(index_json, 'w'):
-                    pass
+            caps = install.link_capabilities(fetched_dir, prefix)
             if config.always_copy or always_copy:
-                lt = install.LINK_COPY
-            elif install.try_hard_link(fetched_dir, prefix, dist):
+                # reflinks are copies which share no data until modified
+                if caps['reflink']:
+                    lt = install.LINK_REFLINK
+                else:
+                    lt = install.LINK_COPY
+            elif caps['hard']:
                 lt = install.LINK_HARD
-            elif config.allow_softlinks and sys.platform != 'win32':
+            elif caps['reflink']:
+                lt = install.LINK_REFLINK
+            elif (config.allow_softlinks and sys.platform != 'win32' and
+                    caps['soft']):
                 lt = install.LINK_SOFT
             else:
                 lt = install.LINK_COPY
             actions[inst.LINK].append('%s %d' % (dist, lt))
         except (OSError, IOError):
             actions[inst.LINK].append(dist)
-        finally:
-            if not extracted_in:
-                # Remove the dummy data
-                try:
-                    install.rm_rf(fetched_dist)
-                except (OSError, IOError):
-                    pass
 
     return actions
 
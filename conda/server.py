@@ -0,0 +1,285 @@
+# (c) 2016 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+"""
+Serve package caches as a conda channel over HTTP.
+
+The tarballs found in one or more package caches are served under
+/<subdir>/<fn>, and /<subdir>/repodata.json(.bz2) is generated on the fly
+from the info/index.json of each cached package.  When an upstream
+channel is given, the server acts as a pull-through mirror: its
+repodata is merged into the generated one, and packages which are not
+cached yet are downloaded (once) into the first package cache before they
+are served.
+"""
+from __future__ import print_function, division, absolute_import
+
+import bz2
+import json
+import os
+import shutil
+import tarfile
+import threading
+import time
+from logging import getLogger
+from os.path import isdir, isfile, join
+
+from conda import config
+from conda.compat import PY3, iteritems
+from conda.utils import cached_md5_file
+
+if PY3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+log = getLogger(__name__)
+
+CHUNK_SIZE = 2**16
+# seconds during which the repodata of the upstream channel is reused
+UPSTREAM_TTL = 60
+
+
+def read_urls(pkgs_dir):
+    """
+    Return a dictionary mapping the package filenames listed in the
+    urls.txt of `pkgs_dir` to their URLs.
+    """
+    res = {}
+    try:
+        with open(join(pkgs_dir, 'urls.txt')) as fi:
+            for url in fi.read().split():
+                res[url.rsplit('/', 1)[-1]] = url
+    except IOError:
+        pass
+    return res
+
+
+def read_index_json(pkgs_dir, fn):
+    """
+    Return the info/index.json of the package `fn`, taken from its extracted
+    directory when available, and otherwise from the tarball itself.
+    """
+    path = join(pkgs_dir, fn[:-8], 'info', 'index.json')
+    if isfile(path):
+        with open(path) as fi:
+            return json.load(fi)
+    t = tarfile.open(join(pkgs_dir, fn))
+    try:
+        return json.loads(t.extractfile('info/index.json').read().decode('utf-8'))
+    finally:
+        t.close()
+
+
+class PackageCacheIndex(object):
+    """
+    The repodata of a set of package caches.  The metadata of each tarball
+    is kept in memory and only recomputed when the tarball changes.
+    """
+    def __init__(self, pkgs_dirs):
+        self.pkgs_dirs = list(pkgs_dirs)
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def _record(self, pkgs_dir, fn, url):
+        path = join(pkgs_dir, fn)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+        cached = self._records.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        info = read_index_json(pkgs_dir, fn)
+        info['md5'] = cached_md5_file(path)
+        info['size'] = st.st_size
+        subdir = info.get('subdir')
+        if not subdir:
+            if url and '/' in url:
+                subdir = url.rsplit('/', 2)[-2]
+            else:
+                subdir = config.subdir
+        rec = subdir, info
+        self._records[path] = key, rec
+        return rec
+
+    def packages(self, subdir):
+        """
+        Return a dictionary mapping filenames to (pkgs_dir, info) for all
+        cached tarballs of `subdir`.
+        """
+        res = {}
+        with self._lock:
+            for pkgs_dir in self.pkgs_dirs:
+                if not isdir(pkgs_dir):
+                    continue
+                urls = read_urls(pkgs_dir)
+                for fn in os.listdir(pkgs_dir):
+                    if not fn.endswith('.tar.bz2') or fn in res:
+                        continue
+                    try:
+                        subdir_, info = self._record(pkgs_dir, fn, urls.get(fn))
+                    except (IOError, OSError, ValueError, KeyError,
+                            tarfile.TarError) as e:
+                        log.debug("skipping %s: %s" % (join(pkgs_dir, fn), e))
+                        continue
+                    if subdir_ == subdir:
+                        res[fn] = pkgs_dir, info
+        return res
+
+    def find(self, subdir, fn):
+        """
+        Return the path of the cached tarball `fn` of `subdir`, or None.
+        """
+        with self._lock:
+            for pkgs_dir in self.pkgs_dirs:
+                path = join(pkgs_dir, fn)
+                if not isfile(path):
+                    continue
+                try:
+                    subdir_, unused_info = self._record(
+                        pkgs_dir, fn, read_urls(pkgs_dir).get(fn))
+                except (IOError, OSError, ValueError, KeyError,
+                        tarfile.TarError) as e:
+                    log.debug("skipping %s: %s" % (path, e))
+                    continue
+                if subdir_ == subdir:
+                    return path
+        return None
+
+    def repodata(self, subdir, upstream_repodata=None):
+        packages = {}
+        if upstream_repodata:
+            packages.update(upstream_repodata.get('packages', {}))
+        for fn, (unused_pkgs_dir, info) in iteritems(self.packages(subdir)):
+            packages[fn] = info
+        return {'info': {'subdir': subdir}, 'packages': packages}
+
+
+class ChannelServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pkgs_dirs, upstream=None):
+        HTTPServer.__init__(self, address, ChannelRequestHandler)
+        self.index = PackageCacheIndex(pkgs_dirs)
+        self.upstream = upstream.rstrip('/') + '/' if upstream else None
+        # the locks of the files being fetched from upstream
+        self._fetch_locks = {}
+        self._lock = threading.Lock()
+        self._upstream_repodatas = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def upstream_repodata(self, subdir):
+        if not self.upstream:
+            return None
+        cached = self._upstream_repodatas.get(subdir)
+        if cached and time.time() - cached[0] < UPSTREAM_TTL:
+            return cached[1]
+        from conda.fetch import fetch_repodata
+        repodata = fetch_repodata('%s%s/' % (self.upstream, subdir))
+        self._upstream_repodatas[subdir] = time.time(), repodata
+        return repodata
+
+    def pull_through(self, subdir, fn):
+        """
+        Download `fn` from the upstream channel into the first package cache
+        (recording it in urls.txt), and return its path.
+        """
+        if not self.upstream:
+            return None
+        from conda.fetch import download
+
+        with self._lock:
+            lock = self._fetch_locks.setdefault((subdir, fn), threading.Lock())
+        with lock:
+            path = self.index.find(subdir, fn)
+            if path:
+                return path
+            repodata = self.upstream_repodata(subdir) or {}
+            info = repodata.get('packages', {}).get(fn)
+            if info is None:
+                return None
+            url = '%s%s/%s' % (self.upstream, subdir, fn)
+            path = join(self.index.pkgs_dirs[0], fn)
+            if isfile(path):
+                # the package cache is not split by subdir
+                log.info("cannot fetch %s: %s of another subdir is cached" %
+                         (url, path))
+                return None
+            log.info("fetching %s from upstream" % fn)
+            download(url, path, md5=info.get('md5'), urlstxt=True)
+            return path
+
+
+class ChannelRequestHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) != 2:
+            return self.send_error(404)
+        subdir, fn = parts
+        try:
+            if fn in ('repodata.json', 'repodata.json.bz2'):
+                repodata = self.server.index.repodata(
+                    subdir, self.server.upstream_repodata(subdir))
+                data = json.dumps(repodata, indent=2,
+                                  sort_keys=True).encode('utf-8')
+                if fn.endswith('.bz2'):
+                    data = bz2.compress(data)
+                return self.send_data(data, head)
+            if fn.endswith('.tar.bz2'):
+                path = (self.server.index.find(subdir, fn) or
+                        self.server.pull_through(subdir, fn))
+                if path:
+                    return self.send_file(path, head)
+        except (IOError, OSError, RuntimeError) as e:
+            log.debug("error serving %s: %s" % (self.path, e))
+            return self.send_error(500, str(e))
+        self.send_error(404)
+
+    def send_data(self, data, head):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def send_file(self, path, head):
+        with open(path, 'rb') as fi:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length', str(os.fstat(fi.fileno()).st_size))
+            self.end_headers()
+            if not head:
+                shutil.copyfileobj(fi, self.wfile, CHUNK_SIZE)
+
+    def log_message(self, fmt, *args):
+        log.info("%s - %s" % (self.address_string(), fmt % args))
+
+
+def make_server(pkgs_dirs, host='', port=8008, upstream=None):
+    return ChannelServer((host, port), pkgs_dirs, upstream=upstream)
+
+
+def serve(pkgs_dirs, host='', port=8008, upstream=None):
+    server = make_server(pkgs_dirs, host, port, upstream)
+    print("Serving %s on %s" % (', '.join(pkgs_dirs), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,241 @@
+# (c) 2016 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+"""
+Repodata sharded by package name.
+
+In addition to repodata.json.bz2, a channel subdir may provide:
+
+    repodata_shards.json.bz2    {"info": {...},
+                                 "shards": {"<name>": "shards/<name>.json.bz2"}}
+    shards/<name>.json.bz2      {"packages": {"<fn>": {...}}}
+
+When sharded_repodata is enabled, fetch_index (given the names of the
+requested packages) only fetches the shards of the names which can be
+reached through the dependencies of these packages, instead of the
+complete repodata.  Each shard is cached separately, with its own etag.
+Channels which do not provide a manifest are fetched in full.
+
+To shard an existing channel subdir (containing repodata.json):
+
+    python -m conda.shards <subdir>
+"""
+from __future__ import print_function, division, absolute_import
+
+import bz2
+import json
+import os
+import sys
+from logging import getLogger
+from os.path import isdir, isfile, join
+
+import requests
+
+from conda import config
+from conda.compat import iteritems, itervalues
+from conda.connection import CondaSession
+
+log = getLogger(__name__)
+
+MANIFEST_FN = 'repodata_shards.json.bz2'
+
+
+def shard_fn(name):
+    return 'shards/%s.json.bz2' % name
+
+
+def shard_repodata(repodata):
+    """
+    Split `repodata` by package name, and return the tuple (manifest,
+    shards), where shards maps the filename of each shard to its content.
+    """
+    groups = {}
+    for fn, info in iteritems(repodata.get('packages', {})):
+        groups.setdefault(info['name'], {})[fn] = info
+    manifest = {'info': repodata.get('info', {}), 'shards': {}}
+    shards = {}
+    for name, packages in iteritems(groups):
+        manifest['shards'][name] = shard_fn(name)
+        shards[shard_fn(name)] = {'packages': packages}
+    return manifest, shards
+
+
+def write_shards(repodata, dir_path):
+    """
+    Write the sharded layout of `repodata` into the subdir `dir_path`.
+    """
+    manifest, shards = shard_repodata(repodata)
+    if not isdir(join(dir_path, 'shards')):
+        os.makedirs(join(dir_path, 'shards'))
+    for fn, data in iteritems(shards):
+        _write_bz2_json(join(dir_path, fn), data)
+    # the manifest is written last, such that clients never see a manifest
+    # pointing to missing shards
+    _write_bz2_json(join(dir_path, MANIFEST_FN), manifest)
+    return manifest
+
+
+def _write_bz2_json(path, data):
+    with open(path, 'wb') as fo:
+        fo.write(bz2.compress(json.dumps(data, indent=2, sort_keys=True)
+                              .encode('utf-8')))
+
+
+def depends_names(info):
+    """
+    Return the names of the packages `info` depends on.
+    """
+    names = {spec.split()[0] for spec in info.get('depends', [])}
+    if (config.add_pip_as_python_dependency and info['name'] == 'python' and
+            info['version'].startswith(('2.', '3.'))):
+        names.add('pip')
+    return names
+
+
+def fetch_json(url, cache_dir=None, use_cache=False, session=None):
+    """
+    Fetch the bz2 compressed JSON document `url`, which is cached (and
+    revalidated using its etag) in the repodata cache.  Returns None when
+    the document does not exist.
+    """
+    from conda.fetch import (add_http_value_to_dict, cache_fn_url,
+                             create_cache_dir, get_from_mirrors)
+
+    session = session or CondaSession()
+    cache_path = join(cache_dir or create_cache_dir(), cache_fn_url(url))
+    try:
+        with open(cache_path) as fi:
+            cache = json.load(fi)
+    except (IOError, ValueError):
+        cache = None
+
+    if use_cache:
+        return cache
+
+    headers = {}
+    if cache and '_etag' in cache:
+        headers['If-None-Match'] = cache['_etag']
+    if cache and '_mod' in cache:
+        headers['If-Modified-Since'] = cache['_mod']
+
+    try:
+        # streaming, as the body of a missing file: URL cannot be read
+        resp = get_from_mirrors(session, url, headers=headers,
+                                proxies=session.proxies, stream=True)
+        if resp.status_code in (403, 404):
+            return None
+        resp.raise_for_status()
+        if resp.status_code == 304:
+            return cache
+        cache = json.loads(bz2.decompress(resp.content).decode('utf-8'))
+    except (ValueError, IOError) as e:
+        raise RuntimeError("Invalid index file: %s: %s" %
+                           (config.remove_binstar_tokens(url), e))
+    except requests.exceptions.HTTPError as e:
+        msg = "HTTPError: %s: %s\n" % (e, config.remove_binstar_tokens(url))
+        log.debug(msg)
+        raise RuntimeError(msg)
+    except requests.exceptions.ConnectionError as e:
+        log.debug("Connection error: %s: %s, using cached %s" %
+                  (e, config.remove_binstar_tokens(url), cache_path))
+        return cache
+
+    add_http_value_to_dict(resp, 'Etag', cache, '_etag')
+    add_http_value_to_dict(resp, 'Last-Modified', cache, '_mod')
+    try:
+        with open(cache_path, 'w') as fo:
+            json.dump(cache, fo)
+    except IOError:
+        pass
+    return cache
+
+
+def _map(func, items):
+    try:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(10)
+    except (ImportError, RuntimeError):
+        return [func(item) for item in items]
+    try:
+        return list(executor.map(func, items))
+    finally:
+        executor.shutdown(wait=True)
+
+
+def fetch_sharded_repodatas(channel_urls, names, use_cache=False):
+    """
+    Return a list of (url, repodata) for the channels `channel_urls`, where
+    the repodata of the channels providing shards only contain the packages
+    reachable from `names`.
+    """
+    from conda.fetch import fetch_repodata
+
+    session = CondaSession()
+    urls = list(channel_urls)
+    manifests = dict(zip(urls, _map(
+        lambda url: fetch_json(url + MANIFEST_FN, use_cache=use_cache,
+                               session=session), urls)))
+    repodatas = {}
+    for url in urls:
+        if manifests[url] is None:
+            log.debug("no shards for %s, fetching all repodata" % url)
+            repodatas[url] = fetch_repodata(url, use_cache=use_cache,
+                                            session=session)
+        else:
+            repodatas[url] = {'packages': {},
+                              'info': manifests[url].get('info', {}),
+                              '_url': config.remove_binstar_tokens(url)}
+
+    seen = set()
+    todo = set(names)
+    while todo:
+        seen.update(todo)
+        jobs = [(url, manifests[url]['shards'][name])
+                for url in urls if manifests[url]
+                for name in sorted(todo) if name in manifests[url]['shards']]
+        shards = _map(
+            lambda job: fetch_json(job[0] + job[1], use_cache=use_cache,
+                                   session=session), jobs)
+        infos = []
+        for (url, fn), shard in zip(jobs, shards):
+            if shard is None:
+                log.debug("missing shard %s%s" % (url, fn))
+                continue
+            repodatas[url]['packages'].update(shard['packages'])
+            infos.extend(itervalues(shard['packages']))
+        for url in urls:
+            if manifests[url] is None and repodatas[url]:
+                infos.extend(info for info in
+                             itervalues(repodatas[url]['packages'])
+                             if info['name'] in todo)
+        todo = set()
+        for info in infos:
+            todo.update(depends_names(info))
+        todo -= seen
+
+    log.debug("fetched the shards of %d names" % len(seen))
+    return [(url, repodatas[url]) for url in urls]
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python -m conda.shards SUBDIR")
+    dir_path = sys.argv[1]
+    path = join(dir_path, 'repodata.json')
+    if isfile(path):
+        with open(path) as fi:
+            repodata = json.load(fi)
+    elif isfile(path + '.bz2'):
+        with open(path + '.bz2', 'rb') as fi:
+            repodata = json.loads(bz2.decompress(fi.read()).decode('utf-8'))
+    else:
+        sys.exit("Error: no repodata.json in %s" % dir_path)
+    manifest = write_shards(repodata, dir_path)
+    print("wrote %d shards to %s" % (len(manifest['shards']),
+                                     join(dir_path, 'shards')))
+
+
+if __name__ == '__main__':
+    main()
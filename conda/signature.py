@@ -33,10 +33,12 @@ class SignatureError(Exception):
     pass
 
 
-def verify(path):
+def verify(path, hash=None):
     """
     Verify the file `path`, with signature `path`.sig, against the key
-    found under ~/.conda/keys/<key_name>.pub.  This function returns:
+    found under ~/.conda/keys/<key_name>.pub.  When the SHA256 `hash` of
+    the file is already known (e.g. computed while downloading it), the
+    file is not read again.  This function returns:
       - True, if the signature is valid
       - False, if the signature is invalid
     It raises SignatureError when the signature file, or the public key
@@ -54,4 +56,6 @@ def verify(path):
         KEYS[key_name] = RSA.importKey(open(key_path).read())
     key = KEYS[key_name]
     verifier = PKCS1_PSS.new(key)
-    return verifier.verify(hash_file(path), base64.b64decode(sig))
+    if hash is None:
+        hash = hash_file(path)
+    return verifier.verify(hash, base64.b64decode(sig))
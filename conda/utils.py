@@ -4,8 +4,9 @@ import logging
 import sys
 import hashlib
 import collections
+import json
 from functools import partial
-from os.path import abspath, isdir, join
+from os.path import abspath, basename, dirname, isdir, join
 import os
 import re
 import subprocess
@@ -143,6 +144,70 @@ def md5_file(path):
     return hashsum_file(path, 'md5')
 
 
+# Digests of files which have been verified before, so that (large) package
+# tarballs are not read again.  The digests of the files in a directory are
+# kept in <dir>/cache/digests.json, and are only valid as long as the
+# (size, mtime, inode) of the file is unchanged.
+
+_digests_ = {}
+
+
+def _digests_path(dir_path):
+    return join(dir_path, 'cache', 'digests.json')
+
+
+def _load_digests(dir_path):
+    digests = _digests_.get(dir_path)
+    if digests is None:
+        try:
+            with open(_digests_path(dir_path)) as fi:
+                digests = json.load(fi)
+        except (IOError, ValueError):
+            digests = {}
+        _digests_[dir_path] = digests
+    return digests
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def record_md5(path, md5):
+    """
+    Remember `md5` as the verified digest of the file `path`.
+    """
+    path = abspath(path)
+    digests = _load_digests(dirname(path))
+    try:
+        digests[basename(path)] = _file_key(path) + [md5]
+    except OSError:
+        return
+    cache_path = _digests_path(dirname(path))
+    tmp_path = '%s.%d' % (cache_path, os.getpid())
+    try:
+        if not isdir(dirname(cache_path)):
+            os.makedirs(dirname(cache_path))
+        with open(tmp_path, 'w') as fo:
+            json.dump(digests, fo)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write %s (%s)" % (cache_path, e))
+
+
+def cached_md5_file(path):
+    """
+    Same as md5_file, but reuses the digest recorded for an unchanged file.
+    """
+    path = abspath(path)
+    rec = _load_digests(dirname(path)).get(basename(path))
+    if rec and rec[:3] == _file_key(path):
+        return rec[3]
+    md5 = md5_file(path)
+    record_md5(path, md5)
+    return md5
+
+
 def url_path(path):
     path = abspath(path)
     if sys.platform == 'win32':
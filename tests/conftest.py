@@ -1,5 +1,9 @@
 import sys
 
+import pytest
+
+from conda import install
+
 win_default_shells = ["cmd.exe", "powershell", "git_bash", "cygwin"]
 shells = ["bash", "zsh"]
 
@@ -13,3 +17,42 @@ def pytest_addoption(parser):
 def pytest_generate_tests(metafunc):
     if 'shell' in metafunc.fixturenames:
         metafunc.parametrize("shell", metafunc.config.option.shell)
+
+
+@pytest.fixture
+def synthetic_package(tmpdir, monkeypatch):
+    """
+    Return a function creating an extracted package with `n` text and `n`
+    binary files containing placeholders, in a fresh package cache.
+    """
+    pkgs_dir = tmpdir.mkdir('pkgs')
+    monkeypatch.setattr(install.config, 'pkgs_dirs', [pkgs_dir.strpath])
+    monkeypatch.setattr(install, 'package_cache_', {})
+    monkeypatch.setattr(install, 'fname_table', {})
+
+    def make(n, dist='synthetic-1.0-0', placeholder='/opt/' + 'placehold' * 30):
+        pkg = pkgs_dir.mkdir(dist)
+        ph = placeholder.encode('utf-8')
+        files = []
+        has_prefix = []
+        for i in range(n):
+            f = 'bin/script%d' % i
+            pkg.join(f).write_binary(b'#!' + ph + b'/bin/python\nx = 1\n' * 50,
+                                     ensure=True)
+            files.append(f)
+            has_prefix.append('%s text %s' % (placeholder, f))
+            f = 'lib/lib%d.so' % i
+            pkg.join(f).write_binary(b'\x7fELF' + b'\0' * 1000 + ph +
+                                     b'/lib\0' + b'\xff' * 1000, ensure=True)
+            files.append(f)
+            has_prefix.append('%s binary %s' % (placeholder, f))
+        pkg.join('info', 'files').write('\n'.join(files), ensure=True)
+        pkg.join('info', 'has_prefix').write('\n'.join(has_prefix))
+        pkg.join('info', 'index.json').write('{}')
+        install.write_prefix_offsets(pkg.strpath)
+        install.add_cached_package(pkgs_dir.strpath,
+                                   'http://example.com/channel/%s' % dist)
+        # the dist, as prefixed with its channel
+        dist, = [d for d in install.package_cache() if d.endswith(dist)]
+        return dist, files
+    return make
@@ -0,0 +1,179 @@
+import threading
+from contextlib import contextmanager
+
+import pytest
+import requests
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from conda.connection import CachingAdapter
+
+
+@contextmanager
+def etag_server(files):
+    """
+    Serve the bytes in the `files` dictionary, with Etags derived from
+    their content.  Return the base URL and the list of requests, as tuples
+    (path, status code).
+    """
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = files.get(self.path)
+            if body is None:
+                hits.append((self.path, 404))
+                self.send_error(404)
+                return
+            etag = '"%d"' % hash(body)
+            if self.headers.get('If-None-Match') == etag:
+                hits.append((self.path, 304))
+                self.send_response(304)
+                self.end_headers()
+                return
+            hits.append((self.path, 200))
+            self.send_response(200)
+            self.send_header('Etag', etag)
+            # bodies ending with "..." are truncated
+            self.send_header('Content-Length',
+                             str(len(body) + 10 * body.endswith(b'...')))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1], hits
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def caching_session(cache_dir, max_size=None):
+    session = requests.Session()
+    session.trust_env = False
+    adapter = CachingAdapter(requests.adapters.HTTPAdapter(), cache_dir,
+                             max_size)
+    session.mount('http://', adapter)
+    return session, adapter
+
+
+def test_packages_are_served_from_cache(tmpdir):
+    files = {'/foo-1.0-0.tar.bz2': b'package data'}
+    with etag_server(files) as (url, hits):
+        s1, a1 = caching_session(tmpdir.strpath)
+        assert s1.get(url + '/foo-1.0-0.tar.bz2').content == b'package data'
+        # another process (with a fresh session) shares the cache
+        s2, a2 = caching_session(tmpdir.strpath)
+        resp = s2.get(url + '/foo-1.0-0.tar.bz2', stream=True)
+        assert resp.raw.read() == b'package data'
+    assert hits == [('/foo-1.0-0.tar.bz2', 200)]
+    assert tmpdir.join('objects').check(dir=True)
+
+
+def test_repodata_is_revalidated(tmpdir):
+    files = {'/repodata.json.bz2': b'v1'}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.strpath)
+        assert session.get(url + '/repodata.json.bz2').content == b'v1'
+        assert session.get(url + '/repodata.json.bz2').content == b'v1'
+        files['/repodata.json.bz2'] = b'v2'
+        assert session.get(url + '/repodata.json.bz2').content == b'v2'
+        assert session.get(url + '/missing').status_code == 404
+    assert hits == [('/repodata.json.bz2', 200),
+                    ('/repodata.json.bz2', 304),
+                    ('/repodata.json.bz2', 200),
+                    ('/missing', 404)]
+
+
+def test_eviction(tmpdir):
+    files = {'/a.tar.bz2': b'a' * 100, '/b.tar.bz2': b'b' * 100}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.strpath, max_size=150)
+        session.get(url + '/a.tar.bz2')
+        session.get(url + '/b.tar.bz2')
+        # a was evicted to make room for b
+        assert session.get(url + '/a.tar.bz2').content == b'a' * 100
+        assert session.get(url + '/a.tar.bz2').content == b'a' * 100
+    assert [h[0] for h in hits] == ['/a.tar.bz2', '/b.tar.bz2', '/a.tar.bz2']
+
+
+def test_truncated_bodies_are_not_stored(tmpdir):
+    files = {'/foo-1.0-0.tar.bz2': b'truncated...'}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.strpath)
+        for i in range(2):
+            with pytest.raises(requests.exceptions.RequestException):
+                session.get(url + '/foo-1.0-0.tar.bz2').content
+    assert len(hits) == 2
+    assert not tmpdir.join('urls').check()
+
+
+def test_store_failure(tmpdir, monkeypatch):
+    files = {'/foo-1.0-0.tar.bz2': b'package data'}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.strpath)
+
+        def add(*args):
+            raise OSError("disk full")
+        monkeypatch.setattr(adapter, '_add', add)
+        # the package is still served, without downloading it again
+        assert session.get(url + '/foo-1.0-0.tar.bz2').content == b'package data'
+    assert hits == [('/foo-1.0-0.tar.bz2', 200)]
+
+
+def test_forget(tmpdir):
+    files = {'/foo-1.0-0.tar.bz2': b'package data'}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.strpath)
+        session.get(url + '/foo-1.0-0.tar.bz2')
+        adapter.forget(url + '/foo-1.0-0.tar.bz2')
+        assert session.get(url + '/foo-1.0-0.tar.bz2').content == b'package data'
+    assert len(hits) == 2
+
+
+def test_md5_mismatch_bypasses_cache(tmpdir):
+    from conda.fetch import download
+
+    files = {'/foo-1.0-0.tar.bz2': b'corrupt data'}
+    with etag_server(files) as (url, hits):
+        session, adapter = caching_session(tmpdir.join('cache').strpath)
+        session.proxies = {}
+        with pytest.raises(RuntimeError):
+            download(url + '/foo-1.0-0.tar.bz2',
+                     tmpdir.join('foo-1.0-0.tar.bz2').strpath,
+                     session=session, md5='0' * 32, retries=1)
+    # the retry was not served the corrupt body from the cache
+    assert len(hits) == 2
+    assert not tmpdir.join('cache', 'urls').listdir()
+
+
+def test_authorization_header_bypasses_cache(tmpdir):
+    files = {'/foo-1.0-0.tar.bz2': b'private data'}
+    with etag_server(files) as (url, hits):
+        for unused in range(2):
+            session, adapter = caching_session(tmpdir.strpath)
+            resp = session.get(url + '/foo-1.0-0.tar.bz2',
+                               headers={'Authorization': 'Bearer secret'})
+            assert resp.content == b'private data'
+    assert hits == [('/foo-1.0-0.tar.bz2', 200)] * 2
+    assert not tmpdir.join('objects').check()
+
+
+def test_url_credentials_bypass_cache(tmpdir):
+    files = {'/foo-1.0-0.tar.bz2': b'private data'}
+    with etag_server(files) as (url, hits):
+        url = url.replace('http://', 'http://user:secret@')
+        for unused in range(2):
+            session, adapter = caching_session(tmpdir.strpath)
+            assert session.get(url + '/foo-1.0-0.tar.bz2').content == b'private data'
+    assert hits == [('/foo-1.0-0.tar.bz2', 200)] * 2
+    assert not tmpdir.join('objects').check()
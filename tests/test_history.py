@@ -1,6 +1,8 @@
 from os.path import dirname
 import unittest
 
+import pytest
+
 from .decorators import skip_if_no_mock
 from .helpers import mock
 
@@ -49,3 +51,58 @@ class UserRequestsTestCase(unittest.TestCase):
                           'cmd': ['conda', 'install', 'pyflakes'],
                           'date': '2016-02-18 22:53:20',
                           'specs': ['pyflakes', 'conda', 'python 2.7*']})
+
+
+def test_get_state_from_checkpoints(tmpdir, monkeypatch):
+    monkeypatch.setattr(history, 'CHECKPOINT_INTERVAL', 5)
+    h = history.History(tmpdir.strpath)
+    h.write_dists(['a-1.0-0'])
+    state = {'a-1.0-0'}
+    for i in range(12):
+        new_state = state | {'b-%d-0' % i}
+        if i % 3 == 2:
+            new_state.discard('b-%d-0' % (i - 1))
+        h.write_changes(state, new_state)
+        state = new_state
+    states = [s for unused_dt, s in h.construct_states()]
+    assert len(states) == 13
+
+    assert h.get_state() == state
+    checkpoints = h.load_checkpoints()
+    assert [cp['rev'] for cp in checkpoints] == [12]
+    # only the revisions following the checkpoint are parsed
+    parsed = []
+    orig_parse_revisions = h.parse_revisions
+    monkeypatch.setattr(h, 'parse_revisions',
+                        lambda offset=0: parsed.append(offset) or
+                        orig_parse_revisions(offset))
+    h.write_changes(state, state | {'c-1.0-0'})
+    assert h.get_state() == state | {'c-1.0-0'}
+    assert parsed == [checkpoints[0]['end']]
+
+    states.append(state | {'c-1.0-0'})
+    assert [h.get_state(rev) for rev in range(14)] == states
+    assert [h.get_state(-rev) for rev in range(1, 15)] == states[::-1]
+    with pytest.raises(IndexError):
+        h.get_state(14)
+
+    # checkpoints which do not match the history file anymore are ignored
+    tmpdir.join('conda-meta', 'history').write(
+        '==> 2000-01-01 00:00:00 <==\nz-1.0-0\n' * 20)
+    assert h.load_checkpoints() == []
+    assert h.get_state() == {'z-1.0-0'}
+
+
+def test_get_state_comments_after_checkpoint(tmpdir, monkeypatch):
+    monkeypatch.setattr(history, 'CHECKPOINT_INTERVAL', 1)
+    h = history.History(tmpdir.strpath)
+    h.write_dists(['a-1.0-0'])
+    assert h.get_state() == {'a-1.0-0'}
+    assert [cp['rev'] for cp in h.load_checkpoints()] == [0]
+    # e.g. written by 'conda install --force', which adds no revision
+    with open(h.path, 'a') as fo:
+        fo.write("# install specs: ['a']\n")
+    assert h.get_state() == {'a-1.0-0'}
+    h.write_changes({'a-1.0-0'}, {'a-1.0-0', 'b-1.0-0'})
+    assert h.get_state() == {'a-1.0-0', 'b-1.0-0'}
+    assert h.get_state(0) == {'a-1.0-0'}
@@ -1,10 +1,17 @@
 from contextlib import contextmanager
+import json
+import os
 import random
 import shutil
 import stat
+import sys
+import tarfile
 import tempfile
+import time
 import unittest
-from os.path import join
+from os.path import basename, dirname, isfile, join
+
+import pytest
 
 
 from conda import install
@@ -408,5 +415,569 @@ class duplicates_to_remove_TestCase(unittest.TestCase):
         self.assertEqual(duplicates_to_remove(li, [d1, d2]), [])
 
 
+def test_make_dirs(tmpdir):
+    tmpdir.mkdir('lib')
+    files = ['bin/python', 'lib/libz.so', 'lib/python2.7/site-packages/a.py',
+             'lib/python2.7/os.py', 'LICENSE.txt']
+    new_dirs = install.make_dirs(tmpdir.strpath, files)
+    assert new_dirs == {'bin', 'lib/python2.7', 'lib/python2.7/site-packages'}
+    assert tmpdir.join('lib', 'python2.7', 'site-packages').check(dir=True)
+    assert install.make_dirs(tmpdir.strpath, files) == set()
+
+
+def test_link_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(install, 'LINK_THREADS_MIN_FILES', 10)
+    src_dir = tmpdir.mkdir('src')
+    prefix = tmpdir.mkdir('prefix')
+    files = ['f%d' % i for i in range(20)] + ['sub/g%d' % i for i in range(20)]
+    for f in files:
+        src_dir.join(f).write(f, ensure=True)
+    prefix.join('f0').write('old')
+    new_dirs = install.make_dirs(prefix.strpath, files)
+    install.link_files([(join(src_dir.strpath, f), join(prefix.strpath, f),
+                         install.LINK_HARD, dirname(f) in new_dirs)
+                        for f in files])
+    for f in files:
+        assert prefix.join(f).read() == f
+    assert prefix.join('sub', 'g0').stat().ino == src_dir.join('sub', 'g0').stat().ino
+
+
+def test_reflink_falls_back_to_copy(tmpdir):
+    src = tmpdir.join('src')
+    src.write('data')
+    src.chmod(0o755)
+    dst = tmpdir.join('dst')
+    # whether or not the file system supports reflinks, dst is a copy
+    install._link(src.strpath, dst.strpath, install.LINK_REFLINK)
+    assert dst.read() == 'data'
+    assert dst.stat().mode == src.stat().mode
+    assert dst.stat().ino != src.stat().ino
+    dst.write('changed')
+    assert src.read() == 'data'
+
+
+def test_prefix_offsets(tmpdir, monkeypatch):
+    pkg = tmpdir.mkdir('foo-1.0-0')
+    placeholder = install.prefix_placeholder
+    text = ('#!%s/bin/python\nprint("%s")\n' % (placeholder, placeholder))
+    binary = (b'\x7fELF\0' + placeholder.encode('utf-8') + b'/lib:' +
+              placeholder.encode('utf-8') + b'/lib64\0...\0' +
+              b'/some-placeholder/lib\0')
+    pkg.join('bin', 'script').write(text, ensure=True)
+    pkg.join('lib', 'libfoo.so').write(binary, mode='wb', ensure=True)
+    pkg.join('lib', 'libbar.so').write(b'/some-placeholder\0', mode='wb')
+    pkg.join('info', 'has_prefix').write(
+        'bin/script\n'
+        '%s binary lib/libfoo.so\n'
+        '/some-placeholder binary lib/libbar.so\n' % placeholder, ensure=True)
+    install.write_prefix_offsets(pkg.strpath)
+    offsets = install.read_prefix_offsets(pkg.join('info').strpath)
+    assert offsets['bin/script']['offsets'] == [2, text.index('print') + 7]
+    assert len(offsets['lib/libfoo.so']['offsets']) == 1
+
+    for f, size in [('bin/script', 0), ('lib/libfoo.so', 0),
+                    ('lib/libfoo.so', 1)]:
+        monkeypatch.setattr(install, 'MMAP_MIN_SIZE', size or 2**20)
+        placeholder, mode = install.read_has_prefix(
+            pkg.join('info', 'has_prefix').strpath)[f]
+        expected = tmpdir.join('expected')
+        pkg.join(f).copy(expected)
+        install.update_prefix(expected.strpath, '/usr/local', placeholder, mode)
+        patched = tmpdir.join('patched')
+        pkg.join(f).copy(patched)
+        assert install.patch_prefix(patched.strpath, '/usr/local', placeholder,
+                                    mode, offsets[f])
+        assert patched.read_binary() == expected.read_binary()
+        # the offsets do not apply to the patched file
+        assert not install.patch_prefix(patched.strpath, '/usr/local',
+                                        placeholder, mode, offsets[f])
+
+    with pytest.raises(PaddingError):
+        install.patch_prefix(pkg.join('lib', 'libbar.so').strpath, '/a/longer/prefix/path',
+                             '/some-placeholder', 'binary', offsets['lib/libbar.so'])
+
+
+@skip_if_no_mock
+def test_link_capabilities(tmpdir, monkeypatch):
+    monkeypatch.setattr(install, 'link_capabilities_', {})
+    monkeypatch.setattr(install, '_mounts_fingerprint', lambda: 'mounts1')
+    pkgs_dir = tmpdir.join('pkgs')
+    prefix = tmpdir.join('envs', 'test')
+    caps = install.link_capabilities(pkgs_dir.strpath, prefix.strpath)
+    tmpdir.join('src').write('data')
+    try:
+        install.reflink(tmpdir.join('src').strpath, tmpdir.join('dst').strpath)
+    except OSError:
+        supported = False
+    else:
+        supported = True
+    assert caps == {'hard': True, 'soft': True, 'reflink': supported}
+    assert not prefix.check()
+    assert pkgs_dir.listdir() == [pkgs_dir.join('cache')]
+
+    probe = mock.Mock(return_value=caps)
+    monkeypatch.setattr(install, '_probe_link_capabilities', probe)
+    # memoized for this pair of devices, and persisted across runs
+    install.link_capabilities(pkgs_dir.strpath, tmpdir.join('other').strpath)
+    monkeypatch.setattr(install, 'link_capabilities_', {})
+    assert install.link_capabilities(pkgs_dir.strpath, prefix.strpath) == caps
+    assert not probe.called
+    # but probed again once the mounts change
+    monkeypatch.setattr(install, 'link_capabilities_', {})
+    monkeypatch.setattr(install, '_mounts_fingerprint', lambda: 'mounts2')
+    assert install.link_capabilities(pkgs_dir.strpath, prefix.strpath) == caps
+    assert probe.call_count == 1
+
+
+def test_package_cache_index(tmpdir, monkeypatch):
+    pkgs_dir = tmpdir.mkdir('pkgs')
+    monkeypatch.setattr(install.config, 'pkgs_dirs', [pkgs_dir.strpath])
+    pkgs_dir.join('urls.txt').write('http://example.com/channel/a-1.0-0.tar.bz2\n')
+    pkgs_dir.join('a-1.0-0.tar.bz2').write('tarball')
+    for dist in 'a-1.0-0', 'b-1.0-0':
+        pkgs_dir.join(dist, 'info', 'files').write('', ensure=True)
+        pkgs_dir.join(dist, 'info', 'index.json').write('{}')
+
+    def reset():
+        monkeypatch.setattr(install, 'package_cache_', {})
+        monkeypatch.setattr(install, 'fname_table', {})
+        monkeypatch.setattr(install, 'pkgs_dir_entries_', {})
+
+    def scan():
+        reset()
+        looked_at = []
+        orig_entry = install._pkgs_dir_entry
+        monkeypatch.setattr(install, '_pkgs_dir_entry',
+                            lambda pdir, fn: looked_at.append(fn) or orig_entry(pdir, fn))
+        cache = install.package_cache()
+        monkeypatch.setattr(install, '_pkgs_dir_entry', orig_entry)
+        return cache, sorted(looked_at)
+
+    cache, looked_at = scan()
+    assert looked_at == ['a-1.0-0', 'a-1.0-0.tar.bz2', 'b-1.0-0', 'cache', 'urls.txt']
+    a = 'http://example.com::a-1.0-0'
+    assert install.is_fetched(a) == pkgs_dir.join('a-1.0-0.tar.bz2').strpath
+    assert install.is_extracted(a) == pkgs_dir.join('a-1.0-0').strpath
+    assert pkgs_dir.join('cache', install.PACKAGE_CACHE_INDEX_FN).check()
+    # the next time, no extracted package is looked at, unless it is new
+    cache2, looked_at = scan()
+    assert looked_at == ['a-1.0-0.tar.bz2', 'cache', 'urls.txt'] and cache2 == cache
+    # a package which is completed later is found, even though the mtime of
+    # the package cache does not change
+    pkgs_dir.join('d-1.0-0', 'info', 'files').write('', ensure=True)
+    assert not [d for d in scan()[0] if d.endswith('d-1.0-0')]
+    pkgs_dir.join('d-1.0-0', 'info', 'index.json').write('{}')
+    assert [d for d in scan()[0] if d.endswith('d-1.0-0')]
+    pkgs_dir.join('c-1.0-0.tar.bz2').write('tarball')
+    cache3, looked_at = scan()
+    assert 'c-1.0-0.tar.bz2' in looked_at and 'b-1.0-0' not in looked_at
+    assert [d for d in cache3 if d.endswith('c-1.0-0')]
+
+    # removing packages from the cache keeps the index up to date
+    install.rm_extracted(a)
+    b, = [d for d in cache3 if d.endswith('b-1.0-0')]
+    install.rm_fetched(b)
+    cache4, looked_at = scan()
+    assert install.is_fetched(a) and not install.is_extracted(a)
+    assert b not in cache4
+
+
+@pytest.mark.skipif(install.sqlite3 is None, reason="requires sqlite3")
+def test_prefix_state_db(tmpdir, monkeypatch):
+    monkeypatch.setattr(install.config, 'prefix_state_db', True)
+    prefix = tmpdir.strpath
+    meta_dir = tmpdir.mkdir('conda-meta')
+
+    def write_meta(dist, files):
+        url = 'http://example.com/channel/osx-64/%s.tar.bz2' % dist
+        meta_dir.join(dist + '.json').write(json.dumps({'files': files, 'url': url}))
+        return install.url_channel(url)[1] + '::' + dist
+
+    def read():
+        monkeypatch.setattr(install, 'linked_data_', {})
+        return install.linked_data(prefix)
+
+    a = write_meta('a-1.0-0', ['lib/a'])
+    b = write_meta('b-1.0-0', ['lib/b'])
+    assert sorted(read()) == [a, b]
+    assert meta_dir.join(install.PREFIX_STATE_FN).check()
+    assert install.load_meta(prefix, a)['files'] == ['lib/a']
+
+    # the JSON files are not read again, unless they change
+    loads = []
+    orig_load = install.json.load
+    monkeypatch.setattr(install.json, 'load',
+                        lambda fi: loads.append(fi.name) or orig_load(fi))
+    assert sorted(read()) == [a, b]
+    assert loads == []
+    write_meta('a-1.0-0', ['lib/a', 'lib/a2'])
+    meta_dir.join('b-1.0-0.json').remove()
+    c = write_meta('c-1.0-0', [])
+    assert sorted(read()) == [a, c]
+    assert sorted(basename(fn) for fn in loads) == ['a-1.0-0.json', 'c-1.0-0.json']
+    assert install.load_meta(prefix, a)['files'] == ['lib/a', 'lib/a2']
+
+    # a file which is rewritten in place (keeping the mtime of conda-meta)
+    # is read again as well
+    st = os.stat(meta_dir.strpath)
+    with open(meta_dir.join('c-1.0-0.json').strpath, 'w') as fo:
+        json.dump({'files': ['lib/c'], 'url': 'http://example.com/channel/osx-64/c'}, fo)
+    os.utime(meta_dir.strpath, (st.st_atime, st.st_mtime))
+    assert read()[c]['files'] == ['lib/c']
+
+    install.delete_linked_data(prefix, c)
+    assert sorted(read()) == [a]
+
+
+def test_file_owners_index(synthetic_package, tmpdir, monkeypatch):
+    monkeypatch.setattr(install, 'file_owners_', {})
+    monkeypatch.setattr(install, 'file_owners_changed_', set())
+    a, a_files = synthetic_package(1, dist='a-1.0-0')
+    b, b_files = synthetic_package(2, dist='b-1.0-0')
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, a)
+    install.link(prefix, b)
+    install.unlink(prefix, a)
+    assert install.file_owners(prefix) == {f: {b} for f in b_files}
+    install.save_file_owners(prefix)
+    assert isfile(join(prefix, 'conda-meta', install.FILE_OWNERS_FN))
+
+    def fresh():
+        monkeypatch.setattr(install, 'file_owners_', {})
+        monkeypatch.setattr(install, 'linked_data_', {})
+        return install.file_owners(prefix)
+
+    # another process reads the index, without reading the records
+    orig_linked_data = install.linked_data
+    monkeypatch.setattr(install, 'linked_data', None)
+    assert fresh() == {f: {b} for f in b_files}
+    assert not install.file_owners_changed_
+    # but rebuilds it when conda-meta changed
+    monkeypatch.setattr(install, 'linked_data', orig_linked_data)
+    with open(join(prefix, 'conda-meta', 'b-1.0-0.json'), 'a') as fo:
+        fo.write(' ')
+    assert fresh() == {f: {b} for f in b_files}
+    assert prefix in install.file_owners_changed_
+
+
+def test_link_many_has_prefix_files(synthetic_package, tmpdir):
+    dist, files = synthetic_package(200)
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, dist)
+    for f in files:
+        with open(join(prefix, f), 'rb') as fi:
+            data = fi.read()
+        assert prefix.encode('utf-8') in data
+        assert b'placehold' not in data
+    assert install.is_linked(prefix, dist)['files'] == files
+
+
+def test_link_placeholder_too_short(synthetic_package, tmpdir):
+    dist, files = synthetic_package(20, placeholder='/short')
+    with pytest.raises(SystemExit) as exc:
+        install.link(tmpdir.join('a-long-prefix').strpath, dist)
+    msg = str(exc.value)
+    assert msg.startswith("ERROR: placeholder '/short' too short in: %s" % dist)
+    # all failing (binary) files are reported
+    assert sorted(msg.split()[7:]) == sorted(f for f in files if f.startswith('lib'))
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="files are not swapped on Windows")
+def test_update(synthetic_package, tmpdir):
+    old_dist, old_files = synthetic_package(3, dist='synthetic-1.0-0')
+    dist, files = synthetic_package(2, dist='synthetic-2.0-0')
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, old_dist)
+    ino = os.lstat(join(prefix, 'lib/lib0.so')).st_ino
+
+    install.update(prefix, old_dist, dist)
+    assert install.linked(prefix) == {dist}
+    assert os.lstat(join(prefix, 'lib/lib0.so')).st_ino != ino
+    for f in files:
+        with open(join(prefix, f), 'rb') as fi:
+            assert prefix.encode('utf-8') in fi.read()
+    # the files which are only in the old package are removed, and nothing
+    # is left behind
+    assert not isfile(join(prefix, 'lib/lib2.so'))
+    assert sorted(os.listdir(join(prefix, 'lib'))) == ['lib0.so', 'lib1.so']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses a shell script")
+def test_update_rolls_back(synthetic_package, tmpdir):
+    old_dist, old_files = synthetic_package(3, dist='synthetic-1.0-0')
+    dist, files = synthetic_package(2, dist='synthetic-2.0-0')
+    pkg = tmpdir.join('pkgs', 'synthetic-2.0-0')
+    pkg.join('bin', '.synthetic-post-link.sh').write('exit 1\n')
+    pkg.join('info', 'files').write('\nbin/.synthetic-post-link.sh', mode='a')
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, old_dist)
+    inos = {f: os.lstat(join(prefix, f)).st_ino for f in old_files}
+
+    with pytest.raises(SystemExit):
+        install.update(prefix, old_dist, dist)
+    assert install.linked(prefix) == {old_dist}
+    assert {f: os.lstat(join(prefix, f)).st_ino for f in old_files} == inos
+    assert sorted(os.listdir(join(prefix, 'bin'))) == ['script0', 'script1', 'script2']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="files are not swapped on Windows")
+def test_update_swap_fails(synthetic_package, tmpdir, monkeypatch):
+    old_dist, old_files = synthetic_package(3, dist='synthetic-1.0-0')
+    dist, files = synthetic_package(3, dist='synthetic-2.0-0')
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, old_dist)
+    inos = {f: os.lstat(join(prefix, f)).st_ino for f in old_files}
+
+    orig_rename = os.rename
+
+    def rename(src, dst):
+        if src.endswith('lib1.so' + install.STAGED_SUFFIX):
+            raise OSError(28, 'No space left on device')
+        orig_rename(src, dst)
+    monkeypatch.setattr(os, 'rename', rename)
+    with pytest.raises(SystemExit) as exc:
+        install.update(prefix, old_dist, dist)
+    assert 'synthetic-1.0-0 was restored' in str(exc.value)
+    assert install.linked(prefix) == {old_dist}
+    assert {f: os.lstat(join(prefix, f)).st_ino for f in old_files} == inos
+    assert sorted(os.listdir(join(prefix, 'lib'))) == ['lib0.so', 'lib1.so', 'lib2.so']
+
+
+def test_manifest_computed_at_extract(tmpdir, monkeypatch):
+    pkgs_dir = tmpdir.mkdir('pkgs')
+    monkeypatch.setattr(install.config, 'pkgs_dirs', [pkgs_dir.strpath])
+    monkeypatch.setattr(install, 'package_cache_', {})
+    monkeypatch.setattr(install, 'fname_table', {})
+    src = tmpdir.join('src')
+    src.join('share', 'data.txt').write('data\n', ensure=True)
+    src.join('info', 'files').write('share/data.txt', ensure=True)
+    src.join('info', 'index.json').write('{}')
+    with tarfile.open(pkgs_dir.join('a-1.0-0.tar.bz2').strpath, 'w:bz2') as t:
+        for f in 'info/files', 'info/index.json', 'share/data.txt':
+            t.add(src.join(f).strpath, f)
+    install.add_cached_package(pkgs_dir.strpath, 'http://example.com/channel/a-1.0-0.tar.bz2')
+    dist, = install.package_cache()
+
+    install.extract(dist)
+    assert pkgs_dir.join('a-1.0-0', 'info', install.FILES_MANIFEST_FN).check()
+    # linking the package does not hash its files again
+    monkeypatch.setattr(install, 'file_sha256', None)
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, dist)
+    manifest = install.is_linked(prefix, dist)['manifest']
+    assert manifest['share/data.txt']['size'] == 5
+
+
+def test_verify_files(synthetic_package, tmpdir):
+    dist, files = synthetic_package(2)
+    pkg = tmpdir.join('pkgs', 'synthetic-1.0-0')
+    pkg.join('share', 'data.txt').write('data\n', ensure=True)
+    pkg.join('info', 'files').write('\nshare/data.txt', mode='a')
+    prefix = tmpdir.join('envs', 'test').strpath
+    install.link(prefix, dist)
+    manifest = install.is_linked(prefix, dist)['manifest']
+    assert sorted(manifest) == sorted(files + ['share/data.txt'])
+    # the files in which the placeholders were replaced are hashed in the prefix
+    assert (manifest['lib/lib0.so']['sha256'] ==
+            install.file_sha256(join(prefix, 'lib/lib0.so')))
+    assert install.verify_files(prefix, deep=True) == []
+
+    # keeping the size and mtime, only the deep check detects the change
+    path = join(prefix, 'bin/script0')
+    st = os.stat(path)
+    with open(path, 'r+b') as fo:
+        fo.write(b'#?')
+    os.utime(path, (st.st_atime, st.st_mtime))
+    os.chmod(join(prefix, 'bin/script1'), 0o700)
+    os.unlink(join(prefix, 'lib/lib1.so'))
+    assert install.verify_files(prefix) == [(dist, 'bin/script1', 'mode'),
+                                            (dist, 'lib/lib1.so', 'missing')]
+    problems = install.verify_files(prefix, deep=True)
+    assert problems == [(dist, 'bin/script0', 'modified'),
+                        (dist, 'bin/script1', 'mode'),
+                        (dist, 'lib/lib1.so', 'missing')]
+
+    install.relink_files(prefix, dist, [f for _, f, _ in problems])
+    assert install.verify_files(prefix, deep=True) == []
+
+    # a hard-linked file is damaged in the package cache as well
+    with open(join(prefix, 'share/data.txt'), 'w') as fo:
+        fo.write('oops\n')
+    assert install.verify_files(prefix) == [(dist, 'share/data.txt', 'modified')]
+    with pytest.raises(SystemExit):
+        install.relink_files(prefix, dist, ['share/data.txt'])
+
+
+def test_package_refs(synthetic_package, tmpdir):
+    from conda.cli.main_clean import find_pkgs
+
+    dist, files = synthetic_package(2)
+    other_dist, unused_files = synthetic_package(2, dist='other-1.0-0')
+    pkg = tmpdir.join('pkgs', 'other-1.0-0')
+    pkg.join('share', 'data.txt').write('data\n', ensure=True)
+    pkg.join('info', 'files').write('\nshare/data.txt', mode='a')
+    pkgs_dir = tmpdir.join('pkgs').strpath
+    # as when the package was extracted
+    install.set_package_refs(pkgs_dir, 'synthetic-1.0-0', [])
+    prefix1 = tmpdir.join('envs', 'test1').strpath
+    prefix2 = tmpdir.join('envs', 'test2').strpath
+    # copied packages are only known to be used through the registry
+    install.link(prefix1, dist, linktype=install.LINK_COPY)
+    install.link(prefix2, dist, linktype=install.LINK_COPY)
+    assert install.linked_prefixes(pkgs_dir, 'synthetic-1.0-0') == [prefix1, prefix2]
+    assert install.linked_prefixes(pkgs_dir, 'other-1.0-0') is None
+    assert dict(find_pkgs()[0]) == {pkgs_dir: ['other-1.0-0']}
+
+    install.unlink(prefix1, dist)
+    # a removed environment does not count anymore
+    install.rm_rf(prefix2)
+    assert install.linked_prefixes(pkgs_dir, 'synthetic-1.0-0') == []
+    assert sorted(find_pkgs()[0][pkgs_dir]) == ['other-1.0-0', 'synthetic-1.0-0']
+
+    # packages which are not recorded are still found to be used when they
+    # are hard-linked
+    install.link(prefix1, other_dist)
+    assert dict(find_pkgs()[0]) == {pkgs_dir: ['synthetic-1.0-0']}
+
+
+def test_evict_packages(synthetic_package, tmpdir, monkeypatch):
+    monkeypatch.setattr(install, 'package_access_', {})
+    pkgs_dir = tmpdir.join('pkgs')
+    pdir = pkgs_dir.strpath
+    dists = [synthetic_package(1, dist='p%d-1.0-0' % i)[0] for i in range(3)]
+    tarballs = ['p%d-1.0-0.tar.bz2' % i for i in range(3)]
+    for fn in tarballs:
+        pkgs_dir.join(fn).write('x' * 1000)
+    install.update_pkgs_dir_entries(pdir, tarballs)
+    install._save_package_access(pdir, {'p0-1.0-0': {'atime': 300},
+                                        'p2-1.0-0': {'atime': 100}})
+    # p1 is the most recently used package, and is linked (by copying)
+    install.set_package_refs(pdir, 'p1-1.0-0', [])
+    install.link(tmpdir.join('envs', 'test').strpath, dists[1],
+                 linktype=install.LINK_COPY)
+    install.save_package_access()
+
+    assert install.evict_packages(pdir, max_size=10**9, max_count=3) == []
+    # the tarballs are removed first, then the least recently used
+    # extracted packages
+    removed = install.evict_packages(pdir, max_count=2)
+    assert removed == [join(pdir, fn) for fn in ('p2-1.0-0.tar.bz2',
+                                                 'p0-1.0-0.tar.bz2',
+                                                 'p1-1.0-0.tar.bz2',
+                                                 'p2-1.0-0')]
+    assert sorted(os.listdir(pdir)) == ['.locks', 'cache', 'p0-1.0-0', 'p1-1.0-0']
+    assert dists[2] not in install.package_cache()
+    # linked packages are never removed
+    assert install.evict_packages(pdir, max_count=0) == [join(pdir, 'p0-1.0-0')]
+    assert sorted(install.package_access(pdir)) == ['p1-1.0-0']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses hard links")
+def test_dedup_package(synthetic_package, tmpdir):
+    pdir = tmpdir.join('pkgs').strpath
+    dists = ['p%d-1.0-0' % i for i in range(2)]
+    for dist in dists:
+        synthetic_package(1, dist=dist)
+        pkg = tmpdir.join('pkgs', dist)
+        pkg.join('share', 'data.txt').write('shared data', ensure=True)
+        pkg.join('info', 'files').write('\nshare/data.txt', mode='a')
+        install.dedup_package(pkg.strpath)
+        assert install.is_deduplicated(pkg.strpath)
+
+    st = [os.stat(join(pdir, dist, 'share', 'data.txt')) for dist in dists]
+    assert st[0].st_ino == st[1].st_ino
+    assert st[0].st_nlink == 3
+    manifest = install.files_manifest(join(pdir, dists[1]))
+    obj = install._object_path(pdir, manifest['share/data.txt'])
+    assert os.stat(obj).st_ino == st[0].st_ino
+    # the manifest still matches the deduplicated files
+    for f, entry in manifest.items():
+        path = join(pdir, dists[1], f)
+        assert install._verify_file(path, entry, deep=False) is None
+
+    assert install.gc_objects(pdir) == (0, 0)
+    for dist in dists:
+        install.rm_rf(join(pdir, dist))
+    count, size = install.gc_objects(pdir)
+    assert count == 3 and size > 0
+    assert not os.path.exists(obj)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses a shell script")
+def test_remove_prefix(tmpdir, monkeypatch):
+    monkeypatch.setattr(install.config, 'pkgs_dirs', [tmpdir.join('pkgs').strpath])
+    prefix = tmpdir.join('envs', 'test')
+    prefix.join('lib', 'foo.so').write('foo', ensure=True)
+    prefix.join('conda-meta', 'foo-1.0-0.json').write(
+        '{"files": ["lib/foo.so", "bin/.foo-pre-unlink.sh"]}', ensure=True)
+    prefix.join('bin', '.foo-pre-unlink.sh').write(
+        'echo $PREFIX > %s\n' % tmpdir.join('pre-unlink'), ensure=True)
+
+    install.remove_prefix(prefix.strpath)
+    assert not prefix.check()
+    assert tmpdir.join('pre-unlink').read() == prefix.strpath + '\n'
+    # the trash is deleted in the background
+    trash_dir = tmpdir.join('pkgs', '.trash')
+    for i in range(100):
+        if not trash_dir.listdir():
+            break
+        time.sleep(0.1)
+    assert trash_dir.listdir() == []
+
+
+def test_reap_trash(tmpdir, monkeypatch):
+    monkeypatch.setattr(install.config, 'pkgs_dirs', [tmpdir.join('pkgs').strpath])
+    for i in range(3):
+        path = tmpdir.join('file%d' % i)
+        path.write('x' * 100)
+        assert install.move_path_to_trash(path.strpath)
+        assert not path.check()
+    # moving to the trash does not empty it
+    entries = install.trash_entries()
+    assert len(entries) == 3
+    now = time.time()
+    for i, path in enumerate(entries):
+        os.utime(path, (now - 100 * (3 - i), now - 100 * (3 - i)))
+
+    assert install.trash_entries(min_age=250) == entries[:1]
+    assert install.reap_trash(min_age=150, max_size=50) == 100
+    assert install.trash_entries() == entries[1:]
+    assert install.reap_trash(min_age=0) == 200
+    assert install.trash_entries() == []
+
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses /bin/false")
+def test_reap_trash_in_background(tmpdir, monkeypatch):
+    # the same package cache in the background process
+    monkeypatch.setenv('CONDA_ENVS_PATH', tmpdir.join('envs').strpath)
+    monkeypatch.setattr(install.config, 'pkgs_dirs',
+                        [tmpdir.join('envs', '.pkgs').strpath])
+    monkeypatch.setattr(install, 'TRASH_REAP_MAX_SIZE', 50)
+    for i in range(3):
+        path = tmpdir.join('file%d' % i)
+        path.write('x' * 100)
+        install.move_path_to_trash(path.strpath)
+    entries = install.trash_entries()
+    now = time.time()
+    for i, path in enumerate(entries):
+        os.utime(path, (now - 1000 + i, now - 1000 + i))
+
+    # the trash is reaped in the foreground (up to the size limit) when the
+    # background process cannot import conda
+    python = sys.executable
+    monkeypatch.setattr(sys, 'executable', '/bin/false')
+    install.reap_trash_in_background()
+    assert install.trash_entries() == entries[1:]
+
+    monkeypatch.setattr(sys, 'executable', python)
+    monkeypatch.chdir(dirname(dirname(install.__file__)))
+    install.reap_trash_in_background()
+    for i in range(100):
+        if not install.trash_entries():
+            break
+        time.sleep(0.1)
+    assert install.trash_entries() == []
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,12 @@
 import os.path
+import subprocess
+import sys
+
 import pytest
 
-from conda.lock import Locked, LockError
+import conda
+from conda.lock import (LOCKFN, LOCKS_DIR, Locked, LockError, lock_pid,
+                        package_lock, pid_running)
 
 
 def test_lock_passes(tmpdir):
@@ -30,3 +35,74 @@ def test_lock_locks(tmpdir):
     # lock should clean up after itself
     assert not tmpdir.join(path).exists()
     assert not tmpdir.exists()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses fcntl")
+def test_package_lock(tmpdir):
+    pkgs_dir = tmpdir.strpath
+    with package_lock(pkgs_dir, 'foo-1.0-0'):
+        # shared locks are held together
+        with package_lock(pkgs_dir, 'foo-1.0-0'):
+            with pytest.raises(LockError):
+                with package_lock(pkgs_dir, 'foo-1.0-0', exclusive=True,
+                                  blocking=False):
+                    assert False
+        # other packages are locked separately
+        with package_lock(pkgs_dir, 'bar-1.0-0', exclusive=True,
+                          blocking=False):
+            pass
+    with package_lock(pkgs_dir, 'foo-1.0-0', exclusive=True) as lock:
+        with pytest.raises(LockError) as execinfo:
+            with package_lock(pkgs_dir, 'foo-1.0-0', blocking=False):
+                assert False
+        assert "PID %d" % os.getpid() in str(execinfo.value)
+        assert os.path.dirname(lock.path) == tmpdir.join(LOCKS_DIR).strpath
+
+
+def test_stale_locks(tmpdir):
+    lock_path = tmpdir.join('%s-%d' % (LOCKFN, os.getpid())).strpath
+    assert lock_pid(lock_path) == os.getpid()
+    assert pid_running(os.getpid())
+    if sys.platform != 'win32':
+        # a process which has ended
+        p = subprocess.Popen([sys.executable, '-c', 'pass'])
+        p.wait()
+        assert not pid_running(p.pid)
+
+
+STRESS_SCRIPT = """
+import os, sys, time
+from conda.lock import package_lock
+
+pkgs_dir, n = sys.argv[1], int(sys.argv[2])
+path = os.path.join(pkgs_dir, 'count')
+for i in range(n):
+    if i % 2:
+        with package_lock(pkgs_dir, 'foo-1.0-0', exclusive=True):
+            with open(path) as fi:
+                count = int(fi.read())
+            # nobody else sees this
+            with open(path, 'w') as fo:
+                fo.write('-1')
+            time.sleep(0.001)
+            with open(path, 'w') as fo:
+                fo.write(str(count + 1))
+    else:
+        with package_lock(pkgs_dir, 'foo-1.0-0'):
+            with open(path) as fi:
+                assert int(fi.read()) >= 0
+"""
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses fcntl")
+def test_package_lock_processes(tmpdir):
+    tmpdir.join('count').write('0')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(conda.__file__))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    procs = [subprocess.Popen([sys.executable, '-c', STRESS_SCRIPT,
+                               tmpdir.strpath, '40'], env=env)
+             for i in range(10)]
+    assert [p.wait() for p in procs] == [0] * 10
+    assert tmpdir.join('count').read() == str(10 * 20)
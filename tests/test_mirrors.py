@@ -0,0 +1,144 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from conda import config, mirrors
+from conda.connection import CondaSession
+from conda.fetch import get_from_mirrors
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def delayed_server(delay, body=b'hello', status=200):
+    """
+    Serve `body` for every GET and HEAD request, after sleeping `delay`
+    seconds.
+    """
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            time.sleep(delay)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+        def do_GET(self):
+            hits.append(self.path)
+            self.do_HEAD()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        yield 'http://127.0.0.1:%d/channel' % server.server_address[1], hits
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def local_session():
+    # the test servers must not be reached through any configured proxy
+    session = CondaSession()
+    session.trust_env = False
+    session.proxies = {}
+    return session
+
+
+@pytest.fixture
+def mirror_config(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'pkgs_dirs', [tmpdir.strpath])
+    monkeypatch.setattr(mirrors, '_stats', None)
+    monkeypatch.setattr(mirrors, '_last_save', 0)
+    monkeypatch.setattr(mirrors, '_unsaved', False)
+
+    def set_mirrors(channel, *urls):
+        monkeypatch.setitem(config.rc, 'channel_mirrors', {channel: list(urls)})
+    return set_mirrors
+
+
+def test_no_mirrors(mirror_config):
+    mirror_config('http://example.com/channel')
+    url = 'http://other.com/channel/linux-64/repodata.json.bz2'
+    assert mirrors.mirror_urls(url) == [url]
+
+
+def test_fastest_mirror_is_used(mirror_config):
+    with delayed_server(0.5) as (slow, slow_hits):
+        with delayed_server(0) as (fast, fast_hits):
+            mirror_config(slow, fast)
+            session = local_session()
+            resp = get_from_mirrors(session, slow + '/linux-64/foo.tar.bz2')
+            assert resp.content == b'hello'
+            assert fast_hits == ['/channel/linux-64/foo.tar.bz2']
+            assert slow_hits == []
+
+    stats = mirrors.load_stats()
+    assert stats[slow + '/']['latency'] > stats[fast + '/']['latency']
+    # the statistics are persisted in the package cache
+    mirrors.flush_stats()
+    mirrors._stats = None
+    assert mirrors.mirror_urls(slow + '/x') == [fast + '/x', slow + '/x']
+
+
+def test_failover(mirror_config):
+    with delayed_server(0, status=503) as (broken, broken_hits):
+        with delayed_server(0.2) as (ok, ok_hits):
+            mirror_config(broken, ok)
+            # pretend the broken mirror looked best when it was probed
+            mirrors.record_latency(broken + '/', 0.001)
+            mirrors.record_latency(ok + '/', 1)
+            resp = get_from_mirrors(local_session(), broken + '/noarch/bar')
+            assert resp.content == b'hello'
+            assert broken_hits == ['/channel/noarch/bar']
+            assert ok_hits == ['/channel/noarch/bar']
+
+    assert not mirrors.is_healthy(broken + '/')
+    assert mirrors.mirror_urls(broken + '/a') == [ok + '/a', broken + '/a']
+
+
+def test_stale_mirror(mirror_config):
+    with delayed_server(0, status=404) as (stale, stale_hits):
+        with delayed_server(0.2) as (ok, ok_hits):
+            mirror_config(stale, ok)
+            mirrors.record_latency(stale + '/', 0.001)
+            mirrors.record_latency(ok + '/', 1)
+            resp = get_from_mirrors(local_session(), stale + '/noarch/new')
+            assert resp.status_code == 200
+            assert stale_hits == ok_hits == ['/channel/noarch/new']
+
+    assert not mirrors.is_healthy(stale + '/')
+
+
+def test_failed_probes_are_not_repeated(mirror_config):
+    class Session(object):
+        proxies = {}
+        heads = []
+
+        def head(self, url, **kwargs):
+            self.heads.append(url)
+            raise IOError("connection refused")
+
+    base = 'http://127.0.0.1:1/channel'
+    mirror_config(base, 'http://127.0.0.1:2/channel')
+    session = Session()
+    for i in range(3):
+        mirrors.mirror_urls(base + '/noarch/foo', session)
+    assert sorted(session.heads) == [base + '/', 'http://127.0.0.1:2/channel/']
@@ -1,9 +1,15 @@
+import json
 import os.path
 import sys
 import unittest
 
+import pytest
+
+from conda import install
 from conda.fetch import cache_fn_url
-from conda.misc import url_pat, walk_prefix
+from conda import misc
+from conda.misc import (conda_installed_files, swap_execute_actions, untracked,
+                        url_pat, walk_prefix, which_package)
 
 
 class TestMisc(unittest.TestCase):
@@ -68,5 +74,183 @@ def test_walk_prefix(tmpdir):  # tmpdir is a py.test utility
     assert walk_prefix(tmpdir.strpath) == answer
 
 
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="environments are not swapped on Windows")
+def test_swap_execute_actions(synthetic_package, tmpdir):
+    old_dist, old_files = synthetic_package(2, dist='synthetic-1.0-0')
+    other_dist, other_files = synthetic_package(1, dist='other-1.0-0')
+    dist, files = synthetic_package(1, dist='synthetic-2.0-0')
+    prefix = tmpdir.join('envs', 'test')
+    install.link(prefix.strpath, old_dist)
+    prefix.join('etc', 'untracked.cfg').write('settings', ensure=True)
+    prefix.join('conda-meta', 'pinned').write('synthetic 2.0')
+    inode = prefix.stat().ino
+
+    swap_execute_actions({'PREFIX': prefix.strpath,
+                          'UNLINK': [old_dist],
+                          'LINK': [dist, other_dist]})
+    assert prefix.stat().ino != inode
+    assert install.linked(prefix.strpath) == {dist, other_dist}
+    assert not prefix.join('lib', 'lib1.so').check()
+    assert prefix.join('etc', 'untracked.cfg').read() == 'settings'
+    assert prefix.join('conda-meta', 'pinned').read() == 'synthetic 2.0'
+    # the placeholders are replaced by the prefix, not the staging directory
+    data = prefix.join('bin', 'script0').read()
+    assert data.startswith('#!%s/bin/python' % prefix.strpath)
+    # nothing is left next to the prefix
+    assert tmpdir.join('envs').listdir() == [prefix]
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="environments are not swapped on Windows")
+def test_swap_execute_actions_copies(synthetic_package, tmpdir, monkeypatch):
+    old_dist, old_files = synthetic_package(1, dist='synthetic-1.0-0')
+    dist, files = synthetic_package(1, dist='synthetic-2.0-0')
+    pkgs = tmpdir.join('pkgs')
+    local_dist, _ = synthetic_package(0, dist='local-1.0-0')
+    nomanifest_dist, _ = synthetic_package(0, dist='nomanifest-1.0-0')
+    for name in 'local', 'nomanifest':
+        pkgs.join('%s-1.0-0' % name, 'share', '%s.txt' % name).write(name, ensure=True)
+        pkgs.join('%s-1.0-0' % name, 'info', 'files').write('share/%s.txt' % name)
+    prefix = tmpdir.join('envs', 'test')
+    for d in old_dist, local_dist, nomanifest_dist:
+        install.link(prefix.strpath, d, install.LINK_COPY)
+    # a local build, which is not in the package cache anymore
+    install.rm_extracted(local_dist)
+    assert not pkgs.join('local-1.0-0').check()
+    # a package linked without a manifest, modified in the prefix
+    meta_path = prefix.join('conda-meta', 'nomanifest-1.0-0.json')
+    meta = json.loads(meta_path.read())
+    del meta['manifest']
+    meta_path.write(json.dumps(meta))
+    monkeypatch.setattr(install, 'linked_data_', {})
+    prefix.join('share', 'nomanifest.txt').write('changed')
+
+    swap_execute_actions({'PREFIX': prefix.strpath,
+                          'UNLINK': [old_dist],
+                          'LINK': [dist]})
+    assert install.linked(prefix.strpath) == {dist, local_dist, nomanifest_dist}
+    assert prefix.join('share', 'local.txt').read() == 'local'
+    assert prefix.join('share', 'nomanifest.txt').read() == 'changed'
+    assert pkgs.join('nomanifest-1.0-0', 'share', 'nomanifest.txt').read() == 'nomanifest'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses shell scripts")
+def test_swap_execute_actions_scripts(synthetic_package, tmpdir):
+    old_dist, old_files = synthetic_package(1, dist='synthetic-1.0-0')
+    dist, files = synthetic_package(1, dist='synthetic-2.0-0')
+    kept_dist, _ = synthetic_package(0, dist='kept-1.0-0')
+    pkgs = tmpdir.join('pkgs')
+    pkgs.join('synthetic-1.0-0', 'bin', '.synthetic-pre-unlink.sh').write(
+        'echo "$PREFIX" > %s\n' % tmpdir.join('pre-unlink.txt'))
+    pkgs.join('synthetic-1.0-0', 'info', 'files').write(
+        '\nbin/.synthetic-pre-unlink.sh', mode='a')
+    pkgs.join('synthetic-2.0-0', 'bin', '.synthetic-post-link.sh').write(
+        'echo "$PREFIX" > "$PREFIX/post-link.txt"\n')
+    pkgs.join('synthetic-2.0-0', 'info', 'files').write(
+        '\nbin/.synthetic-post-link.sh', mode='a')
+    pkgs.join('kept-1.0-0', 'share', 'kept.txt').write('kept\n', ensure=True)
+    pkgs.join('kept-1.0-0', 'info', 'files').write('share/kept.txt')
+    prefix = tmpdir.join('envs', 'test')
+    install.link(prefix.strpath, old_dist)
+    install.link(prefix.strpath, kept_dist)
+    # the file is hard-linked, and replaced (like an editor would)
+    prefix.join('share', 'kept.txt').remove()
+    prefix.join('share', 'kept.txt').write('changed\n')
+
+    swap_execute_actions({'PREFIX': prefix.strpath,
+                          'UNLINK': [old_dist],
+                          'LINK': [dist]})
+    assert install.linked(prefix.strpath) == {dist, kept_dist}
+    assert tmpdir.join('pre-unlink.txt').read() == prefix.strpath + '\n'
+    assert prefix.join('post-link.txt').read() == prefix.strpath + '\n'
+    assert prefix.join('share', 'kept.txt').read() == 'changed\n'
+    assert pkgs.join('kept-1.0-0', 'share', 'kept.txt').read() == 'kept\n'
+
+
+@pytest.mark.parametrize('state_db', [False, True])
+def test_which_package(tmpdir, monkeypatch, state_db):
+    if state_db and install.sqlite3 is None:
+        pytest.skip("requires sqlite3")
+    monkeypatch.setattr(install.config, 'prefix_state_db', state_db)
+    prefix = tmpdir.join('envs', 'test')
+    for dist, files in [('a-1.0-0', ['lib/a', 'lib/common']),
+                        ('b-1.0-0', ['lib/b', 'lib/common'])]:
+        prefix.join('conda-meta', dist + '.json').write(
+            '{"files": %s}' % str(files).replace("'", '"'), ensure=True)
+    a, b = sorted(install.linked(prefix.strpath))
+
+    assert list(which_package(prefix.join('lib', 'a').strpath)) == [a]
+    assert list(which_package(prefix.join('lib', 'common').strpath)) == [a, b]
+    assert list(which_package(prefix.join('lib', 'other').strpath)) == []
+    assert conda_installed_files(prefix.strpath) == {'lib/a', 'lib/b', 'lib/common'}
+
+    # the index follows packages being unlinked
+    install.delete_linked_data(prefix.strpath, a)
+    assert list(which_package(prefix.join('lib', 'common').strpath)) == [b]
+    assert conda_installed_files(prefix.strpath) == {'lib/b', 'lib/common'}
+
+
+def test_untracked(tmpdir, monkeypatch):
+    prefix = tmpdir.join('envs', 'test')
+    owned = ['lib/a/%d.py' % i for i in range(3)] + ['lib/b/x.py', 'bin/tool']
+    for f in owned + ['lib/a/1.pyc', 'lib/b/notes.txt', 'etc/local.cfg']:
+        prefix.join(f).write('', ensure=True)
+    prefix.join('conda-meta', 'a-1.0-0.json').write(
+        '{"files": %s}' % str(owned).replace("'", '"'), ensure=True)
+
+    listed = []
+    orig_scandir = misc.scandir
+    monkeypatch.setattr(misc, 'scandir', lambda path: listed.append(path) or orig_scandir(path))
+    expected = {'lib/b/notes.txt', 'etc/local.cfg'}
+    assert untracked(prefix.strpath) == expected
+    assert prefix.join('lib', 'a').strpath in listed
+
+    # directories which only contain files of packages are not listed again,
+    # unless files are added to them
+    del listed[:]
+    assert untracked(prefix.strpath) == expected
+    assert prefix.join('lib', 'a').strpath not in listed
+    assert prefix.join('lib', 'b').strpath in listed
+    prefix.join('lib', 'a', 'new.py').write('')
+    assert untracked(prefix.strpath) == expected | {'lib/a/new.py'}
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="files are not hard-linked on Windows")
+def test_clone_files(tmpdir, monkeypatch):
+    # small chunks, such that the prefix spans several of them
+    monkeypatch.setattr(misc, 'CLONE_CHUNK_SIZE', 7)
+    prefix1 = tmpdir.join('envs', 'src')
+    prefix2 = tmpdir.join('envs', 'dst')
+    p1 = prefix1.strpath
+    prefix1.join('etc', 'conf.txt').write(('path=%s/lib\n' % p1) * 3, ensure=True)
+    prefix1.join('etc', 'plain.txt').write('no prefix here\n' * 10)
+    prefix1.join('lib', 'data.bin').write_binary(b'\xff\xfe' + p1.encode('utf-8'),
+                                                 ensure=True)
+    os.symlink('data.bin', prefix1.join('lib', 'link').strpath)
+    files = ['etc/conf.txt', 'etc/plain.txt', 'lib/data.bin', 'lib/link']
+
+    misc.clone_files(p1, prefix2.strpath, files)
+    assert prefix2.join('etc', 'conf.txt').read() == (
+        'path=%s/lib\n' % prefix2.strpath) * 3
+    # binary files, and files without the prefix, are linked as they are
+    for f in 'etc/plain.txt', 'lib/data.bin':
+        assert prefix2.join(f).read_binary() == prefix1.join(f).read_binary()
+        assert os.path.samefile(prefix1.join(f).strpath, prefix2.join(f).strpath)
+    assert prefix2.join('lib', 'link').readlink() == 'data.bin'
+
+    prefix3 = tmpdir.join('envs', 'copy')
+    misc.clone_files(p1, prefix3.strpath, files, always_copy=True)
+    assert prefix3.join('etc', 'plain.txt').read() == 'no prefix here\n' * 10
+    assert not os.path.samefile(prefix1.join('etc', 'plain.txt').strpath,
+                                prefix3.join('etc', 'plain.txt').strpath)
+
+    # errors writing the files are not ignored
+    def replace_prefix(src, dst, a, b):
+        raise IOError(28, 'No space left on device')
+    monkeypatch.setattr(misc, '_replace_prefix', replace_prefix)
+    with pytest.raises(IOError):
+        misc.clone_files(p1, tmpdir.join('envs', 'full').strpath, files)
+
+
 if __name__ == '__main__':
     unittest.main()
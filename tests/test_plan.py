@@ -929,5 +929,21 @@ class PlanFromActionsTests(unittest.TestCase):
 
         self.assertEqual(expected_plan, conda_plan)
 
+    def test_plan_staged_updates(self):
+        actions = {
+            'PREFIX': 'aprefix',
+            'op_order': (inst.UNLINK, inst.LINK),
+            'UNLINK': ['numpy-1.9.2-py27_0', 'six-1.9.0-py27_0'],
+            'LINK': ['numpy-1.10.1-py27_0 %d' % LINK_HARD, 'python-2.7.10-0'],
+        }
+        staged = plan.staged_update_actions(actions)
+        self.assertEqual(staged['op_order'], (inst.UNLINK, inst.UPDATE, inst.LINK))
+        self.assertEqual(staged['UNLINK'], ['six-1.9.0-py27_0'])
+        self.assertEqual(staged['UPDATE'],
+                         ['numpy-1.10.1-py27_0 %d numpy-1.9.2-py27_0' % LINK_HARD])
+        self.assertEqual(staged['LINK'], ['python-2.7.10-0'])
+        # the original actions are unchanged
+        self.assertEqual(len(actions['UNLINK']), 2)
+
 if __name__ == '__main__':
     unittest.main()
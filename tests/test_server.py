@@ -0,0 +1,117 @@
+import bz2
+import io
+import json
+import tarfile
+import threading
+from os.path import join
+
+import pytest
+import requests
+
+from conda.server import make_server, PackageCacheIndex
+from conda.utils import md5_file
+
+
+def make_tarball(pkgs_dir, name, version='1.0', build='0', subdir='linux-64'):
+    fn = '%s-%s-%s.tar.bz2' % (name, version, build)
+    info = {'name': name, 'version': version, 'build': build,
+            'build_number': int(build), 'depends': [], 'subdir': subdir}
+    data = json.dumps(info).encode('utf-8')
+    t = tarfile.open(join(pkgs_dir, fn), 'w:bz2')
+    ti = tarfile.TarInfo('info/index.json')
+    ti.size = len(data)
+    t.addfile(ti, io.BytesIO(data))
+    t.close()
+    return fn
+
+
+@pytest.fixture
+def server(tmpdir):
+    pkgs_dir = tmpdir.strpath
+    s = make_server([pkgs_dir], host='127.0.0.1', port=0)
+    t = threading.Thread(target=s.serve_forever)
+    t.daemon = True
+    t.start()
+    yield s, pkgs_dir
+    s.shutdown()
+    s.server_close()
+
+
+def get(url):
+    session = requests.Session()
+    session.trust_env = False
+    return session.get(url)
+
+
+def test_repodata(tmpdir):
+    pkgs_dir = tmpdir.strpath
+    fn1 = make_tarball(pkgs_dir, 'foo')
+    fn2 = make_tarball(pkgs_dir, 'bar', subdir='noarch')
+    index = PackageCacheIndex([pkgs_dir])
+
+    packages = index.repodata('linux-64')['packages']
+    assert list(packages) == [fn1]
+    assert packages[fn1]['name'] == 'foo'
+    assert packages[fn1]['md5'] == md5_file(join(pkgs_dir, fn1))
+    assert list(index.repodata('noarch')['packages']) == [fn2]
+    assert index.repodata('osx-64')['packages'] == {}
+
+
+def test_serve(server):
+    s, pkgs_dir = server
+    fn = make_tarball(pkgs_dir, 'foo')
+
+    resp = get(s.url + 'linux-64/repodata.json.bz2')
+    assert resp.status_code == 200
+    repodata = json.loads(bz2.decompress(resp.content).decode('utf-8'))
+    assert list(repodata['packages']) == [fn]
+
+    resp = get(s.url + 'linux-64/' + fn)
+    assert resp.status_code == 200
+    with open(join(pkgs_dir, fn), 'rb') as fi:
+        assert resp.content == fi.read()
+
+    assert get(s.url + 'linux-64/missing-1.0-0.tar.bz2').status_code == 404
+    assert get(s.url + 'foo').status_code == 404
+
+    # packages are only served under their own subdir
+    assert get(s.url + 'osx-64/' + fn).status_code == 404
+
+
+def test_pull_through(tmpdir, monkeypatch):
+    from conda import config
+
+    monkeypatch.setattr(config, 'pkgs_dirs', [tmpdir.join('pkgs').strpath])
+    # the servers must be reached directly
+    monkeypatch.setattr(config, 'rc', {})
+    monkeypatch.setattr(config, 'shared_cache_dir', None)
+    upstream_dir = tmpdir.mkdir('upstream').strpath
+    fn = make_tarball(upstream_dir, 'foo')
+    mirror_dir = tmpdir.mkdir('mirror').strpath
+    servers = [make_server([upstream_dir], host='127.0.0.1', port=0)]
+    servers.append(make_server([mirror_dir], host='127.0.0.1', port=0,
+                               upstream=servers[0].url))
+    for s in servers:
+        t = threading.Thread(target=s.serve_forever)
+        t.daemon = True
+        t.start()
+    try:
+        mirror = servers[1]
+        resp = get(mirror.url + 'linux-64/repodata.json')
+        assert list(resp.json()['packages']) == [fn]
+
+        resp = get(mirror.url + 'linux-64/' + fn)
+        assert resp.status_code == 200
+        with open(join(upstream_dir, fn), 'rb') as fi:
+            assert resp.content == fi.read()
+        # the package is now cached by the mirror
+        assert mirror.index.find('linux-64', fn) == join(mirror_dir, fn)
+        with open(join(mirror_dir, 'urls.txt')) as fi:
+            assert fi.read().split() == [servers[0].url + 'linux-64/' + fn]
+
+        assert get(mirror.url + 'osx-64/' + fn).status_code == 404
+        assert get(mirror.url + 'linux-64/bar-1.0-0.tar.bz2').status_code == 404
+    finally:
+        for s in servers:
+            s.shutdown()
+            s.server_close()
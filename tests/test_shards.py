@@ -0,0 +1,84 @@
+import bz2
+import json
+
+import pytest
+
+from conda import config
+from conda.fetch import fetch_index
+from conda.shards import MANIFEST_FN, shard_repodata, write_shards
+from conda.utils import url_path
+
+
+def record(name, version='1.0', depends=()):
+    return ('%s-%s-0.tar.bz2' % (name, version),
+            {'name': name, 'version': version, 'build': '0',
+             'build_number': 0, 'depends': list(depends)})
+
+
+def make_channel(dir_path, records, sharded=True):
+    repodata = {'info': {'subdir': config.subdir},
+                'packages': dict(records)}
+    dir_path.ensure(dir=True)
+    with open(dir_path.join('repodata.json.bz2').strpath, 'wb') as fo:
+        fo.write(bz2.compress(json.dumps(repodata).encode('utf-8')))
+    if sharded:
+        write_shards(repodata, dir_path.strpath)
+    return url_path(dir_path.strpath) + '/'
+
+
+@pytest.fixture
+def shard_config(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'pkgs_dirs', [tmpdir.join('pkgs').strpath])
+    monkeypatch.setattr(config, 'sharded_repodata', True)
+    monkeypatch.setattr(config, 'add_pip_as_python_dependency', False)
+    return tmpdir
+
+
+def test_shard_repodata():
+    repodata = {'info': {'subdir': 'linux-64'},
+                'packages': dict([record('a'), record('a', '2.0'), record('b')])}
+    manifest, shards = shard_repodata(repodata)
+    assert manifest == {'info': {'subdir': 'linux-64'},
+                        'shards': {'a': 'shards/a.json.bz2',
+                                   'b': 'shards/b.json.bz2'}}
+    assert sorted(shards['shards/a.json.bz2']['packages']) == [
+        'a-1.0-0.tar.bz2', 'a-2.0-0.tar.bz2']
+
+
+def test_only_reachable_shards_are_fetched(shard_config):
+    url = make_channel(shard_config.join('channel'), [
+        record('a', depends=['b >=1.0']),
+        record('b', depends=['c']),
+        record('c'),
+        record('d', depends=['a']),
+    ])
+    assert shard_config.join('channel', MANIFEST_FN).check()
+    index = fetch_index({url: ('test', 1)}, names={'a'})
+    assert sorted(index) == ['test::a-1.0-0.tar.bz2', 'test::b-1.0-0.tar.bz2',
+                             'test::c-1.0-0.tar.bz2']
+    assert index['test::a-1.0-0.tar.bz2']['channel'] == url
+
+    # without names, or with sharding disabled, all packages are fetched
+    assert len(fetch_index({url: ('test', 1)})) == 4
+    config.sharded_repodata = False
+    assert len(fetch_index({url: ('test', 1)}, names={'a'})) == 4
+
+
+def test_dependencies_across_channels(shard_config):
+    url1 = make_channel(shard_config.join('channel1'), [
+        record('a', depends=['b']),
+        record('x'),
+    ])
+    url2 = make_channel(shard_config.join('channel2'), [
+        record('b', depends=['c']),
+        record('y'),
+    ], sharded=False)
+    url3 = make_channel(shard_config.join('channel3'), [
+        record('c'),
+        record('z'),
+    ])
+    index = fetch_index({url1: ('c1', 1), url2: ('c2', 2), url3: ('c3', 3)},
+                        names={'a'})
+    # channel2 has no shards, so all of its packages are in the index
+    assert sorted(index) == ['c1::a-1.0-0.tar.bz2', 'c2::b-1.0-0.tar.bz2',
+                             'c2::y-1.0-0.tar.bz2', 'c3::c-1.0-0.tar.bz2']
@@ -147,3 +147,34 @@ def test_text_translations():
     test_unix_text = "prepending /z/msarahan/code/conda/tests/envsk5_b4i/test 1 and /z/msarahan/code/conda/tests/envsk5_b4i/test 1/scripts to path"
     assert_equals(test_win_text, utils.unix_path_to_win(test_unix_text))
     assert_equals(test_unix_text, utils.win_path_to_unix(test_win_text))
+
+
+def test_cached_md5_file(tmpdir):
+    path = tmpdir.join('foo-1.0-0.tar.bz2')
+    path.write(b'some data', mode='wb')
+    md5 = utils.md5_file(path.strpath)
+    assert utils.cached_md5_file(path.strpath) == md5
+    assert tmpdir.join('cache', 'digests.json').check()
+    with mock.patch.object(utils, 'md5_file') as md5_file:
+        assert utils.cached_md5_file(path.strpath) == md5
+        assert not md5_file.called
+    # a changed file is hashed again
+    path.write(b'other data!', mode='wb')
+    assert utils.cached_md5_file(path.strpath) == utils.md5_file(path.strpath)
+
+
+def test_download_digests(tmpdir):
+    import hashlib
+    from conda.fetch import download
+
+    src = tmpdir.join('src.tar.bz2')
+    src.write(b'package data' * 1000, mode='wb')
+    dst = tmpdir.mkdir('pkgs').join('dst.tar.bz2')
+    md5 = utils.md5_file(src.strpath)
+    hashes = download(utils.url_path(src.strpath), dst.strpath, md5=md5,
+                      digests={'sha256': hashlib.sha256})
+    assert hashes['sha256'].hexdigest() == utils.hashsum_file(src.strpath, 'sha256')
+    # the verified MD5 is recorded, so the tarball need not be read again
+    with mock.patch.object(utils, 'md5_file') as md5_file:
+        assert utils.cached_md5_file(dst.strpath) == md5
+        assert not md5_file.called